@@ -0,0 +1,7 @@
+"""
+Benchmarks for the twistar hot paths.  Run them with::
+
+    python -m benchmarks --help
+
+By default they run offline against a temporary SQLite database.
+"""
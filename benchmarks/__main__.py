@@ -0,0 +1,6 @@
+from __future__ import absolute_import
+from twisted.internet import task
+
+from benchmarks.run import main
+
+task.react(main)
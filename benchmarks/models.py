@@ -0,0 +1,80 @@
+"""
+Classes and schema used by the benchmarks.
+"""
+
+from __future__ import absolute_import
+from twisted.enterprise import adbapi
+
+from twistar.dbobject import DBObject
+from twistar.registry import Registry
+
+
+class Author(DBObject):
+    HASMANY = ['books']
+    HASONE = ['profile']
+
+
+class Profile(DBObject):
+    BELONGSTO = ['author']
+
+
+class Book(DBObject):
+    BELONGSTO = ['author']
+    HABTM = ['tags']
+
+
+class Tag(DBObject):
+    HABTM = ['books']
+
+
+Registry.register(Author, Profile, Book, Tag)
+
+
+PRIMARY_KEYS = {
+    'sqlite': "id INTEGER PRIMARY KEY AUTOINCREMENT",
+    'postgres': "id SERIAL PRIMARY KEY",
+    'mysql': "id INT AUTO_INCREMENT PRIMARY KEY"
+}
+
+TABLES = {
+    'authors': "%s, name VARCHAR(255), email VARCHAR(255), age INT",
+    'profiles': "%s, bio VARCHAR(255), author_id INT",
+    'books': "%s, title VARCHAR(255), pages INT, price FLOAT, author_id INT",
+    'tags': "%s, name VARCHAR(255)",
+    'books_tags': "book_id INT, tag_id INT"
+}
+
+
+def connect(db, location):
+    """
+    Create the connection pool for the given database type.
+
+    @param db: One of C{'sqlite'}, C{'postgres'} or C{'mysql'}.
+
+    @param location: A file name for SQLite, a DSN (like C{"dbname=twistar"})
+    for PostgreSQL or comma separated C{key=value} connection arguments for MySQL.
+    """
+    if db == 'sqlite':
+        return adbapi.ConnectionPool('sqlite3', location, check_same_thread=False)
+    if db == 'postgres':
+        return adbapi.ConnectionPool('psycopg2', location)
+    kwargs = dict(pair.split('=', 1) for pair in location.split(','))
+    return adbapi.ConnectionPool('MySQLdb', **kwargs)
+
+
+def createTables(db):
+    """
+    (Re)create the benchmark tables.
+
+    @return: A C{Deferred}.
+    """
+    def _create(txn):
+        for tablename, columns in TABLES.items():
+            txn.execute("DROP TABLE IF EXISTS %s" % tablename)
+            if '%s' in columns:
+                columns = columns % PRIMARY_KEYS[db]
+            txn.execute("CREATE TABLE %s (%s)" % (tablename, columns))
+        txn.execute("CREATE INDEX books_author_id ON books (author_id)")
+        txn.execute("CREATE INDEX books_tags_book_id ON books_tags (book_id)")
+    Registry.SCHEMAS.clear()
+    return Registry.DBPOOL.runInteraction(_create)
@@ -0,0 +1,436 @@
+"""
+The benchmark suite.  Each benchmark is a function that accepts a L{Context}
+and returns a C{Deferred} (or plain value) with the number of operations it
+performed.  Results are printed, can be written as JSON, and can be compared
+against a stored baseline.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+import os
+import sys
+import json
+import platform
+import argparse
+import tempfile
+from timeit import default_timer as now
+
+import twisted
+from twisted.internet import defer
+
+from twistar.registry import Registry
+from twistar.utils import createInstances, transaction
+from twistar import version
+
+from benchmarks.models import Author, Book, Tag, Profile, connect, createTables
+from six.moves import range
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """
+    Decorator adding a function to the suite.
+    """
+    BENCHMARKS.append(func)
+    return func
+
+
+class FakeTxn(object):
+    """
+    Just enough of a cursor for L{InteractionBase.valuesToHash}.
+    """
+    def __init__(self, cols):
+        self.description = [(col,) for col in cols]
+
+
+class Context(object):
+    """
+    The data a benchmark runs against.
+
+    @ivar size: The number of rows in the C{books} table.
+    @ivar config: The L{InteractionBase} in use.
+    @ivar authors: A C{list} of saved L{Author}s (one per ten books).
+    @ivar books: A C{list} of all L{Book}s.
+    @ivar tags: A C{list} of saved L{Tag}s.
+    @ivar lastIds: The largest id in each table that benchmarks add rows to, after
+    L{populate}.
+
+    @cvar DB: The type of database being used.
+    """
+    DB = 'sqlite'
+
+    def __init__(self, size):
+        self.size = size
+        self.config = Registry.getConfig()
+        self.authors = []
+        self.books = []
+        self.tags = []
+        self.lastIds = {}
+
+
+    @defer.inlineCallbacks
+    def populate(self):
+        yield createTables(Context.DB)
+        authors = [{'name': "author %i" % i, 'email': "a%i@example.com" % i, 'age': 20 + i % 50}
+                   for i in range(max(self.size // 10, 1))]
+        yield self.insertChunks('authors', authors)
+        self.authors = yield Author.all()
+
+        profiles = [{'bio': "bio", 'author_id': author.id} for author in self.authors]
+        yield self.insertChunks('profiles', profiles)
+
+        books = [{'title': "book %i" % i, 'pages': i % 500, 'price': i * 0.25,
+                  'author_id': self.authors[i % len(self.authors)].id} for i in range(self.size)]
+        yield self.insertChunks('books', books)
+        self.books = yield Book.all()
+
+        yield self.insertChunks('tags', [{'name': "tag %i" % i} for i in range(20)])
+        self.tags = yield Tag.all()
+
+        for tablename in ('authors', 'books'):
+            result = yield self.config.aggregate(tablename, max='id')
+            self.lastIds[tablename] = result['max_id']
+
+
+    def restore(self):
+        """
+        Delete the rows benchmarks have added since L{populate}, so that every benchmark
+        (and every repeat of one) runs against C{size} rows.
+
+        @return: A C{Deferred}.
+        """
+        ds = [self.config.delete(tablename, where=['id > ?', lastId])
+              for tablename, lastId in sorted(self.lastIds.items())]
+        return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+
+
+    @defer.inlineCallbacks
+    def insertChunks(self, tablename, rows, chunksize=1000):
+        for index in range(0, len(rows), chunksize):
+            yield self.config.insertMany(tablename, rows[index:index + chunksize])
+
+
+@benchmark
+def hydrate(ctx):
+    """
+    Select every book and turn the rows into objects.
+    """
+    return Book.all().addCallback(len)
+
+
+@benchmark
+def hydrate_slotted(ctx):
+    """
+    L{hydrate} with the slotted L{Book} class.
+    """
+    Book.SLOTS = True
+
+    def _done(result):
+        Book.SLOTS = False
+        return result
+    return Book.all().addBoth(_done).addCallback(len)
+
+
+@benchmark
+def find_columns(ctx):
+    """
+    Select every book column by column (no objects or row dicts).
+    """
+    return Book.findColumns().addCallback(lambda columns: len(columns['id']))
+
+
+@benchmark
+def create_instances(ctx):
+    """
+    createInstances on already fetched rows (no database access).
+    """
+    rows = [{'id': i, 'title': "book", 'pages': i, 'price': 1.0, 'author_id': 1} for i in range(ctx.size)]
+    return createInstances(rows, Book).addCallback(len)
+
+
+@benchmark
+def values_to_hash(ctx):
+    """
+    valuesToHash on fake rows (no database access).
+    """
+    txn = FakeTxn(['id', 'title', 'pages', 'price', 'author_id'])
+    row = (1, "book", 100, 1.0, 1)
+    for _ in range(ctx.size):
+        ctx.config.valuesToHash(txn, row, 'books')
+    return ctx.size
+
+
+@benchmark
+def getattribute(ctx):
+    """
+    Read attributes of every book.
+    """
+    for book in ctx.books:
+        book.id, book.title, book.pages, book.price, book.author_id
+    return len(ctx.books) * 5
+
+
+@benchmark
+def to_hash(ctx):
+    """
+    Convert every book to a dictionary.
+    """
+    cols = Registry.SCHEMAS[Book.tablename()]
+    for book in ctx.books:
+        book.toHash(cols, includeBlank=True, exclude=['id'])
+    return len(ctx.books)
+
+
+@benchmark
+def relationship_access(ctx):
+    """
+    Create relationship objects (without querying).
+    """
+    for book in ctx.books:
+        book.author
+        book.tags
+    return len(ctx.books) * 2
+
+
+@benchmark
+@defer.inlineCallbacks
+def save_create(ctx):
+    """
+    Create authors one at a time.
+    """
+    count = min(ctx.size, 500)
+    for i in range(count):
+        yield Author(name="new author %i" % i, email="new%i@example.com" % i, age=30).save()
+    defer.returnValue(count)
+
+
+@benchmark
+@defer.inlineCallbacks
+def save_update(ctx):
+    """
+    Update books one at a time.
+    """
+    books = ctx.books[:500]
+    for book in books:
+        book.pages += 1
+        yield book.save()
+    defer.returnValue(len(books))
+
+
+@benchmark
+@defer.inlineCallbacks
+def insert_many(ctx):
+    """
+    Bulk insert books.
+    """
+    rows = [{'title': "bulk", 'pages': 1, 'price': 1.0, 'author_id': None} for _ in range(ctx.size)]
+    yield ctx.insertChunks('books', rows)
+    defer.returnValue(len(rows))
+
+
+@benchmark
+@defer.inlineCallbacks
+def habtm_set(ctx):
+    """
+    Set the tags of books.
+    """
+    books = ctx.books[:100]
+    for book in books:
+        yield book.tags.set(ctx.tags[:10])
+    defer.returnValue(len(books))
+
+
+@benchmark
+@defer.inlineCallbacks
+def habtm_get(ctx):
+    """
+    Get the tags of books.
+    """
+    books = ctx.books[:100]
+    for book in books:
+        yield book.tags.get()
+    defer.returnValue(len(books))
+
+
+@benchmark
+def validation(ctx):
+    """
+    Validate unsaved authors with in-memory validators.
+    """
+    Author.validatesPresenceOf('name', 'email')
+    Author.validatesLengthOf('name', range=range(1, 256))
+    authors = [Author(name="author %i" % i, email="e%i@example.com" % i) for i in range(min(ctx.size, 10000))]
+
+    def _done(_):
+        Author.clearValidations()
+        return len(authors)
+    return defer.DeferredList([author.validate() for author in authors]).addBoth(_done)
+
+
+@benchmark
+@defer.inlineCallbacks
+def lazy_loading(ctx):
+    """
+    Get the author of books one book at a time.
+    """
+    books = ctx.books[:200]
+    for book in books:
+        yield book.author.get()
+    defer.returnValue(len(books))
+
+
+@benchmark
+@defer.inlineCallbacks
+def eager_loading(ctx):
+    """
+    Get the authors of the same books as L{lazy_loading} with one query.
+    """
+    books = ctx.books[:200]
+    ids = sorted(set(book.author_id for book in books))
+    where = ["id IN (%s)" % ",".join(["?"] * len(ids))] + ids
+    authors = yield Author.find(where=where)
+    byid = dict((author.id, author) for author in authors)
+    [byid.get(book.author_id) for book in books]
+    defer.returnValue(len(books))
+
+
+@benchmark
+def load_relations(ctx):
+    """
+    loadRelations on authors.
+    """
+    authors = ctx.authors[:100]
+    ds = [author.loadRelations('books', 'profile') for author in authors]
+    return defer.DeferredList(ds).addCallback(lambda _: len(authors))
+
+
+@benchmark
+@defer.inlineCallbacks
+def transactions(ctx):
+    """
+    Run small transactions one after another.
+    """
+    @transaction
+    def interaction(txn, authorid):
+        return Profile.find(where=['author_id = ?', authorid], limit=1)
+
+    authors = ctx.authors[:100]
+    for author in authors:
+        yield interaction(author.id)
+    defer.returnValue(len(authors))
+
+
+@benchmark
+def concurrent_find(ctx):
+    """
+    Many finds at once through the connection pool.
+    """
+    ds = [Author.find(ctx.authors[i % len(ctx.authors)].id) for i in range(500)]
+    return defer.DeferredList(ds).addCallback(lambda _: len(ds))
+
+
+@defer.inlineCallbacks
+def measure(func, ctx, repeat):
+    """
+    Run a benchmark C{repeat} times, restoring the context's rows after each run (which
+    isn't timed).
+
+    @return: A C{Deferred} firing with a C{dict} of results.
+    """
+    times = []
+    ops = 0
+    for _ in range(repeat):
+        start = now()
+        ops = yield defer.maybeDeferred(func, ctx)
+        times.append(now() - start)
+        yield ctx.restore()
+    times.sort()
+    median = times[len(times) // 2]
+    defer.returnValue({
+        'min': times[0],
+        'median': median,
+        'ops': ops,
+        'ops_per_sec': ops / median if median else None
+    })
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results to a baseline.
+
+    @return: A C{list} of C{(name, ratio)} pairs for the benchmarks whose median time
+    grew by more than C{tolerance} (a fraction).
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline or not baseline[name]['median']:
+            continue
+        ratio = result['median'] / baseline[name]['median']
+        result['baseline_ratio'] = ratio
+        if ratio > 1 + tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark twistar's hot paths.")
+    parser.add_argument('--db', choices=['sqlite', 'postgres', 'mysql'], default='sqlite')
+    parser.add_argument('--location', help="SQLite file, PostgreSQL DSN, or MySQL key=value,... arguments")
+    parser.add_argument('--sizes', default="1000,100000", help="Comma separated numbers of rows")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', help="Comma separated names of benchmarks to run")
+    parser.add_argument('--output', help="Write results as JSON to this file")
+    parser.add_argument('--baseline', help="Compare results to this JSON file (written with --output)")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed slowdown relative to the baseline before failing (default 0.2)")
+    return parser.parse_args(argv)
+
+
+@defer.inlineCallbacks
+def main(reactor, argv=None):
+    args = parseArgs(sys.argv[1:] if argv is None else argv)
+    location = args.location
+    if args.db == 'sqlite' and location is None:
+        location = os.path.join(tempfile.mkdtemp(), "benchmarks.sqlite")
+    Context.DB = args.db
+    Registry.DBPOOL = connect(args.db, location)
+    Registry.IMPL = None
+
+    funcs = BENCHMARKS
+    if args.only:
+        names = args.only.split(",")
+        funcs = [func for func in BENCHMARKS if func.__name__ in names]
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(",")]:
+        ctx = Context(size)
+        yield ctx.populate()
+        for func in funcs:
+            name = "%s[%i]" % (func.__name__, size)
+            results[name] = yield measure(func, ctx, args.repeat)
+            print("%-28s %10.4fs %12.1f ops/s" % (name, results[name]['median'], results[name]['ops_per_sec'] or 0))
+    Registry.DBPOOL.close()
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        for name, ratio in regressions:
+            print("REGRESSION %-28s %.2fx slower than baseline" % (name, ratio))
+
+    if args.output:
+        meta = {
+            'twistar': version,
+            'twisted': twisted.__version__,
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'db': args.db,
+            'repeat': args.repeat
+        }
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2, sort_keys=True)
+
+    if regressions:
+        raise SystemExit(1)
@@ -12,6 +12,6 @@ setup(
     author_email="bamuller@gmail.com",
     license="MIT",
     url="http://findingscience.com/twistar",
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks']),
     install_requires=['twisted >= 12.1','six']
 )
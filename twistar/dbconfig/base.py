@@ -3,14 +3,44 @@ Base module for interfacing with databases.
 """
 
 from __future__ import absolute_import
+import itertools
+import threading
+from timeit import default_timer as now
+
 from twisted.python import log
-from twisted.internet import defer
+from twisted.python.failure import Failure
+from twisted.internet import defer, reactor
 
 from twistar.registry import Registry
-from twistar.exceptions import ImaginaryTableError, CannotRefreshError
-from twistar.utils import joinWheres
+from twistar.instrumentation import Instrumentation
+from twistar.exceptions import ImaginaryTableError, CannotRefreshError, StaleObjectError, QueryTimeoutError
+from twistar.retry import originalError
+from twistar.utils import joinWheres, extendColumn
+import six
 from six.moves import range
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RunningInteraction(object):
+    """
+    The transaction of an interaction run by L{InteractionBase.runPooled}, for interrupting
+    it from other threads (see L{InteractionBase.interrupt}).
+
+    @ivar txn: The transaction while the interaction is running, and C{None} before it
+    starts and once it has finished.
+
+    @ivar lock: A lock held while L{txn} is set or cleared.  Whoever holds it can be sure
+    that the interaction doesn't finish (and its connection isn't reused) meanwhile.
+    """
+
+    def __init__(self):
+        self.txn = None
+        self.lock = threading.Lock()
+
 
 class InteractionBase(object):
     """
@@ -20,61 +50,110 @@ class InteractionBase(object):
 
     @cvar includeBlankInInsert: If True, then insert/update queries will include
     setting object properties that have not be set to null in their respective columns.
+
+    @cvar AGGREGATES: The aggregate functions L{aggregate} accepts.
+
+    @cvar MAX_IN_PARAMS: The largest number of values bound in one C{IN} list (see L{whereIn}).
+
+    @cvar TEMP_TABLE_THRESHOLD: The number of values beyond which L{selectIn} puts them in a
+    temporary table rather than running one query per C{IN} list.  C{None} means never.
+
+    @cvar CONSTRAINT_MESSAGES: The error messages added to an object's C{errors} for each
+    kind of constraint violation (see L{parseIntegrityError}).  They are the same as the
+    default messages of the corresponding validators.
+
+    @cvar LOCKS: The row locks L{select} can take, and the clause each is taken with.
     """
 
     LOG = False
     includeBlankInInsert = True
+    AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+    MAX_IN_PARAMS = 500
+    TEMP_TABLE_THRESHOLD = 5000
+    CONSTRAINT_MESSAGES = {
+        'unique': "is not unique.",
+        'notnull': "cannot be blank.",
+        'check': "is invalid."
+    }
+    LOCKS = {
+        'update': "FOR UPDATE",
+        'share': "FOR SHARE"
+    }
 
 
     def __init__(self):
         self.txn = None
+        self._savepoints = itertools.count(1)
 
 
     def log(self, query, args, kwargs):
         """
         Log the query and any args or kwargs using C{twisted.python.log.msg} if
         C{InteractionBase.LOG} is True.
+
+        @see: L{twistar.instrumentation.Instrumentation} for hooks that see every query
+        (along with its timing and call site) and for logging slow queries.
         """
         if not InteractionBase.LOG:
             return
         log.msg("TWISTAR query: %s" % query)
         if len(args) > 0:
-            if isinstance(args[0], list):  # if args contains a list object
-                log.msg("TWISTAR args: %s" % ",".join(*args))
-            else:
-                log.msg("TWISTAR args: %s" % ",".join(args))
+            params = args[0] if isinstance(args[0], (list, tuple)) else args
+            log.msg("TWISTAR args: %s" % ",".join([repr(param) for param in params]))
         elif len(kwargs) > 0:
-            log.msg("TWISTAR kargs: %s" % str(kwargs))
+            log.msg("TWISTAR kargs: %s" % repr(kwargs))
 
 
     def executeOperation(self, query, *args, **kwargs):
         """
-        Simply makes same C{twisted.enterprise.dbapi.ConnectionPool.runOperation} call, but
-        with call to L{log} function.
+        Does the same thing as C{twisted.enterprise.dbapi.ConnectionPool.runOperation}, but
+        runs the query through L{executeTxn}.  The keyword argument C{timeout} is passed
+        to L{runPooled}.
         """
-        self.log(query, args, kwargs)
-        return Registry.DBPOOL.runOperation(query, *args, **kwargs)
+        timeout = kwargs.pop('timeout', None)
+
+        def _executeOperation(txn):
+            self.executeTxn(txn, query, *args, **kwargs)
+        return self.runPooled(_executeOperation, timeout=timeout)
 
 
     def execute(self, query, *args, **kwargs):
         """
-        Simply makes same C{twisted.enterprise.dbapi.ConnectionPool.runQuery} call, but
-        with call to L{log} function.
+        Does the same thing as C{twisted.enterprise.dbapi.ConnectionPool.runQuery}, but
+        runs the query through L{executeTxn}.
         """
-        self.log(query, args, kwargs)
-        return Registry.DBPOOL.runQuery(query, *args, **kwargs)
+        def _execute(txn):
+            self.executeTxn(txn, query, *args, **kwargs)
+            return txn.fetchall()
+        return self.runPooled(_execute)
 
 
     def executeTxn(self, txn, query, *args, **kwargs):
         """
         Execute given query within the given transaction.  Also, makes call
-        to L{log} function.
+        to L{log} function, and reports the query to any
+        L{Instrumentation<twistar.instrumentation.Instrumentation>} hooks.  If
+        the connection pool keeps statistics (see L{twistar.pool.StatsConnectionPool})
+        the time taken by the query is recorded in it.
         """
         self.log(query, args, kwargs)
-        return txn.execute(query, *args, **kwargs)
-
-
-    def select(self, tablename, id=None, where=None, group=None, limit=None, orderby=None, select=None):
+        observed = Instrumentation.begin(query, args)
+        start = now()
+        try:
+            result = txn.execute(query, *args, **kwargs)
+        except Exception as e:
+            Instrumentation.finish(observed, now() - start, error=e)
+            raise
+        elapsed = now() - start
+        observeQuery = getattr(Registry.DBPOOL, 'observeQuery', None)
+        if observeQuery is not None:
+            observeQuery(query, elapsed)
+        Instrumentation.finish(observed, elapsed, txn.rowcount)
+        return result
+
+
+    def select(self, tablename, id=None, where=None, group=None, limit=None, orderby=None, select=None, txn=None,
+               joins=None, lock=None, skip_locked=False, timeout=None):
         """
         Select rows from a table.
 
@@ -95,28 +174,59 @@ class InteractionBase(object):
 
         @param select: Columns to select.  Default is C{*}.
 
+        @param txn: If txn is given it will be used for the query and the result is returned
+        directly, rather than through a C{Deferred}.
+
+        @param joins: A C{list} of join clauses, each in the same form as the C{where}
+        parameter in L{DBObject.find} (for instance, C{["INNER JOIN pictures ON pictures.user_id = users.id"]}).
+        Columns of C{tablename} should then be qualified with the table name.
+
+        @param lock: The kind of row lock to take on the selected rows until the end of the
+        transaction, one of the keys of L{LOCKS} (see L{lockToString}).
+
+        @param skip_locked: If True, rows locked by other transactions are skipped rather
+        than waited for.
+
+        @param timeout: The most seconds the statement may take (see L{runPooled}).  It is
+        ignored if C{txn} is given.
+
         @return: If C{limit} is 1 or id is set, then the result is one dictionary or None if not found.
         Otherwise, an array of dictionaries are returned.
         """
         one = False
         cacheTableStructure = select is None
-        select = select or "*"
 
         if id is not None:
-            if where is None:
-                where = ["id = ?", id]
-            else:
-                where = joinWheres(where, ["id = ?", id])
+            idwhere = ["%s.id = ?" % tablename if joins else "id = ?", id]
+            where = idwhere if where is None else joinWheres(where, idwhere)
             one = True
 
         if not isinstance(limit, tuple) and limit is not None and int(limit) == 1:
             one = True
 
-        q = "SELECT %s FROM %s" % (select, tablename)
+        q, args = self.selectToString(tablename, where, group, limit, orderby, select, joins, lock, skip_locked)
+        if txn is not None:
+            return self._doselect(txn, q, args, tablename, one, cacheTableStructure)
+        return self.runInteraction(self._doselect, q, args, tablename, one, cacheTableStructure, timeout=timeout)
+
+
+    def selectToString(self, tablename, where=None, group=None, limit=None, orderby=None, select=None, joins=None,
+                       lock=None, skip_locked=False):
+        """
+        Build a select query.  The parameters are the same as those of L{select}.
+
+        @return: A C{tuple} of the query string and a C{list} of its arguments.
+        """
+        q = "SELECT %s FROM %s" % (select or "*", tablename)
         args = []
+        for join in joins or []:
+            joinstr, joinargs = self.whereToString(join)
+            q += " " + joinstr
+            args += joinargs
         if where is not None:
-            wherestr, args = self.whereToString(where)
+            wherestr, whereargs = self.whereToString(where)
             q += " WHERE " + wherestr
+            args += whereargs
         if group is not None:
             q += " GROUP BY " + group
         if orderby is not None:
@@ -126,8 +236,55 @@ class InteractionBase(object):
             q += " LIMIT %s OFFSET %s" % (limit[0], limit[1])
         elif limit is not None:
             q += " LIMIT " + str(limit)
+        lockstr = self.lockToString(lock, skip_locked) if lock is not None else ""
+        if lockstr:
+            q += " " + lockstr
+        return (q, args)
+
+
+    def lockToString(self, lock, skip_locked=False):
+        """
+        Get the clause that locks the rows selected by a query.
 
-        return self.runInteraction(self._doselect, q, args, tablename, one, cacheTableStructure)
+        @param lock: One of the keys of L{LOCKS}.
+
+        @param skip_locked: If True, rows locked by other transactions are skipped.
+
+        @raise ValueError: If the lock isn't one of L{LOCKS}.
+        """
+        if lock not in self.LOCKS:
+            raise ValueError("Unknown lock %s, expected one of %s" % (lock, ", ".join(sorted(self.LOCKS))))
+        return self.LOCKS[lock] + (" SKIP LOCKED" if skip_locked else "")
+
+
+    def claim(self, tablename, values, where=None, limit=1, orderby="id", timeout=None):
+        """
+        Atomically claim up to C{limit} rows of a table matching a conditional, by updating
+        them with the given values, so that several consumers can take rows from a table
+        used as a work queue without getting the same ones.  The rows are selected with
+        C{FOR UPDATE SKIP LOCKED}, so rows claimed by concurrent transactions are skipped
+        rather than waited for.  C{where} should leave out rows that are already claimed,
+        for instance C{["claimed_by IS NULL"]}.
+
+        @param values: A C{dict} of the values to set, like C{{'claimed_by': 'worker-1'}}.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{DBObject.find}.
+
+        @param orderby: The order in which matching rows are claimed.
+
+        @param timeout: The most seconds the claim may take (see L{runPooled}).
+
+        @return: A C{Deferred} that fires with a C{list} of C{dict}s of the claimed rows,
+        as they are after the update (in no particular order).
+        """
+        def _claim(txn):
+            rows = self.select(tablename, where=where, limit=(limit, 0), orderby=orderby, select="id", txn=txn,
+                               lock='update', skip_locked=True)
+            ids = [row['id'] for row in rows]
+            for idwhere in self.whereIn('id', ids):
+                self.update(tablename, values, where=idwhere, txn=txn)
+            return self.selectIn(tablename, 'id', ids, txn=txn)
+        return self.runInteraction(_claim, timeout=timeout)
 
 
     def _doselect(self, txn, q, args, tablename, one=False, cacheable=True):
@@ -153,6 +310,173 @@ class InteractionBase(object):
         return results
 
 
+    def whereIn(self, column, values):
+        """
+        Get conditionals matching rows whose C{column} is one of the given values, with
+        each value as a bound parameter (so that the statement text only depends on the
+        number of values).  Long lists are split in chunks of L{MAX_IN_PARAMS} values.
+
+        @return: A C{list} of conditionals of the same form as the C{where} parameter in
+        L{DBObject.find}, one per chunk.  It's empty if there are no values.
+        """
+        values = list(values)
+        wheres = []
+        for index in range(0, len(values), self.MAX_IN_PARAMS):
+            chunk = values[index:index + self.MAX_IN_PARAMS]
+            wheres.append(["%s IN (%s)" % (column, ",".join(["?"] * len(chunk)))] + chunk)
+        return wheres
+
+
+    def selectIn(self, tablename, column, values, where=None, select=None, txn=None):
+        """
+        Select the rows of a table whose C{column} is one of the given values.  Up to
+        L{TEMP_TABLE_THRESHOLD} values are matched with one query per chunk given by
+        L{whereIn}; more integer values are inserted into a temporary table that is
+        then used in a subquery.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{DBObject.find}.
+
+        @param select: Columns to select.  Default is C{*}.
+
+        @param txn: If txn is given it will be used for the queries and the result is
+        returned directly, rather than through a C{Deferred}.
+
+        @return: A C{list} of C{dict}s, one per row.
+        """
+        values = list(values)
+
+        def _selectIn(txn):
+            threshold = self.TEMP_TABLE_THRESHOLD
+            if threshold is not None and len(values) > threshold and \
+                    all(isinstance(value, six.integer_types) for value in values):
+                return self._selectInTempTable(txn, tablename, column, values, where, select)
+            rows = []
+            for inwhere in self.whereIn(column, values):
+                if where is not None:
+                    inwhere = joinWheres(inwhere, where)
+                rows += self.select(tablename, where=inwhere, select=select, txn=txn)
+            return rows
+
+        if txn is not None:
+            return _selectIn(txn)
+        return self.runInteraction(_selectIn)
+
+
+    def _selectInTempTable(self, txn, tablename, column, values, where, select):
+        self.executeTxn(txn, "CREATE TEMPORARY TABLE twistar_in (twistar_value BIGINT)")
+        try:
+            rows = [{'twistar_value': value} for value in values]
+            for index in range(0, len(rows), self.MAX_IN_PARAMS):
+                self.insertMany('twistar_in', rows[index:index + self.MAX_IN_PARAMS], txn=txn)
+            inwhere = ["%s IN (SELECT twistar_value FROM twistar_in)" % column]
+            if where is not None:
+                inwhere = joinWheres(inwhere, where)
+            return self.select(tablename, where=inwhere, select=select, txn=txn)
+        finally:
+            self.executeTxn(txn, "DROP TABLE twistar_in")
+
+
+    def selectColumnar(self, tablename, columns=None, where=None, group=None, limit=None, orderby=None,
+                       batchsize=1000, asNumpy=False, timeout=None):
+        """
+        Select rows from a table, but return them column by column rather than row by row.
+        No C{dict} is created per row: each column is filled straight from batches of
+        C{fetchmany}, as an C{array} for integer and floating point columns or a C{list}
+        otherwise (see L{extendColumn<twistar.utils.extendColumn>}).  This takes much less
+        memory for large result sets that are only going to be aggregated.
+
+        @param columns: A C{list} of the names of the columns to select.  Default is all of them.
+
+        @param batchsize: The number of rows to fetch at a time.
+
+        @param asNumpy: If True, return NumPy arrays instead (NumPy must be installed).
+
+        @param timeout: The most seconds the query may take (see L{runPooled}).
+
+        The other parameters are the same as those of L{select}.
+
+        @return: A C{Deferred} that fires with a C{dict} whose keys are column names and
+        whose values are columns of equal length.
+        """
+        if asNumpy and numpy is None:
+            raise ImportError("NumPy is required for asNumpy=True")
+        select = None if columns is None else ",".join(self.escapeColNames(columns))
+        q, args = self.selectToString(tablename, where, group, limit, orderby, select)
+
+        def _selectColumnar(txn):
+            self.executeTxn(txn, q, args)
+            names = [row[0] for row in txn.description]
+            result = dict((name, None) for name in names)
+            while True:
+                rows = txn.fetchmany(batchsize)
+                if not rows:
+                    break
+                for name, values in zip(names, zip(*rows)):
+                    result[name] = extendColumn(result[name], values)
+            for name in names:
+                if result[name] is None:
+                    result[name] = []
+                if asNumpy:
+                    result[name] = numpy.array(result[name])
+            return result
+        return self.runInteraction(_selectColumnar, timeout=timeout)
+
+
+    def exists(self, tablename, where=None, timeout=None):
+        """
+        Find out whether at least one row in a table matches a conditional.
+
+        @param tablename: The table to look in.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{DBObject.find}.
+
+        @param timeout: The most seconds the query may take (see L{runPooled}).
+
+        @return: A C{Deferred} that fires with a boolean.
+        """
+        return self.existsEach(tablename, [where], timeout).addCallback(lambda results: results[0])
+
+
+    def existsEach(self, tablename, wheres, timeout=None):
+        """
+        Find out, in a single query, whether at least one row in a table matches each of
+        a number of conditionals.  No rows are fetched; each conditional becomes an
+        C{EXISTS} subquery that the database can stop evaluating at the first match.
+
+        @param tablename: The table to look in.
+
+        @param wheres: A C{list} of conditionals of the same form as the C{where} parameter
+        in L{DBObject.find} (C{None} matches any row).
+
+        @param timeout: The most seconds the query may take (see L{runPooled}).
+
+        @return: A C{Deferred} that fires with a C{list} of booleans, one per conditional.
+        """
+        parts = []
+        args = []
+        for where in wheres:
+            q = "SELECT 1 FROM %s" % tablename
+            if where is not None:
+                wherestr, whereargs = self.whereToString(where)
+                q += " WHERE " + wherestr
+                args += whereargs
+            parts.append(self.existsToString(q))
+        q = "SELECT " + ", ".join(parts)
+
+        def _existsEach(txn):
+            self.executeTxn(txn, q, args)
+            return [bool(value) for value in txn.fetchone()]
+        return self.runInteraction(_existsEach, timeout=timeout)
+
+
+    def existsToString(self, query):
+        """
+        Turn a subquery into an expression, selectable without a C{FROM} clause, that is
+        true if the subquery returns any rows (see L{existsEach}).
+        """
+        return "EXISTS (%s)" % query
+
+
     def insertArgsToString(self, vals):
         """
         Convert C{{'name': value}} to an insert "values" string like C{"(%s,%s,%s)"}.
@@ -160,7 +484,7 @@ class InteractionBase(object):
         return "(" + ",".join(["%s" for _ in vals.items()]) + ")"
 
 
-    def insert(self, tablename, vals, txn=None):
+    def insert(self, tablename, vals, txn=None, timeout=None):
         """
         Insert a row into the given table.
 
@@ -172,6 +496,9 @@ class InteractionBase(object):
         @param txn: If txn is given it will be used for the query,
         otherwise a typical runQuery will be used
 
+        @param timeout: The most seconds the statement may take (see L{runPooled}).  It is
+        ignored if C{txn} is given.
+
         @return: A C{Deferred} that calls a callback with the id of new row.
         """
         params = self.insertArgsToString(vals)
@@ -190,7 +517,7 @@ class InteractionBase(object):
         def _insert(txn, q, vals):
             self.executeTxn(txn, q, list(vals.values()))
             return self.getLastInsertID(txn)
-        return self.runInteraction(_insert, q, vals)
+        return self.runInteraction(_insert, q, vals, timeout=timeout)
 
 
     def escapeColNames(self, colnames):
@@ -204,7 +531,7 @@ class InteractionBase(object):
         return ["`%s`" % x for x in colnames]
 
 
-    def insertMany(self, tablename, vals):
+    def insertMany(self, tablename, vals, txn=None, timeout=None):
         """
         Insert many values into a table.
 
@@ -213,6 +540,12 @@ class InteractionBase(object):
         @param vals: Values to insert.  Should be a list of dictionaries in the form of
         C{{'name': value, 'othername': value}}.
 
+        @param txn: If txn is given it will be used for the query,
+        otherwise a typical runQuery will be used
+
+        @param timeout: The most seconds the statement may take (see L{runPooled}).  It is
+        ignored if C{txn} is given.
+
         @return: A C{Deferred}.
         """
         colnames = ",".join(self.escapeColNames(vals[0].keys()))
@@ -221,7 +554,9 @@ class InteractionBase(object):
         for val in vals:
             args = args + list(val.values())
         q = "INSERT INTO %s (%s) VALUES %s" % (tablename, colnames, params)
-        return self.executeOperation(q, args)
+        if txn is not None:
+            return self.executeTxn(txn, q, args)
+        return self.executeOperation(q, args, timeout=timeout)
 
 
     def getLastInsertID(self, txn):
@@ -233,13 +568,19 @@ class InteractionBase(object):
         return txn.lastrowid
 
 
-    def delete(self, tablename, where=None):
+    def delete(self, tablename, where=None, txn=None, timeout=None):
         """
         Delete from the given tablename.
 
         @param where: Conditional of the same form as the C{where} parameter in L{DBObject.find}.
         If given, the rows deleted will be restricted to ones matching this conditional.
 
+        @param txn: If txn is given it will be used for the query,
+        otherwise a typical runQuery will be used
+
+        @param timeout: The most seconds the statement may take (see L{runPooled}).  It is
+        ignored if C{txn} is given.
+
         @return: A C{Deferred}.
         """
         q = "DELETE FROM %s" % tablename
@@ -247,10 +588,12 @@ class InteractionBase(object):
         if where is not None:
             wherestr, args = self.whereToString(where)
             q += " WHERE " + wherestr
-        return self.executeOperation(q, args)
+        if txn is not None:
+            return self.executeTxn(txn, q, args)
+        return self.executeOperation(q, args, timeout=timeout)
 
 
-    def update(self, tablename, args, where=None, txn=None, limit=None):
+    def update(self, tablename, args, where=None, txn=None, limit=None, timeout=None):
         """
         Update a row into the given table.
 
@@ -267,6 +610,9 @@ class InteractionBase(object):
 
         @param limit: If limit is given it will limit the number of rows that are updated.
 
+        @param timeout: The most seconds the statement may take (see L{runPooled}).  It is
+        ignored if C{txn} is given.
+
         @return: A C{Deferred}
         """
         setstring, args = self.updateArgsToString(args)
@@ -278,6 +624,45 @@ class InteractionBase(object):
         if limit is not None:
             q += " LIMIT " + str(limit)
 
+        if txn is not None:
+            return self.executeTxn(txn, q, args)
+        return self.executeOperation(q, args, timeout=timeout)
+
+
+    def recount(self, tablename, column, othertable, foreignkey, where=None, txn=None, condition=None):
+        """
+        Set a column of a table to the number of rows in another table that reference
+        each row (see L{CounterCache<twistar.relationships.CounterCache>}).
+
+        @param tablename: The table with the counter column.
+
+        @param column: The name of the counter column.
+
+        @param othertable: The table whose rows are counted.
+
+        @param foreignkey: The column of C{othertable} referencing rows of C{tablename}.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{DBObject.find}
+        limiting the rows of C{tablename} that are recounted.
+
+        @param txn: If txn is given it will be used for the query, otherwise a typical
+        runQuery will be used.
+
+        @param condition: An optional conditional of the same form limiting the rows of
+        C{othertable} that are counted.
+
+        @return: A C{Deferred}
+        """
+        subquery = "SELECT COUNT(*) FROM %s WHERE %s.%s = %s.id" % (othertable, othertable, foreignkey, tablename)
+        args = []
+        if condition is not None:
+            conditionstr, args = self.whereToString(condition)
+            subquery += " AND (%s)" % conditionstr
+        q = "UPDATE %s SET %s = (%s)" % (tablename, self.escapeColNames([column])[0], subquery)
+        if where is not None:
+            wherestr, whereargs = self.whereToString(where)
+            q += " WHERE " + wherestr
+            args += whereargs
         if txn is not None:
             return self.executeTxn(txn, q, args)
         return self.executeOperation(q, args)
@@ -323,46 +708,313 @@ class InteractionBase(object):
 
 
     def runInteraction(self, interaction, *args, **kwargs):
+        """
+        Run an interaction, in the current transaction if there is one (see
+        L{transaction<twistar.utils.transaction>}) or else in a new one (see L{runPooled}).
+        The keyword argument C{timeout} is only used in the latter case.
+        """
         if self.txn is not None:
+            kwargs.pop('timeout', None)
             return defer.succeed(interaction(self.txn, *args, **kwargs))
-        return Registry.DBPOOL.runInteraction(interaction, *args, **kwargs)
+        return self.runPooled(interaction, *args, **kwargs)
+
+
+    def runPooled(self, interaction, *args, **kwargs):
+        """
+        Run an interaction in a new transaction from L{Registry.DBPOOL}, retrying it
+        according to L{Registry.RETRY_POLICY} (if set) when it fails with a transient error
+        (see L{isTransientError}).
+
+        If the keyword argument C{timeout} is given, each attempt may take at most that many
+        seconds: the database is told to abort statements running past the deadline (see
+        L{startTimeout}), and once it has passed the C{Deferred} fails with a
+        L{QueryTimeoutError} and the running statement is interrupted (see L{interrupt}).
+        The keyword argument C{retry} replaces L{Registry.RETRY_POLICY}.
+
+        The returned C{Deferred} can be cancelled, which interrupts the running statement
+        (or keeps the interaction from starting, if it is still waiting for a connection),
+        so that the transaction is rolled back and its connection is returned to the pool.
+        It fails with C{CancelledError} once that is done.
+
+        @return: A C{Deferred} that fires with the result of the interaction.
+        """
+        timeout = kwargs.pop('timeout', None)
+        policy = kwargs.pop('retry', None) or Registry.RETRY_POLICY
+        interaction = Instrumentation.attribute(interaction)
+
+        def run():
+            if timeout is None:
+                return self._runCancellable(interaction, args, kwargs)
+            return self._runTimed(interaction, timeout, args, kwargs)
+        if policy is None:
+            return run()
+        return policy.run(run, self.isTransientError)
+
+
+    def _runCancellable(self, interaction, args, kwargs, timeout=None):
+        """
+        Run an interaction in the pool, returning a C{Deferred} whose cancellation
+        interrupts it.  A cancelled C{Deferred} only fails once the interaction has
+        finished, so its connection is back in the pool (and
+        L{transaction<twistar.utils.transaction>} no longer holds L{txn}).
+        """
+        state = {'cancelled': False}
+        running = RunningInteraction()
+
+        def _interaction(txn, *args, **kwargs):
+            with running.lock:
+                if state['cancelled']:
+                    raise defer.CancelledError()
+                running.txn = txn
+            try:
+                if timeout is None:
+                    return interaction(txn, *args, **kwargs)
+                self.startTimeout(txn, timeout)
+                try:
+                    return interaction(txn, *args, **kwargs)
+                finally:
+                    # a failure here mustn't hide the interaction's own outcome
+                    try:
+                        self.endTimeout(txn)
+                    except Exception:
+                        log.err(None, "Could not reset the statement timeout")
+            finally:
+                with running.lock:
+                    running.txn = None
+
+        def _cancel(_):
+            with running.lock:
+                state['cancelled'] = True
+            self.interrupt(running)
+
+        result = defer.Deferred(_cancel)
+        finished = defer.Deferred()
+
+        def _fire(outcome):
+            # after a cancellation, the interaction's own outcome is dropped
+            if not result.called:
+                if isinstance(outcome, Failure):
+                    result.errback(outcome)
+                else:
+                    result.callback(outcome)
+            finished.callback(None)
+
+        def _wait(failure):
+            if state['cancelled']:
+                return finished.addCallback(lambda _: failure)
+            return failure
+        result.addErrback(_wait)
+        Registry.DBPOOL.runInteraction(_interaction, *args, **kwargs).addBoth(_fire)
+        return result
+
+
+    def _runTimed(self, interaction, timeout, args, kwargs):
+        """
+        Run an interaction in the pool with a deadline of C{timeout} seconds.
+        """
+        d = self._runCancellable(interaction, args, kwargs, timeout)
+        state = {'expired': False}
+
+        def _expire():
+            state['expired'] = True
+            d.cancel()
+        delayed = reactor.callLater(timeout, _expire)
+
+        def _finished(result):
+            if delayed.active():
+                delayed.cancel()
+            if isinstance(result, Failure):
+                error = originalError(result.value)
+                if state['expired'] or self.isTimeoutError(error):
+                    raise QueryTimeoutError("Interaction took longer than %s seconds" % timeout)
+            return result
+        return d.addBoth(_finished)
+
+
+    def startTimeout(self, txn, timeout):
+        """
+        Tell the database to abort statements of the given transaction that run for more
+        than C{timeout} seconds.  By default, nothing is done, and only the deadline kept by
+        L{runPooled} applies.
+        """
+
+
+    def endTimeout(self, txn):
+        """
+        Undo L{startTimeout}, before the connection of the transaction is returned to the pool.
+        """
+
+
+    def interrupt(self, running):
+        """
+        Abort the statement a L{RunningInteraction} is running, from another thread.  Only
+        interrupt it while holding its C{lock} and if its C{txn} isn't C{None}, since
+        otherwise the interaction may have finished and its connection be running another
+        one's statements.  By default this isn't possible, and the statement runs to
+        completion.
+        """
 
 
-    def insertObj(self, obj):
+    def isTimeoutError(self, error):
+        """
+        Find out whether an error raised by the database driver means a statement was
+        aborted because of L{startTimeout} or L{interrupt}.
+        """
+        return False
+
+
+    def isTransientError(self, error):
+        """
+        Find out whether an error raised by the database driver is transient: the
+        transaction it was raised in was rolled back and could succeed if run again, like
+        a deadlock or a serialization failure.  By default, no error is transient.
+
+        @see: L{RetryPolicy<twistar.retry.RetryPolicy>}
+        """
+        return False
+
+
+    def insertObj(self, obj, txn=None):
         """
         Insert the given object into its table.
 
-        @return: A C{Deferred} that sends a callback the inserted object.
+        @param txn: If txn is given it will be used for the query,
+        otherwise a typical runQuery will be used
+
+        @return: A C{Deferred} that sends a callback the inserted object (or the object
+        itself, if C{txn} is given).
         """
+        nested = txn is not None
+
         def _doinsert(txn):
             klass = obj.__class__
             tablename = klass.tablename()
             cols = self.getSchema(tablename, txn)
             if len(cols) == 0:
                 raise ImaginaryTableError("Table %s does not exist." % tablename)
+            if klass.LOCK_VERSION and getattr(obj, klass.LOCK_VERSION, None) is None:
+                setattr(obj, klass.LOCK_VERSION, 0)
             vals = obj.toHash(cols, includeBlank=self.__class__.includeBlankInInsert, exclude=['id'])
-            self.insert(tablename, vals, txn)
-            obj.id = self.getLastInsertID(txn)
+            if self.runConstrained(txn, obj, lambda: self.insert(tablename, vals, txn), nested):
+                obj.id = self.getLastInsertID(txn)
             return obj
 
-        return self.runInteraction(_doinsert)
+        if txn is not None:
+            return _doinsert(txn)
+        return self.runInteraction(_doinsert, timeout=obj.TIMEOUT)
 
 
-    def updateObj(self, obj):
+    def updateObj(self, obj, txn=None):
         """
-        Update the given object's row in the object's table.
+        Update the given object's row in the object's table.  If the object's class has a
+        C{LOCK_VERSION} column (see L{DBObject<twistar.dbobject.DBObject>}), the row is only
+        updated if that column still holds the version the object was loaded with, and the
+        version is incremented.
 
-        @return: A C{Deferred} that sends a callback the updated object.
+        @param txn: If txn is given it will be used for the query,
+        otherwise a typical runQuery will be used
+
+        @raise StaleObjectError: If the row's version has changed (the C{Deferred} fails with it).
+
+        @return: A C{Deferred} that sends a callback the updated object (or the object
+        itself, if C{txn} is given).
         """
+        nested = txn is not None
+
         def _doupdate(txn):
             klass = obj.__class__
             tablename = klass.tablename()
             cols = self.getSchema(tablename, txn)
 
-            vals = obj.toHash(cols, includeBlank=True, exclude=['id'])
-            return self.update(tablename, vals, where=['id = ?', obj.id], txn=txn)
+            # counter caches are kept up to date in the database, so don't overwrite them
+            vals = obj.toHash(cols, includeBlank=True, exclude=['id'] + klass.counterColumns())
+            where = ['id = ?', obj.id]
+            column = klass.LOCK_VERSION
+            if column:
+                version = getattr(obj, column, None)
+                vals[column] = (version or 0) + 1
+                if version is None:
+                    where = ['id = ? AND %s IS NULL' % column, obj.id]
+                else:
+                    where = ['id = ? AND %s = ?' % column, obj.id, version]
+
+            if not self.runConstrained(txn, obj, lambda: self.update(tablename, vals, where=where, txn=txn), nested):
+                return False
+            if column:
+                if txn.rowcount == 0:
+                    msg = "%s with id %s was changed or deleted since it was loaded" % (klass.__name__, obj.id)
+                    raise StaleObjectError(msg)
+                setattr(obj, column, vals[column])
+            return True
+        if txn is not None:
+            _doupdate(txn)
+            return obj
         # We don't want to return the cursor - so add a blank callback returning the obj
-        return self.runInteraction(_doupdate).addCallback(lambda _: obj)
+        return self.runInteraction(_doupdate, timeout=obj.TIMEOUT).addCallback(lambda _: obj)
+
+
+    def runConstrained(self, txn, obj, write, nested=False):
+        """
+        Call C{write()} to write the given object using the given transaction.  If the object's class
+        has its C{CONSTRAINT_ERRORS} set (see L{DBObject<twistar.dbobject.DBObject>}), then an
+        C{IntegrityError} raised by the database is turned into errors in C{obj.errors}
+        instead.  If the transaction goes on after the write (within a
+        L{transaction<twistar.utils.transaction>}, or if C{nested} is True), the write is
+        wrapped in a savepoint so that the rest of the transaction can continue.
+
+        @param nested: True if the caller runs more queries in C{txn} after the write.
+
+        @return: C{True} if the object was written, C{False} if a constraint was violated.
+        """
+        mapping = obj.__class__.CONSTRAINT_ERRORS
+        if not mapping:
+            write()
+            return True
+
+        savepoint = None
+        if nested or self.txn is not None:
+            savepoint = "twistar_constraints_%d" % next(self._savepoints)
+            self.startSavepoint(txn, savepoint)
+        try:
+            write()
+        except Registry.DBPOOL.dbapi.IntegrityError as e:
+            violations = self.parseIntegrityError(e)
+            if len(violations) == 0:
+                raise
+            if savepoint:
+                self.executeTxn(txn, "ROLLBACK TO SAVEPOINT %s" % savepoint)
+            mapping = mapping if isinstance(mapping, dict) else {}
+            for kind, constraint, columns in violations:
+                if constraint in mapping:
+                    columns = [mapping[constraint]]
+                elif len(columns) == 0:
+                    columns = [constraint]
+                for column in columns:
+                    obj.errors.add(column, self.CONSTRAINT_MESSAGES[kind])
+            return False
+        if savepoint:
+            self.executeTxn(txn, "RELEASE SAVEPOINT %s" % savepoint)
+        return True
+
+
+    def startSavepoint(self, txn, name):
+        """
+        Create a savepoint with the given name in the given transaction.
+        """
+        self.executeTxn(txn, "SAVEPOINT %s" % name)
+
+
+    def parseIntegrityError(self, error):
+        """
+        Figure out which constraints were violated from an C{IntegrityError} raised
+        by the database driver.  Database specific configs override this.
+
+        @return: A C{list} of C{(kind, constraint, columns)} tuples, where C{kind} is one of
+        C{'unique'}, C{'notnull'} or C{'check'}, C{constraint} is the name of the constraint
+        (or C{None} if unknown) and C{columns} is a C{list} of the affected columns (which
+        may be empty).  If the error isn't understood, the C{list} is empty.
+        """
+        return []
 
 
     def refreshObj(self, obj):
@@ -376,7 +1028,7 @@ class InteractionBase(object):
                 raise CannotRefreshError("Can't refresh object if id not longer exists.")
             for key in newobj.keys():
                 setattr(obj, key, newobj[key])
-        return self.select(obj.tablename(), obj.id).addCallback(_dorefreshObj)
+        return self.select(obj.tablename(), obj.id, timeout=obj.TIMEOUT).addCallback(_dorefreshObj)
 
 
     def whereToString(self, where):
@@ -410,7 +1062,54 @@ class InteractionBase(object):
         return (setstring, list(args.values()))
 
 
-    def count(self, tablename, where=None):
+    def aggregate(self, tablename, where=None, group=None, orderby=None, limit=None, timeout=None, **funcs):
+        """
+        Compute aggregates of columns in the database.  Each keyword argument names an
+        aggregate function (one of L{AGGREGATES}) and gives a column name (or a C{list}
+        of them) to apply it to.  The results are aliased as C{<function>_<column>}, except
+        for C{count='*'}, which is aliased as C{count}.  For instance,
+        C{aggregate('pictures', sum='size', max=['size', 'id'], count='*')} fires with
+        C{{'sum_size': 30, 'max_size': 20, 'max_id': 2, 'count': 2}}.
+
+        @param tablename: The tablename to aggregate rows of.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{DBObject.find}.
+
+        @param group: A C{str} of column names (or a C{list} of them) to group rows by.  The
+        columns are included in the results.
+
+        @param orderby: String describing how to order the results, if they are grouped.
+
+        @param limit: Integer limit on the number of groups.
+
+        @param timeout: The most seconds the query may take (see L{runPooled}).
+
+        @return: A C{Deferred} that fires with a C{dict} of results, or a C{list} of them (one
+        per group) if C{group} is given.
+        """
+        select = []
+        if group is not None:
+            group = group if isinstance(group, six.string_types) else ", ".join(group)
+            select.append(group)
+        for func in sorted(funcs.keys()):
+            if func not in self.AGGREGATES:
+                raise ValueError("Unknown aggregate function %s" % func)
+            columns = funcs[func]
+            for column in ([columns] if isinstance(columns, six.string_types) else columns):
+                if column == '*':
+                    select.append("%s(*) AS %s" % (func, self.escapeColNames([func])[0]))
+                else:
+                    alias = self.escapeColNames(["%s_%s" % (func, column)])[0]
+                    select.append("%s(%s) AS %s" % (func, self.escapeColNames([column])[0], alias))
+
+        q, args = self.selectToString(tablename, where, group, limit, orderby, ", ".join(select))
+        d = self.runInteraction(self._doselect, q, args, tablename, False, False, timeout=timeout)
+        if group is None:
+            d.addCallback(lambda rows: rows[0])
+        return d
+
+
+    def count(self, tablename, where=None, timeout=None):
         """
         Get the number of rows in the given table (optionally, that meet the given where criteria).
 
@@ -418,8 +1117,8 @@ class InteractionBase(object):
 
         @param where: Conditional of the same form as the C{where} parameter in L{DBObject.find}.
 
+        @param timeout: The most seconds the query may take (see L{runPooled}).
+
         @return: A C{Deferred} that returns the number of rows.
         """
-        d = self.select(tablename, where=where, select='count(*)')
-        d.addCallback(lambda res: res[0]['count(*)'])
-        return d
+        return self.aggregate(tablename, where=where, timeout=timeout, count='*').addCallback(lambda result: result['count'])
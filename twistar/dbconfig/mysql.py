@@ -1,33 +1,116 @@
 from __future__ import absolute_import
+import re
 import MySQLdb
 
 from twisted.enterprise import adbapi
+from twisted.internet import threads
 from twisted.python import log
 
+from twistar.registry import Registry
 from twistar.dbconfig.base import InteractionBase
+from twistar.pool import StatsConnectionPool
+
+
+# error codes and messages of constraint violations
+INTEGRITY_ERRORS = {
+    1062: ('unique', re.compile(r"for key '(?:[^']*\.)?([^'.]+)'")),
+    1048: ('notnull', re.compile(r"Column '([^']+)'")),
+    3819: ('check', re.compile(r"Check constraint '([^']+)'"))
+}
+
+
+# error codes of deadlocks and lock wait timeouts
+TRANSIENT_ERRORS = (1213, 1205)
+
+# error codes of lost connections
+CONNECTION_ERRORS = (2006, 2013)
+
+# error codes of statements aborted by max_execution_time or KILL QUERY
+TIMEOUT_ERRORS = (3024, 1317)
 
 
 class MySQLDBConfig(InteractionBase):
     includeBlankInInsert = False
 
+    def isTransientError(self, error):
+        return isinstance(error, MySQLdb.Error) and len(error.args) > 0 and error.args[0] in TRANSIENT_ERRORS
+
+
+    def startTimeout(self, txn, timeout):
+        """
+        Set C{max_execution_time} for the connection until L{endTimeout}.  MySQL only applies
+        it to C{SELECT} statements; others are limited by the deadline of
+        L{runPooled<InteractionBase.runPooled>}, which interrupts them with C{KILL QUERY}.
+        """
+        txn.execute("SET SESSION max_execution_time = %d" % max(int(timeout * 1000), 1))
+
+
+    def endTimeout(self, txn):
+        txn.execute("SET SESSION max_execution_time = DEFAULT")
+
+
+    def interrupt(self, running):
+        """
+        Run C{KILL QUERY} for the connection of the transaction, from a new connection.  The
+        kill is only sent if the interaction is still running by then, and the interaction
+        can't finish until it has been sent, so it can't hit another interaction's statement.
+        """
+        with running.lock:
+            txn = running.txn
+            if txn is None:
+                return
+            threadId = txn.connection.thread_id()
+        pool = Registry.DBPOOL
+
+        def _kill():
+            conn = pool.dbapi.connect(*pool.connargs, **pool.connkw)
+            try:
+                with running.lock:
+                    if running.txn is txn:
+                        conn.cursor().execute("KILL QUERY %d" % threadId)
+            finally:
+                conn.close()
+        threads.deferToThread(_kill).addErrback(log.err, "Could not interrupt MySQL connection %d" % threadId)
+
+
+    def isTimeoutError(self, error):
+        return isinstance(error, MySQLdb.Error) and len(error.args) > 0 and error.args[0] in TIMEOUT_ERRORS
+
+
+    def parseIntegrityError(self, error):
+        if len(error.args) < 2 or error.args[0] not in INTEGRITY_ERRORS:
+            return []
+        kind, regex = INTEGRITY_ERRORS[error.args[0]]
+        match = regex.search(error.args[1])
+        if match is None:
+            return []
+        if kind == 'notnull':
+            return [(kind, None, [match.group(1)])]
+        # unique keys are named after their first column by default
+        return [(kind, match.group(1), [])]
+
+
     def insertArgsToString(self, vals):
         if len(vals) > 0:
             return "(" + ",".join(["%s" for _ in vals.items()]) + ")"
         return "VALUES ()"
 
 
-class ReconnectingMySQLConnectionPool(adbapi.ConnectionPool):
+class ReconnectingMySQLConnectionPool(StatsConnectionPool):
     """
     This connection pool will reconnect if the server goes away.  This idea was taken from:
     http://www.gelens.org/2009/09/13/twisted-connectionpool-revisited/
+
+    Reconnections are counted in the pool's L{stats<StatsConnectionPool.stats>}.
     """
     def _runInteraction(self, interaction, *args, **kw):
         try:
             return adbapi.ConnectionPool._runInteraction(self, interaction, *args, **kw)
         except MySQLdb.OperationalError as e:
-            if e[0] not in (2006, 2013):
+            if len(e.args) == 0 or e.args[0] not in CONNECTION_ERRORS:
                 raise
             log.err("Lost connection to MySQL, retrying operation.  If no errors follow, retry was successful.")
             conn = self.connections.get(self.threadID())
             self.disconnect(conn)
+            self.recordReconnect()
             return adbapi.ConnectionPool._runInteraction(self, interaction, *args, **kw)
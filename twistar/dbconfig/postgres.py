@@ -1,9 +1,29 @@
 from __future__ import absolute_import
+import re
+
 from twistar.dbconfig.base import InteractionBase
 
 
+# SQLSTATE codes of constraint violations
+INTEGRITY_ERRORS = {
+    '23505': 'unique',
+    '23502': 'notnull',
+    '23514': 'check'
+}
+
+# SQLSTATE codes of deadlocks and serialization failures
+TRANSIENT_ERRORS = ('40P01', '40001')
+
+# SQLSTATE code of statements cancelled by statement_timeout or a cancel request
+QUERY_CANCELED = '57014'
+
+# the detail of a unique violation, like 'Key (name)=(value) already exists.'
+UNIQUE_DETAIL_RE = re.compile(r"Key \((.+?)\)=")
+
+
 class PostgreSQLDBConfig(InteractionBase):
     includeBlankInInsert = False
+    TEMP_TABLE_THRESHOLD = None
 
     def getLastInsertID(self, txn):
         q = "SELECT lastval()"
@@ -18,11 +38,67 @@ class PostgreSQLDBConfig(InteractionBase):
         return "DEFAULT VALUES"
 
 
-    def escapeColNames(self, colnames):
-        return ['"%s"' % x for x in colnames]
+    def parseIntegrityError(self, error):
+        kind = INTEGRITY_ERRORS.get(getattr(error, 'pgcode', None))
+        diag = getattr(error, 'diag', None)
+        if kind is None or diag is None:
+            return []
+        columns = []
+        if kind == 'notnull' and diag.column_name:
+            columns = [diag.column_name]
+        elif kind == 'unique':
+            match = UNIQUE_DETAIL_RE.search(diag.message_detail or "")
+            if match is not None:
+                columns = [name.strip().strip('"') for name in match.group(1).split(",")]
+        return [(kind, diag.constraint_name, columns)]
+
+
+    def isTransientError(self, error):
+        return getattr(error, 'pgcode', None) in TRANSIENT_ERRORS
+
 
+    def startTimeout(self, txn, timeout):
+        """
+        Set C{statement_timeout} for the rest of the transaction.  This isn't run through
+        L{executeTxn}, so it isn't counted as one of the interaction's statements.
+        """
+        txn.execute("SET LOCAL statement_timeout = %d" % max(int(timeout * 1000), 1))
 
-    def count(self, tablename, where=None):
-        d = self.select(tablename, where=where, select='count(*)')
-        d.addCallback(lambda res: res[0]['count'])
-        return d
+
+    def interrupt(self, running):
+        with running.lock:
+            if running.txn is not None:
+                running.txn.connection.cancel()
+
+
+    def isTimeoutError(self, error):
+        return getattr(error, 'pgcode', None) == QUERY_CANCELED
+
+
+    def whereIn(self, column, values):
+        """
+        Match any number of values with a single array parameter, so that the statement
+        text is always the same.
+        """
+        values = list(values)
+        if len(values) == 0:
+            return []
+        return [["%s = ANY(?)" % column, values]]
+
+
+    def claim(self, tablename, values, where=None, limit=1, orderby="id", timeout=None):
+        """
+        Claim rows with a single C{UPDATE ... RETURNING} statement.
+        """
+        def _claim(txn):
+            subquery, subargs = self.selectToString(tablename, where, None, limit, orderby, "id", lock='update',
+                                                    skip_locked=True)
+            setstring, args = self.updateArgsToString(values)
+            q = "UPDATE %s SET %s WHERE id IN (%s) RETURNING *" % (tablename, setstring, subquery)
+            self.executeTxn(txn, q, args + subargs)
+            return [self.valuesToHash(txn, row, tablename) for row in txn.fetchall()]
+        return self.runInteraction(_claim, timeout=timeout)
+
+
+    def escapeColNames(self, colnames):
+        return ['"%s"' % x for x in colnames]
@@ -19,3 +19,10 @@ class PyODBCDBConfig(InteractionBase):
 
     def insertArgsToString(self, vals):
         return "(" + ",".join(["?" for _ in vals.items()]) + ")"
+
+
+    def existsToString(self, query):
+        """
+        SQL Server can't select an C{EXISTS} predicate directly, so turn it into a value.
+        """
+        return "CASE WHEN EXISTS (%s) THEN 1 ELSE 0 END" % query
@@ -1,9 +1,28 @@
 from __future__ import absolute_import
-from twistar.registry import Registry
+import re
+import sqlite3
+from timeit import default_timer as now
+
 from twistar.dbconfig.base import InteractionBase
 
 
+# messages of sqlite3.IntegrityError, in current and older (before 3.8.2) versions of SQLite
+INTEGRITY_ERRORS = [
+    (re.compile(r"UNIQUE constraint failed: (.+)$"), 'unique'),
+    (re.compile(r"NOT NULL constraint failed: (.+)$"), 'notnull'),
+    (re.compile(r"CHECK constraint failed: (.+)$"), 'check'),
+    (re.compile(r"columns? (.+?) (?:is|are) not unique"), 'unique'),
+    (re.compile(r"(\S+) may not be NULL"), 'notnull')
+]
+
+
 class SQLiteDBConfig(InteractionBase):
+    """
+    @cvar PROGRESS_STEPS: The number of SQLite virtual machine instructions between checks
+    of the deadline of an interaction with a timeout.
+    """
+    PROGRESS_STEPS = 1000
+
     def whereToString(self, where):
         assert(isinstance(where, list))
         query = where[0]
@@ -21,9 +40,92 @@ class SQLiteDBConfig(InteractionBase):
         return "(" + ",".join(["?" for _ in vals.items()]) + ")"
 
 
+    def isTransientError(self, error):
+        """
+        A busy database (another connection holding the write lock for longer than the
+        timeout) is transient.
+        """
+        return isinstance(error, sqlite3.OperationalError) and "locked" in str(error)
+
+
+    def startTimeout(self, txn, timeout):
+        """
+        SQLite has no statement timeout, so a progress handler aborts the running statement
+        once the deadline has passed.
+        """
+        deadline = now() + timeout
+        txn.connection.set_progress_handler(lambda: now() > deadline, self.PROGRESS_STEPS)
+
+
+    def endTimeout(self, txn):
+        txn.connection.set_progress_handler(None, self.PROGRESS_STEPS)
+
+
+    def interrupt(self, running):
+        with running.lock:
+            if running.txn is not None:
+                running.txn.connection.interrupt()
+
+
+    def isTimeoutError(self, error):
+        return isinstance(error, sqlite3.OperationalError) and "interrupted" in str(error)
+
+
+    def startSavepoint(self, txn, name):
+        """
+        Outside of a transaction a SAVEPOINT starts one of its own, which releasing it
+        commits, so begin the transaction first.
+        """
+        if not getattr(txn.connection, 'in_transaction', True):
+            self.executeTxn(txn, "BEGIN")
+        InteractionBase.startSavepoint(self, txn, name)
+
+
+    def lockToString(self, lock, skip_locked=False):
+        """
+        SQLite has no row locks (writes lock the whole database), so no clause is added.
+        """
+        InteractionBase.lockToString(self, lock, skip_locked)
+        return ""
+
+
+    def claim(self, tablename, values, where=None, limit=1, orderby="id", timeout=None):
+        """
+        Without row locks, claim rows with a single C{UPDATE ... RETURNING} statement, which
+        can't be interleaved with other writes.  Versions of SQLite before 3.35 don't support
+        C{RETURNING}; they select the rows first, so concurrent claims in the same database
+        may then get the same rows.
+        """
+        if sqlite3.sqlite_version_info < (3, 35, 0):
+            return InteractionBase.claim(self, tablename, values, where, limit, orderby, timeout)
+
+        def _claim(txn):
+            subquery, subargs = self.selectToString(tablename, where, None, limit, orderby, "id")
+            setstring, args = self.updateArgsToString(values)
+            q = "UPDATE %s SET %s WHERE id IN (%s) RETURNING *" % (tablename, setstring, subquery)
+            self.executeTxn(txn, q, args + subargs)
+            return [self.valuesToHash(txn, row, tablename) for row in txn.fetchall()]
+        return self.runInteraction(_claim, timeout=timeout)
+
+
+    def parseIntegrityError(self, error):
+        message = str(error)
+        for regex, kind in INTEGRITY_ERRORS:
+            match = regex.search(message)
+            if match is None:
+                continue
+            if kind == 'check':
+                return [(kind, match.group(1), [])]
+            columns = [name.strip().split(".")[-1] for name in match.group(1).split(",")]
+            return [(kind, None, columns)]
+        return []
+
+
     # retarded sqlite can't handle multiple row inserts
-    def insertMany(self, tablename, vals):
+    def insertMany(self, tablename, vals, txn=None, timeout=None):
         def _insertMany(txn):
             for val in vals:
                 self.insert(tablename, val, txn)
-        return Registry.DBPOOL.runInteraction(_insertMany)
+        if txn is not None:
+            return _insertMany(txn)
+        return self.runPooled(_insertMany, timeout=timeout)
@@ -2,18 +2,47 @@
 Code relating to the base L{DBObject} object.
 """
 from __future__ import absolute_import
-from twisted.internet import defer
+import datetime
+
+from twisted.internet import defer, reactor, task
 
 from twistar.registry import Registry
-from twistar.relationships import Relationship
+from twistar.relationships import Relationship, RelationshipInfo, BelongsTo, HABTM, CounterCache
 from twistar.exceptions import InvalidRelationshipError, DBObjectSaveError, ReferenceNotSavedError
-from twistar.utils import createInstances, deferredDict, dictToWhere, transaction
+from twistar.utils import createInstances, deferredDict, dictToWhere, joinWheres, transaction
+from twistar.query import Query
 from twistar.validation import Validator, Errors
 
 from BermiInflector.Inflector import Inflector
 import six
 
 
+def _loadSlotted(klass):
+    """
+    Create an empty instance of the slotted subclass of C{klass} when unpickling (see
+    L{DBObject.slottedClass}).  If the schema of the class's table isn't known yet, an
+    instance of C{klass} itself is created.
+    """
+    slotted = klass.slottedClass()
+    obj = slotted.__new__(slotted)
+    obj._config = Registry.getConfig()
+    return obj
+
+
+def _reduceSlotted(obj):
+    """
+    The C{__reduce__} method of slotted classes.  They have the same name as the class
+    they're derived from, so they can't be pickled by reference; instances are recreated
+    through L{_loadSlotted} instead.  The config isn't pickled.
+    """
+    slots = {}
+    for klass in type(obj).__mro__:
+        for name in klass.__dict__.get('__slots__', ()):
+            if name != '_config' and hasattr(obj, name):
+                slots[name] = getattr(obj, name)
+    return (_loadSlotted, (type(obj).__bases__[0],), (getattr(obj, '__dict__', None) or None, slots))
+
+
 class DBObject(Validator):
     """
     A base class for representing objects stored in a RDBMS.
@@ -45,6 +74,46 @@ class DBObject(Validator):
     use the lowercase, plural version of this class's name.  See the L{DBObject.tablename}
     method.
 
+    @cvar CONSTRAINT_ERRORS: If True, rely on the database's unique, not null and check
+    constraints instead of (or in addition to) validators: when creating or updating an
+    object violates one of them, the object is not saved and errors are added to its
+    C{errors} property, just as the validators would have done, instead of an
+    C{IntegrityError} being raised.  This saves the query a validator like
+    L{validatesUniquenessOf<Validator.validatesUniquenessOf>} needs, and isn't subject
+    to races with other writers.  It may also be a C{dict} mapping the names of
+    constraints to the names of the properties errors should be added to, for constraints
+    whose columns can't be figured out from the database's error (like check constraints).
+    See L{InteractionBase.runConstrained<twistar.dbconfig.base.InteractionBase.runConstrained>}.
+
+    @cvar SLOTS: If True, objects of this class created from query results are instances of
+    a subclass (with the same name) that has a C{__slots__} entry for each column in the
+    table's schema, which takes much less memory per object and is faster to access.  If a
+    C{list} of column names, those columns are used rather than waiting for the schema to be
+    known.  Columns that clash with attributes of the class are left out.  See L{slottedClass}.
+
+    @cvar SOFT_DELETE: If given, the name of a timestamp column (like C{'deleted_at'}) that
+    marks rows as deleted.  L{delete}, L{deleteAll} and L{deleteWhere} set it rather than
+    removing rows, and L{find}, L{count}, L{exists}, L{aggregate}, L{findColumns},
+    L{Query<twistar.query.Query>}s and relationships leave out the rows where it is set.
+    Deleted rows can be brought back with L{restore}, or moved out of the table with
+    L{archive}.
+
+    @cvar ARCHIVE_TABLENAME: The table L{archive} moves deleted rows to.  Default is the
+    tablename followed by C{_archive}.
+
+    @cvar LOCK_VERSION: If given, the name of an integer column (like C{'lock_version'})
+    used for optimistic locking.  It is set to 0 when an object is created, and each update
+    only writes the row if the column still holds the object's version, incrementing it.
+    If another writer updated the row first, L{save} fails with a
+    L{StaleObjectError<twistar.exceptions.StaleObjectError>}, so concurrent writers can't
+    silently overwrite each other's changes without locking the row.  See
+    L{retryOnStale<twistar.utils.retryOnStale>} for retrying such conflicts.
+
+    @cvar TIMEOUT: If given, the most seconds the queries this class runs on its own (like
+    L{find}, L{count} or L{save}) may take before failing with a
+    L{QueryTimeoutError<twistar.exceptions.QueryTimeoutError>}.  It isn't applied inside a
+    L{transaction<twistar.utils.transaction>}, which has its own C{timeout}.
+
     @see: L{Relationship}, L{HasMany}, L{HasOne}, L{HABTM}, L{BelongsTo}
     """
 
@@ -52,10 +121,16 @@ class DBObject(Validator):
     HASONE = []
     HABTM = []
     BELONGSTO = []
+    CONSTRAINT_ERRORS = False
+    SLOTS = False
+    SOFT_DELETE = None
+    ARCHIVE_TABLENAME = None
+    LOCK_VERSION = None
+    TIMEOUT = None
 
     # this will just be a hash of relationships for faster property resolution
-    # the keys are the name and the values are classes representing the relationship
-    # it will be of the form {'othername': <BelongsTo instance>, 'anothername': <HasMany instance>}
+    # the keys are the name and the values are the metadata of the relationship
+    # it will be of the form {'othername': <RelationshipInfo>, 'anothername': <RelationshipInfo>}
     RELATIONSHIP_CACHE = None
 
     def __init__(self, **kwargs):
@@ -69,12 +144,28 @@ class DBObject(Validator):
         """
         self.id = None
         self._deleted = False
-        self.errors = Errors()
         self.updateAttrs(kwargs)
         self._config = Registry.getConfig()
 
-        if self.__class__.RELATIONSHIP_CACHE is None:
-            self.__class__.initRelationshipCache()
+        self.__class__.relationshipCache()
+
+
+    @property
+    def errors(self):
+        """
+        The L{Errors} found during validation of this object.  It is only created when
+        first used, so that objects that are never validated (like most of those
+        returned by queries) don't carry one around.
+        """
+        errors = getattr(self, '_errors', None)
+        if errors is None:
+            errors = self._errors = Errors()
+        return errors
+
+
+    @errors.setter
+    def errors(self, errors):
+        self._errors = errors
 
 
     def updateAttrs(self, kwargs):
@@ -102,13 +193,46 @@ class DBObject(Validator):
         if self._deleted:
             raise DBObjectSaveError("Cannot save a previously deleted object.")
 
-        def _save(isValid):
-            if self.id is None and isValid:
-                return self._create()
-            elif isValid:
-                return self._update()
-            return self
-        return self.isValid().addCallback(_save)
+        def _save(obj):
+            if not obj.errors.isEmpty():
+                return obj
+            elif obj.id is None:
+                return obj._create()
+            return obj._update()
+        return self.validate().addCallback(_save)
+
+
+    @classmethod
+    def saveMany(klass, objs):
+        """
+        Save a C{list} of objects of this class.  Validation of the whole C{list} is
+        performed first, in batch where the validators allow it (for instance, uniqueness
+        is checked with one query per property rather than per property per object, and
+        objects in the C{list} that share a value are caught as well).  Objects that fail
+        validation are not saved; the others are created or updated as in L{save}, one
+        after another.
+
+        Each object is written in its own transaction, so the batch isn't atomic: if
+        writing one fails, the objects before it stay saved and those after it aren't
+        written.  To save all or none of them, call this within a
+        L{transaction<twistar.utils.transaction>}.
+
+        @return: A C{Deferred} object.  If a callback is added to that deferred
+        the given C{list} will be returned.
+
+        @see: L{Validator._validateMany}
+        """
+        for obj in objs:
+            if obj._deleted:
+                raise DBObjectSaveError("Cannot save a previously deleted object.")
+
+        @defer.inlineCallbacks
+        def _save(objs):
+            for obj in objs:
+                if obj.errors.isEmpty():
+                    yield obj._create() if obj.id is None else obj._update()
+            defer.returnValue(objs)
+        return klass._validateMany(objs).addCallback(_save)
 
 
     def validate(self):
@@ -187,7 +311,16 @@ class DBObject(Validator):
         def _createOnSuccess(result):
             if result is False:
                 return defer.succeed(self)
-            return self._config.insertObj(self)
+            if len(CounterCache.counting(self.tablename())) == 0:
+                return self._config.insertObj(self)
+
+            # insert and recount in one transaction, so the counters can't drift
+            def _insertCounted(txn):
+                self._config.insertObj(self, txn)
+                if self.errors.isEmpty():
+                    self._updateCounters(txn)
+                return self
+            return self._config.runInteraction(_insertCounted, timeout=self.TIMEOUT)
 
         def _beforeSave(result):
             if result is False:
@@ -210,7 +343,21 @@ class DBObject(Validator):
         def _saveOnSuccess(result):
             if result is False:
                 return defer.succeed(self)
-            return self._config.updateObj(self)
+            counters = CounterCache.counting(self.tablename())
+            if len(counters) == 0:
+                return self._config.updateObj(self)
+
+            # the rows this object was counted in before the update need recounting too, so
+            # read them, update and recount in one transaction
+            select = ", ".join(sorted(set([counter.foreignkey for counter in counters])))
+
+            def _updateCounted(txn):
+                previous = self._config.select(self.tablename(), id=self.id, select=select, txn=txn)
+                self._config.updateObj(self, txn)
+                if self.errors.isEmpty():
+                    self._updateCounters(txn, previous)
+                return self
+            return self._config.runInteraction(_updateCounted, timeout=self.TIMEOUT)
 
         def _beforeSave(result):
             if result is False:
@@ -220,6 +367,28 @@ class DBObject(Validator):
         return defer.maybeDeferred(self.beforeUpdate).addCallback(_beforeSave)
 
 
+    def _updateCounters(self, txn=None, previous=None):
+        """
+        Recount the counter caches (see L{CounterCache}) that count this object.
+
+        @param txn: If given, the counters are recounted in this transaction.
+
+        @param previous: An optional C{dict} of the values this object's columns held
+        before it was changed.
+
+        @return: A C{Deferred} that fires with this object (or this object, if C{txn} is given).
+        """
+        counters = CounterCache.counting(self.tablename())
+        if len(counters) == 0:
+            return self if txn is not None else defer.succeed(self)
+        ids = dict((counter.foreignkey, [getattr(self, counter.foreignkey, None)]) for counter in counters)
+        previous = dict((key, [value]) for key, value in six.iteritems(previous or {}))
+        if txn is not None:
+            CounterCache.update(self.tablename(), ids, previous, txn)
+            return self
+        return CounterCache.update(self.tablename(), ids, previous).addCallback(lambda _: self)
+
+
     def refresh(self):
         """
         Update the properties for this object from the database.
@@ -258,30 +427,45 @@ class DBObject(Validator):
     def delete(self):
         """
         Delete this instance from the database.  Calls L{beforeDelete} before deleting from
-        the database.
+        the database.  Its L{HABTM} join rows and C{dependent} objects are removed in the
+        same transaction (see L{deleteWhere}).  If the class has a L{SOFT_DELETE} column,
+        it is set instead (on this instance too), and the instance keeps its C{id}.
 
         @return: A C{Deferred}.
         """
 
-        def _delete(result):
-            oldid = self.id
-            self.id = None
-            self._deleted = True
-            return self.__class__.deleteAll(where=["id = ?", oldid])
-
         def _deleteOnSuccess(result):
             if result is False:
                 return defer.succeed(self)
-            else:
-                ds = []
-                for relation in self.HABTM:
-                    name = relation['name'] if isinstance(relation, dict) else relation
-                    ds.append(getattr(self, name).clear())
-                return defer.DeferredList(ds).addCallback(_delete)
+            if self.SOFT_DELETE:
+                deletedAt = datetime.datetime.now()
+                setattr(self, self.SOFT_DELETE, deletedAt)
+                d = self.__class__._deleteEach([["id = ?", self.id]], True, deletedAt)
+                return d.addCallback(lambda _: self)
+            oldid = self.id
+            self.id = None
+            self._deleted = True
+            return self.__class__.deleteWhere(["id = ?", oldid]).addCallback(lambda _: self)
 
         return defer.maybeDeferred(self.beforeDelete).addCallback(_deleteOnSuccess)
 
 
+    def restore(self):
+        """
+        Undelete this instance, if its class has a L{SOFT_DELETE} column, by clearing it.
+
+        @return: A C{Deferred} that fires with this instance.
+        """
+        if not self.SOFT_DELETE:
+            raise ValueError("%s doesn't soft delete" % self.__class__.__name__)
+        setattr(self, self.SOFT_DELETE, None)
+
+        def _restore(txn):
+            self._config.update(self.tablename(), {self.SOFT_DELETE: None}, ["id = ?", self.id], txn=txn)
+            return self._updateCounters(txn)
+        return self._config.runInteraction(_restore, timeout=self.TIMEOUT)
+
+
     def loadRelations(self, *relations):
         """
         Preload a a list of relationships.  For instance, if you have an instance of an
@@ -310,6 +494,23 @@ class DBObject(Validator):
         return deferredDict(ds)
 
 
+    @classmethod
+    def loadBelongsTo(klass, objs, name):
+        """
+        Get the objects that each of the given instances of this class belongs to through
+        the L{BelongsTo} relationship C{name}, with one query per class rather than one per
+        instance.  For instance, C{Nickname.loadBelongsTo(nicknames, 'nicknameable')} loads
+        the owners of all the nicknames with one query for C{Boy}s and one for C{Girl}s.
+
+        @return: A C{Deferred} that fires with a C{list} of objects (or C{None}s), in the
+        same order as C{objs}.
+        """
+        info = klass.relationshipCache().get(name)
+        if info is None or info.relationshipKlass is not BelongsTo:
+            raise InvalidRelationshipError("%s has no belongs to relationship %s" % (klass.__name__, name))
+        return BelongsTo.getMany(objs, info)
+
+
     @classmethod
     def addRelation(klass, relation, rtype):
         """
@@ -336,13 +537,30 @@ class DBObject(Validator):
             name = relation
             args = {}
         relationshipKlass = Relationship.TYPES[rtype]
-        klass.RELATIONSHIP_CACHE[name] = (relationshipKlass, args)
+        klass.RELATIONSHIP_CACHE[name] = RelationshipInfo(klass, name, relationshipKlass, args)
+
+
+    @classmethod
+    def relationshipCache(klass):
+        """
+        Get the cache of relationship metadata of this class (not inherited from a parent
+        class), initializing it if needed.
+
+        @return: A C{dict} mapping relationship names to L{RelationshipInfo}s.
+        """
+        cache = klass.__dict__.get('RELATIONSHIP_CACHE')
+        if cache is None:
+            klass.initRelationshipCache()
+            cache = klass.RELATIONSHIP_CACHE
+        return cache
 
 
     @classmethod
     def initRelationshipCache(klass):
         """
-        Initialize the cache of relationship objects for this class.
+        Initialize the cache of relationship metadata (L{RelationshipInfo}s) for this class.
+        This happens when the class is registered (see L{Registry.register}) or, for classes
+        that aren't, when the first instance is created.
         """
         klass.RELATIONSHIP_CACHE = {}
         for rtype in Relationship.TYPES.keys():
@@ -350,6 +568,46 @@ class DBObject(Validator):
                 klass.addRelation(relation, rtype)
 
 
+    @classmethod
+    def slottedClass(klass):
+        """
+        Get the class used for objects created from query results (see the C{SLOTS}
+        class variable).  The slotted subclass is created once the columns of the class's
+        table are known and is then reused.  Instances of it can be pickled; they are
+        unpickled as instances of the slotted class of the current process.
+
+        @return: The slotted subclass of this class, or this class if C{SLOTS} isn't set or
+        the schema of the table isn't known yet.
+        """
+        if not klass.SLOTS:
+            return klass
+        slotted = klass.__dict__.get('SLOTTED_CLASS')
+        if slotted is not None:
+            return slotted
+
+        cols = klass.SLOTS
+        if not isinstance(cols, (list, tuple)):
+            cols = Registry.SCHEMAS.get(klass.tablename())
+            if cols is None:
+                return klass
+        cache = klass.relationshipCache()
+        slots = ['id', '_deleted', '_config', '_errors']
+        for col in cols:
+            if col not in slots and not hasattr(klass, col) and col not in cache:
+                slots.append(col)
+        attrs = {
+            '__slots__': tuple(slots),
+            '__module__': klass.__module__,
+            '__doc__': klass.__doc__,
+            '__reduce__': _reduceSlotted,
+            'RELATIONSHIP_CACHE': cache
+        }
+        slotted = type(klass.__name__, (klass,), attrs)
+        slotted.SLOTTED_CLASS = slotted
+        klass.SLOTTED_CLASS = slotted
+        return slotted
+
+
     @classmethod
     def tablename(klass):
         """
@@ -397,7 +655,8 @@ class DBObject(Validator):
 
 
     @classmethod
-    def find(klass, id=None, where=None, group=None, limit=None, orderby=None):
+    def find(klass, id=None, where=None, group=None, limit=None, orderby=None, joins=None, lock=None,
+             skip_locked=False):
         """
         Find instances of a given class.
 
@@ -417,6 +676,21 @@ class DBObject(Validator):
 
         @param orderby: A C{str} describing the ordering, like C{orderby='first_name DESC'}.
 
+        @param joins: A C{list} of relationship names whose objects are joined, so that
+        instances can be filtered by them in the same query.  The other class's table is
+        aliased as the relationship name, so for instance
+        C{User.find(joins=['pictures'], where=['pictures.name = ?', 'me'])} finds the users
+        with a picture named C{'me'}.  Each instance is only found once, even if several
+        objects of a L{HasMany} or L{HABTM} relationship match, and columns of this
+        class's table should be qualified with its table name (like C{users.age}).
+
+        @param lock: C{'update'} or C{'share'} to lock the rows found until the end of the
+        transaction, with C{SELECT ... FOR UPDATE} or C{FOR SHARE}.  This is meant to be
+        used within a L{transaction<twistar.utils.transaction>}.
+
+        @param skip_locked: If True (along with C{lock}), rows locked by other transactions
+        are skipped rather than waited for.  See also L{claim}.
+
         @return: A C{Deferred} which returns the following to a callback:
         If id is specified (or C{limit} is 1) then a single
         instance of C{klass} will be returned if one is found that fits the criteria, C{None}
@@ -424,8 +698,123 @@ class DBObject(Validator):
         be returned with all matching results.
         """
         config = Registry.getConfig()
-        d = config.select(klass.tablename(), id, where, group, limit, orderby)
-        return d.addCallback(createInstances, klass)
+        select = None
+        if joins:
+            joins, distinct = klass.joinClauses(joins)
+            select = "%s%s.*" % ("DISTINCT " if distinct else "", klass.tablename())
+        where = klass.liveWhere(where)
+        d = config.select(klass.tablename(), id, where, group, limit, orderby, select, joins=joins, lock=lock,
+                          skip_locked=skip_locked, timeout=klass.TIMEOUT)
+        return d.addCallback(lambda props: createInstances(props, klass.slottedClass()))
+
+
+    @classmethod
+    def claim(klass, where=None, limit=1, set=None, orderby="id"):
+        """
+        Atomically claim up to C{limit} instances of this class by updating their rows, for
+        tables used as work queues.  Concurrent consumers never claim the same rows, and
+        don't wait for each other: on PostgreSQL this is a single
+        C{UPDATE ... WHERE id IN (SELECT ... FOR UPDATE SKIP LOCKED) RETURNING *}, on MySQL 8
+        the rows are selected C{FOR UPDATE SKIP LOCKED} and then updated, and on SQLite a
+        single C{UPDATE ... RETURNING} is used.  For instance::
+
+            jobs = yield Job.claim(where=['worker IS NULL'], limit=10, set={'worker': name})
+
+        @param where: Conditional of the same form as the C{where} parameter in L{find}.  It
+        should leave out instances that are already claimed.
+
+        @param set: A C{dict} of the values to set on the claimed rows.
+
+        @param orderby: The order in which matching instances are claimed.
+
+        @return: A C{Deferred} that fires with a C{list} of the claimed instances, as they
+        are after the update.
+
+        @see: L{InteractionBase.claim<twistar.dbconfig.base.InteractionBase.claim>}
+        """
+        if not set:
+            raise ValueError("claim needs values to set on the claimed rows")
+        config = Registry.getConfig()
+        d = config.claim(klass.tablename(), set, klass.liveWhere(where), limit, orderby, klass.TIMEOUT)
+        return d.addCallback(lambda props: createInstances(props, klass.slottedClass()))
+
+
+    @classmethod
+    def joinClauses(klass, names):
+        """
+        Get the joins that add the objects of the given relationships to a select of
+        instances of this class (see the C{joins} parameter of L{find}).
+
+        @param names: A C{list} of relationship names.
+
+        @return: A C{tuple} of a C{list} of join clauses and a boolean that is C{True} if
+        any of the relationships is to many objects, so that rows may be repeated.
+        """
+        cache = klass.relationshipCache()
+        joins = []
+        distinct = False
+        for name in names:
+            if name not in cache:
+                raise InvalidRelationshipError("%s has no relationship %s" % (klass.__name__, name))
+            info = cache[name]
+            joins += info.relationshipKlass.joinsFor(klass, info)
+            distinct = distinct or info.relationshipKlass.TO_MANY
+        return (joins, distinct)
+
+
+    @classmethod
+    def where(klass, *wheres, **conditions):
+        """
+        Start a lazy query for instances of this class.  For instance,
+        C{User.where(age__gt=21).order('last_name').limit(50)} is a L{Query<twistar.query.Query>}
+        that is only run when it's awaited or its C{find} method is called.
+
+        @param wheres: Conditionals of the same form as the C{where} parameter in L{find}.
+
+        @param conditions: Keyword conditions, like C{age__gt=21} (see L{Query<twistar.query.Query>}).
+
+        @return: A L{Query<twistar.query.Query>}.
+        """
+        return Query(klass).where(*wheres, **conditions)
+
+
+    @classmethod
+    def liveWhere(klass, where=None):
+        """
+        Add the condition leaving out rows marked as deleted to a conditional, if this class
+        has a L{SOFT_DELETE} column.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{find}.
+
+        @return: A conditional of the same form, or C{None}.
+        """
+        if not klass.SOFT_DELETE:
+            return where
+        live = ["%s.%s IS NULL" % (klass.tablename(), klass.SOFT_DELETE)]
+        return joinWheres(where, live) if where else live
+
+
+    @classmethod
+    def findColumns(klass, columns=None, where=None, group=None, limit=None, orderby=None, asNumpy=False):
+        """
+        Find the values of the given columns for rows of this class's table without creating
+        any objects.  This is meant for analytics on large numbers of rows: for instance,
+        C{User.findColumns(['age'], where=['age > ?', 18])} fires with C{{'age': array('q', [...])}}.
+
+        @param columns: A C{list} of column names.  Default is all of them.
+
+        @param asNumpy: If True, the columns are NumPy arrays (NumPy must be installed).
+
+        The other parameters are the same as those of L{find}.
+
+        @return: A C{Deferred} that fires with a C{dict} mapping column names to columns.
+
+        @see: L{InteractionBase.selectColumnar<twistar.dbconfig.base.InteractionBase.selectColumnar>}
+        """
+        config = Registry.getConfig()
+        where = klass.liveWhere(where)
+        return config.selectColumnar(klass.tablename(), columns, where, group, limit, orderby, asNumpy=asNumpy,
+                                     timeout=klass.TIMEOUT)
 
 
     @classmethod
@@ -441,7 +830,58 @@ class DBObject(Validator):
         @return: A C{Deferred} which returns the total number of db records to a callback.
         """
         config = Registry.getConfig()
-        return config.count(klass.tablename(), where=where)
+        return config.count(klass.tablename(), where=klass.liveWhere(where), timeout=klass.TIMEOUT)
+
+
+    @classmethod
+    def counterColumns(klass):
+        """
+        Get the names of the counter cache columns of this class's relationships (see
+        L{CounterCache}).  They are not written when an object is updated, since they
+        are kept up to date in the database.
+        """
+        return [counter.column for counter in CounterCache.definedBy(klass)]
+
+
+    @classmethod
+    def recountCounters(klass, *names):
+        """
+        Recount the counter caches (see L{CounterCache}) of all objects of this class,
+        for instance to repair counters that have drifted after L{deleteAll} was used
+        on the counted objects.
+
+        @param names: The names of the relationships whose counters should be recounted.
+        Default is all of them.
+
+        @return: A C{Deferred}.
+        """
+        counters = [c for c in CounterCache.definedBy(klass) if len(names) == 0 or c.name in names]
+        ds = [counter.recount() for counter in counters]
+        return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+
+
+    @classmethod
+    def aggregate(klass, where=None, group=None, orderby=None, limit=None, **funcs):
+        """
+        Compute aggregates over instances of this class in the database, rather than
+        loading them.  For instance, C{Picture.aggregate(sum='size', avg='size', group='user_id')}
+        fires with a C{list} of C{dict}s like C{{'user_id': 1, 'sum_size': 30, 'avg_size': 15}}.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{find}.
+
+        @param group: A C{str} of column names (or a C{list} of them) to group by.
+
+        @param funcs: Aggregate functions (C{count}, C{sum}, C{avg}, C{min} or C{max}) and the
+        column name (or C{list} of column names) to apply each to.
+
+        @return: A C{Deferred} that fires with a C{dict} of results, or a C{list} of them
+        (one per group) if C{group} is given.
+
+        @see: L{InteractionBase.aggregate<twistar.dbconfig.base.InteractionBase.aggregate>}
+        """
+        config = Registry.getConfig()
+        return config.aggregate(klass.tablename(), klass.liveWhere(where), group, orderby, limit, klass.TIMEOUT,
+                                **funcs)
 
 
     @classmethod
@@ -461,7 +901,8 @@ class DBObject(Validator):
         """
         Delete all instances of C{klass} in the database without instantiating the records
         first or invoking callbacks (L{beforeDelete} is not called). This will run a single
-        SQL DELETE statement in the database.
+        SQL DELETE statement in the database (or, if the class has a L{SOFT_DELETE} column,
+        a single UPDATE setting it).
 
         @param where: Conditionally delete instances.  This parameter is of the same form
         found in L{find}.
@@ -470,7 +911,294 @@ class DBObject(Validator):
         """
         config = Registry.getConfig()
         tablename = klass.tablename()
-        return config.delete(tablename, where)
+        if klass.SOFT_DELETE:
+            return config.update(tablename, {klass.SOFT_DELETE: datetime.datetime.now()}, klass.liveWhere(where),
+                                 timeout=klass.TIMEOUT)
+        return config.delete(tablename, where, timeout=klass.TIMEOUT)
+
+
+    @classmethod
+    def deleteWhere(klass, where=None, cascade=True, callbacks=False, batchsize=1000):
+        """
+        Delete the instances of this class matching a conditional with set-based statements
+        run in a single transaction, rather than one statement per object.  With C{cascade},
+        the L{HABTM} join rows of the deleted rows are deleted, and so are the objects of
+        L{HasMany} and L{HasOne} relationships with C{dependent='delete'} (recursively), while
+        those with C{dependent='nullify'} have their foreign keys set to C{NULL}.  For instance,
+        if C{User} has C{HASMANY = [{'name': 'pictures', 'dependent': 'delete'}]}, then
+        C{User.deleteWhere(['age < ?', 18])} runs::
+
+            DELETE FROM pictures WHERE user_id IN (SELECT id FROM users WHERE age < ?)
+            DELETE FROM users WHERE age < ?
+
+        Counter caches (see L{CounterCache}) counting the deleted or nullified rows are
+        recounted.  A relationship leading back to a class already being deleted isn't
+        followed again, except one of a class to its own table (replies of a comment, for
+        instance): the ids of the matching rows and of all the rows depending on them are
+        then selected first, and the rows are deleted by id.  Rows of classes with a L{SOFT_DELETE} column are only marked as
+        deleted, and nothing is cascaded from them, since they are still there.
+
+        @param where: Conditional of the same form as the C{where} parameter in L{find}.
+
+        @param cascade: Whether to delete or nullify dependent rows.
+
+        @param callbacks: If C{True}, the matching instances are first loaded in batches of
+        C{batchsize} and L{beforeDelete} is called on each; those for which it returns
+        C{False} aren't deleted.
+
+        @return: A C{Deferred} that fires with the number of rows of this class's table deleted.
+        """
+        if callbacks:
+            return klass._deleteWithCallbacks(where, cascade, batchsize)
+        return klass._deleteEach([where], cascade)
+
+
+    @classmethod
+    @defer.inlineCallbacks
+    def _deleteWithCallbacks(klass, where, cascade, batchsize):
+        ids = []
+        for batch in Query(klass).where(where).batches(batchsize):
+            objs = yield batch
+            ds = [defer.maybeDeferred(obj.beforeDelete) for obj in objs]
+            results = yield defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+            ids += [obj.id for obj, (_, result) in zip(objs, results) if result is not False]
+        if len(ids) == 0:
+            defer.returnValue(0)
+        deleted = yield klass._deleteEach(Registry.getConfig().whereIn('id', ids), cascade)
+        defer.returnValue(deleted)
+
+
+    @classmethod
+    def _deleteEach(klass, wheres, cascade, deletedAt=None):
+        """
+        Delete the rows matching each of the given conditionals in one transaction.
+
+        @param deletedAt: The time rows of classes with a L{SOFT_DELETE} column are marked
+        as deleted at.  Default is now.
+        """
+        config = Registry.getConfig()
+        deletedAt = deletedAt or datetime.datetime.now()
+
+        def _delete(txn):
+            recounts = []
+            deleted = 0
+            for where in wheres:
+                deleted += klass._deleteRows(txn, config, where, cascade, recounts, [klass], deletedAt)
+            for counter, ids in recounts:
+                for idwhere in config.whereIn('id', sorted(set(ids))):
+                    config.recount(counter.klass.tablename(), counter.column, counter.tablename, counter.foreignkey,
+                                   idwhere, txn=txn, condition=counter.condition)
+            return deleted
+        return config.runInteraction(_delete, timeout=klass.TIMEOUT)
+
+
+    @classmethod
+    def _deleteRows(klass, txn, config, where, cascade, recounts, path, deletedAt):
+        """
+        Delete (and cascade to) the rows of this class's table matching a conditional.
+
+        @param recounts: A C{list} to add C{(counter, ids)} pairs to, for the counter caches
+        that need recounting afterwards.
+
+        @param path: The classes being deleted, which aren't cascaded to again.
+
+        @param deletedAt: The time to mark rows as deleted at, if this class has a
+        L{SOFT_DELETE} column.
+
+        @return: The number of rows deleted.
+        """
+        tablename = klass.tablename()
+        if klass.SOFT_DELETE:
+            where = klass.liveWhere(where)
+            klass._captureCounted(txn, config, tablename, where, recounts)
+            config.update(tablename, {klass.SOFT_DELETE: deletedAt}, where, txn=txn)
+            return txn.rowcount
+
+        if not cascade:
+            klass._captureCounted(txn, config, tablename, where, recounts)
+            config.delete(tablename, where, txn=txn)
+            return txn.rowcount
+
+        relationships = [info for _, info in sorted(klass.relationshipCache().items())]
+        if any(klass._referencesItself(info) for info in relationships):
+            return klass._deleteTree(txn, config, where, relationships, recounts, path, deletedAt)
+
+        ids = "SELECT id FROM %s" % tablename
+        args = []
+        if where:
+            ids += " WHERE %s" % where[0]
+            args = list(where[1:])
+        klass._cascade(txn, config, lambda column: [["%s IN (%s)" % (column, ids)] + args],
+                       relationships, recounts, path, deletedAt)
+        klass._captureCounted(txn, config, tablename, where, recounts)
+        config.delete(tablename, where, txn=txn)
+        return txn.rowcount
+
+
+    @classmethod
+    def _referencesItself(klass, info):
+        """
+        Find out whether a relationship with a C{dependent} option refers to rows of this
+        class's own table (replies of a comment, for instance).
+        """
+        if info.relationshipKlass is HABTM or info.dependent is None:
+            return False
+        return info.otherklass.tablename() == klass.tablename()
+
+
+    @classmethod
+    def _deleteTree(klass, txn, config, where, relationships, recounts, path, deletedAt):
+        """
+        Delete the rows matching a conditional when this class's table is referenced by its
+        own rows.  The ids of the rows are selected first (a statement can't select from the
+        table it changes on some databases), followed by those of the rows depending on them
+        through relationships with C{dependent='delete'}, level by level until none are left.
+        The deepest level is deleted first.
+
+        @return: The number of rows deleted.
+        """
+        tablename = klass.tablename()
+        trees = [info for info in relationships if klass._referencesItself(info) and info.dependent == 'delete']
+        rows = config.select(tablename, where=where or None, select="id", txn=txn)
+        levels = [[row['id'] for row in rows]]
+        seen = set(levels[0])
+        while len(levels[-1]) > 0 and len(trees) > 0:
+            level = []
+            for info in trees:
+                for otherwhere in klass._dependentWheres(info, lambda column: config.whereIn(column, levels[-1])):
+                    for row in config.select(tablename, where=otherwhere, select="id", txn=txn):
+                        if row['id'] not in seen:
+                            seen.add(row['id'])
+                            level.append(row['id'])
+            levels.append(level)
+
+        ids = sorted(seen)
+        others = [info for info in relationships if not any(info is tree for tree in trees)]
+        klass._cascade(txn, config, lambda column: config.whereIn(column, ids), others, recounts, path, deletedAt)
+        deleted = 0
+        for level in reversed(levels):
+            for idwhere in config.whereIn('id', level):
+                klass._captureCounted(txn, config, tablename, idwhere, recounts)
+                config.delete(tablename, idwhere, txn=txn)
+                deleted += txn.rowcount
+        return deleted
+
+
+    @classmethod
+    def _cascade(klass, txn, config, referencing, relationships, recounts, path, deletedAt):
+        """
+        Delete the join rows of the rows of this class's table being deleted, and delete or
+        nullify the rows depending on them.
+
+        @param referencing: A function that, given a column of another table, returns a
+        C{list} of conditionals matching the rows referencing the rows being deleted.
+        """
+        for info in relationships:
+            if info.relationshipKlass is HABTM:
+                for joinwhere in referencing(info.thisname):
+                    klass._captureCounted(txn, config, info.jointable, joinwhere, recounts)
+                    config.delete(info.jointable, joinwhere, txn=txn)
+                continue
+            if info.dependent is None:
+                continue
+
+            other = info.otherklass
+            for otherwhere in klass._dependentWheres(info, referencing):
+                if info.dependent == 'nullify':
+                    columns = [info.thisname]
+                    if 'as' in info.args:
+                        columns = ["%s_id" % info.args['as'], "%s_type" % info.args['as']]
+                    klass._captureCounted(txn, config, other.tablename(), otherwhere, recounts)
+                    config.update(other.tablename(), dict((column, None) for column in columns), otherwhere, txn=txn)
+                elif other not in path:
+                    other._deleteRows(txn, config, otherwhere, True, recounts, path + [other], deletedAt)
+
+
+    @classmethod
+    def _dependentWheres(klass, info, referencing):
+        """
+        Get the conditionals matching the rows of the other class of a relationship that
+        depend on the rows of this class's table being deleted.
+
+        @param referencing: A function as in L{_cascade}.
+        """
+        if 'as' in info.args:
+            poly = info.args['as']
+            return [joinWheres(where, ["%s_type = ?" % poly, klass.__name__]) for where in referencing("%s_id" % poly)]
+        return referencing(info.thisname)
+
+
+    @classmethod
+    def _captureCounted(klass, txn, config, tablename, where, recounts):
+        """
+        Note the rows referenced by the rows of a table matching a conditional, for the
+        counter caches counting that table, before the rows are deleted or changed.
+        """
+        for counter in CounterCache.counting(tablename):
+            select = "DISTINCT %s" % counter.foreignkey
+            rows = config.select(tablename, where=where or None, select=select, txn=txn)
+            ids = [row[counter.foreignkey] for row in rows if row[counter.foreignkey] is not None]
+            if len(ids) > 0:
+                recounts.append((counter, ids))
+
+
+    @classmethod
+    @defer.inlineCallbacks
+    def archive(klass, older_than, batchsize=1000, pause=0):
+        """
+        Move rows marked as deleted (see L{SOFT_DELETE}) before a given time out of this
+        class's table and into its archive table (see L{ARCHIVE_TABLENAME}), which must have
+        the same columns.  Rows are moved in batches of at most C{batchsize}, each in its own
+        transaction, so that a large backlog doesn't hold locks on the table for long; this
+        makes it suitable for running periodically, for instance with a
+        C{twisted.internet.task.LoopingCall}.  Since live rows are those where the column
+        is C{NULL}, a partial index like
+        C{CREATE INDEX ... ON comments (user_id) WHERE deleted_at IS NULL} keeps queries for
+        them fast while deleted rows wait to be archived.
+
+        @param older_than: A C{datetime.datetime}, or a C{datetime.timedelta} before now.
+
+        @param pause: The number of seconds to wait between batches.
+
+        @return: A C{Deferred} that fires with the number of rows moved.
+        """
+        if not klass.SOFT_DELETE:
+            raise ValueError("%s doesn't soft delete" % klass.__name__)
+        if isinstance(older_than, datetime.timedelta):
+            older_than = datetime.datetime.now() - older_than
+        config = Registry.getConfig()
+        column = klass.SOFT_DELETE
+        where = ["%s IS NOT NULL AND %s < ?" % (column, column), older_than]
+        moved = 0
+        while True:
+            count = yield config.runInteraction(klass._archiveBatch, config, where, batchsize, timeout=klass.TIMEOUT)
+            moved += count
+            if count < batchsize:
+                break
+            if pause:
+                yield task.deferLater(reactor, pause, lambda: None)
+        defer.returnValue(moved)
+
+
+    @classmethod
+    def _archiveBatch(klass, txn, config, where, batchsize):
+        """
+        Move up to C{batchsize} rows matching a conditional to the archive table.
+
+        @return: The number of rows moved.
+        """
+        tablename = klass.tablename()
+        archivename = klass.ARCHIVE_TABLENAME or "%s_archive" % tablename
+        # a tuple limit, so that a batchsize of 1 still selects a list
+        rows = config.select(tablename, where=where, orderby="id", limit=(batchsize, 0), select="id", txn=txn)
+        ids = [row['id'] for row in rows]
+        cols = ",".join(config.escapeColNames(config.getSchema(tablename, txn)))
+        for idwhere in config.whereIn('id', ids):
+            wherestr, args = config.whereToString(idwhere)
+            q = "INSERT INTO %s (%s) SELECT %s FROM %s WHERE %s" % (archivename, cols, cols, tablename, wherestr)
+            config.executeTxn(txn, q, args)
+            config.delete(tablename, idwhere, txn=txn)
+        return len(ids)
 
 
     @classmethod
@@ -485,9 +1213,8 @@ class DBObject(Validator):
         @return: A C{Deferred} which returns the following to a callback:
         A boolean as to whether or not at least one object was found.
         """
-        def _exists(result):
-            return result is not None
-        return klass.find(where=where, limit=1).addCallback(_exists)
+        config = Registry.getConfig()
+        return config.exists(klass.tablename(), klass.liveWhere(where), klass.TIMEOUT)
 
 
     def __str__(self):
@@ -515,8 +1242,8 @@ class DBObject(Validator):
         if klass.RELATIONSHIP_CACHE is not None and name in klass.RELATIONSHIP_CACHE:
             if object.__getattribute__(self, 'id') is None:
                 raise ReferenceNotSavedError("Cannot get/set relationship on unsaved object")
-            relationshipKlass, args = klass.RELATIONSHIP_CACHE[name]
-            return relationshipKlass(self, name, args)
+            info = klass.RELATIONSHIP_CACHE[name]
+            return info.relationshipKlass(self, info)
         return object.__getattribute__(self, name)
 
 
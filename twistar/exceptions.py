@@ -6,6 +6,17 @@ All C{Exception} classes.
 class TransactionError(Exception):
     """
     Error while running a transaction.
+
+    @ivar original: The exception raised within the transaction, if any.
+    """
+    def __init__(self, message, original=None):
+        Exception.__init__(self, message)
+        self.original = original
+
+
+class QueryTimeoutError(Exception):
+    """
+    Error resulting from an interaction that took longer than its timeout.
     """
 
 
@@ -46,3 +57,25 @@ class DBObjectSaveError(Exception):
     """
     Error saving a DBObject.
     """
+
+
+class StaleObjectError(DBObjectSaveError):
+    """
+    Error resulting from the attempted update of an object whose row was changed by
+    someone else since it was loaded (see the C{LOCK_VERSION} option of
+    L{DBObject<twistar.dbobject.DBObject>}).
+    """
+
+
+class NPlusOneError(Exception):
+    """
+    Error resulting from the same query being repeated more times than allowed
+    while an L{NPlusOneDetector<twistar.instrumentation.NPlusOneDetector>} is watching.
+    """
+
+
+class NPlusOneWarning(UserWarning):
+    """
+    Warning issued when the same query is repeated more times than allowed
+    while an L{NPlusOneDetector<twistar.instrumentation.NPlusOneDetector>} is watching.
+    """
@@ -0,0 +1,452 @@
+"""
+Module providing hooks for observing the queries twistar executes.
+"""
+
+from __future__ import absolute_import
+import os
+import re
+import sys
+import random
+import warnings
+import sysconfig
+import threading
+
+import twisted
+from twisted.internet import defer
+from twisted.python import log
+
+from twistar.utils import queryTarget
+from twistar.exceptions import NPlusOneError, NPlusOneWarning
+
+
+TWISTAR_DIR = os.path.dirname(os.path.abspath(__file__))
+TWISTAR_TESTS_DIR = os.path.join(TWISTAR_DIR, 'tests')
+IGNORED_DIRS = (os.path.dirname(os.path.abspath(twisted.__file__)),
+                os.path.abspath(sysconfig.get_paths()['stdlib']))
+
+# call site of the interaction currently running in each thread
+_local = threading.local()
+
+# patterns (and their replacements) used to reduce a statement to its shape
+SHAPE_PATTERNS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " ")
+]
+
+
+class CallSite(object):
+    """
+    Where a query came from.
+
+    @ivar method: The outermost twistar method that triggered the query, such as
+    C{'User.find'} or C{'User.avatar.get'} (for relationships), or C{None}.
+
+    @ivar caller: The C{'filename:line'} of the first frame outside of twistar (and
+    Twisted) that led to the query, or C{None}.
+    """
+
+    def __init__(self, method, caller):
+        self.method = method
+        self.caller = caller
+
+
+    def __str__(self):
+        return "%s (%s)" % (self.method or "?", self.caller or "?")
+
+
+    __repr__ = __str__
+
+
+def _methodLabel(frame):
+    """
+    Get a label like C{User.find} for a frame running twistar code, if there is
+    a L{DBObject}, class or L{Relationship} to name it by.
+    """
+    name = frame.f_code.co_name
+    local = frame.f_locals
+    inst = local.get('self')
+    if hasattr(inst, 'propname') and hasattr(inst, 'inst'):
+        return "%s.%s.%s" % (inst.inst.__class__.__name__, inst.propname, name)
+    klass = local.get('klass')
+    if isinstance(klass, type) and hasattr(klass, 'tablename'):
+        return "%s.%s" % (klass.__name__, name)
+    for key in ('self', 'obj'):
+        value = local.get(key)
+        if value is not None and hasattr(value, 'tablename') and not isinstance(value, type):
+            return "%s.%s" % (value.__class__.__name__, name)
+    return None
+
+
+def callSite():
+    """
+    Walk up the current stack to find out which twistar method and which line
+    of application code led to it.
+
+    @return: A L{CallSite}.
+    """
+    frame = sys._getframe(1)
+    method = None
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if filename.startswith(TWISTAR_DIR) and not filename.startswith(TWISTAR_TESTS_DIR):
+            method = _methodLabel(frame) or method
+        elif not filename.startswith(IGNORED_DIRS) and not filename.startswith('<'):
+            return CallSite(method, "%s:%d" % (filename, frame.f_lineno))
+        frame = frame.f_back
+    return CallSite(method, None)
+
+
+class Query(object):
+    """
+    A single statement executed through L{InteractionBase.executeTxn<twistar.dbconfig.base.InteractionBase.executeTxn>}.
+    The same instance is given to the C{pre} and C{post} functions of a L{Hook}.
+
+    @ivar sql: The SQL statement.
+    @ivar args: The statement parameters (a C{list}, or C{None} if none were given).
+    @ivar operation: The lowercased statement type, like C{'select'} or C{'insert'}.
+    @ivar tablename: The first table referenced by the statement, or C{None}.
+    @ivar callsite: A L{CallSite}.
+    @ivar rowcount: The cursor's C{rowcount} after execution (-1 if the driver doesn't
+    know, which is common for C{SELECT}s).  C{None} before execution.
+    @ivar elapsed: Seconds the statement took.  C{None} before execution.
+    @ivar error: The exception raised by the statement, if any.
+    @ivar hooks: The L{Hook}s sampled for this statement.
+    """
+
+    def __init__(self, sql, args, callsite):
+        self.sql = sql
+        self.args = args
+        self.operation, self.tablename = queryTarget(sql)
+        self.callsite = callsite
+        self.rowcount = None
+        self.elapsed = None
+        self.error = None
+        self.hooks = []
+
+
+class Hook(object):
+    """
+    A pair of functions called before and after statements are executed.  Hooks are
+    called synchronously in the thread running the statement, so they should be fast
+    and thread safe.
+
+    @ivar pre: A function accepting a L{Query} called before each sampled statement, or C{None}.
+    @ivar post: A function accepting a L{Query} called after each sampled statement, or C{None}.
+    @ivar sample: The fraction (0 to 1) of statements this hook sees.
+    """
+
+    def __init__(self, pre=None, post=None, sample=1.0):
+        self.pre = pre
+        self.post = post
+        self.sample = sample
+
+
+    def sampled(self):
+        """
+        Decide whether this hook should see the next statement.
+        """
+        return self.sample >= 1 or random.random() < self.sample
+
+
+class Instrumentation(object):
+    """
+    A registry (in the style of L{Registry<twistar.registry.Registry>}) of query
+    hooks and the slow query log.
+
+    @cvar HOOKS: The C{list} of active L{Hook}s.
+
+    @cvar SLOW_QUERY_THRESHOLD: If not C{None}, any statement taking at least
+    this many seconds is logged with C{twisted.python.log.msg}, along with
+    its L{CallSite}.
+    """
+    HOOKS = []
+    SLOW_QUERY_THRESHOLD = None
+
+    @classmethod
+    def addHook(klass, pre=None, post=None, sample=1.0):
+        """
+        Register functions to be called around each statement.
+
+        @param pre: A function accepting a L{Query} to call before each statement.
+
+        @param post: A function accepting a L{Query} to call after each statement
+        (whether it succeeded or not).
+
+        @param sample: The fraction of statements to call these functions for.
+
+        @return: The L{Hook}, which can be given to L{removeHook}.
+        """
+        hook = Hook(pre, post, sample)
+        klass.HOOKS = klass.HOOKS + [hook]
+        return hook
+
+
+    @classmethod
+    def removeHook(klass, hook):
+        """
+        Unregister a L{Hook} returned by L{addHook}.
+        """
+        klass.HOOKS = [h for h in klass.HOOKS if h is not hook]
+
+
+    @classmethod
+    def isActive(klass):
+        """
+        Whether any hooks or the slow query log are enabled.
+        """
+        return len(klass.HOOKS) > 0 or klass.SLOW_QUERY_THRESHOLD is not None
+
+
+    @classmethod
+    def attribute(klass, interaction):
+        """
+        Record the current call site so that statements run by the given interaction
+        (later, in a pool thread) can be attributed to it.
+
+        @return: A function to use in place of C{interaction}.
+        """
+        if not klass.isActive():
+            return interaction
+        site = callSite()
+
+        def _attributed(txn, *args, **kwargs):
+            previous = getattr(_local, 'callsite', None)
+            _local.callsite = site
+            try:
+                return interaction(txn, *args, **kwargs)
+            finally:
+                _local.callsite = previous
+        return _attributed
+
+
+    @classmethod
+    def begin(klass, sql, args):
+        """
+        Start observing a statement, calling the C{pre} functions of the sampled hooks.
+
+        @return: A L{Query}, or C{None} if nothing is observing statements.
+        """
+        if not klass.isActive():
+            return None
+        site = getattr(_local, 'callsite', None) or callSite()
+        query = Query(sql, args[0] if len(args) > 0 else None, site)
+        query.hooks = [hook for hook in klass.HOOKS if hook.sampled()]
+        for hook in query.hooks:
+            if hook.pre is not None:
+                hook.pre(query)
+        return query
+
+
+    @classmethod
+    def finish(klass, query, elapsed, rowcount=None, error=None):
+        """
+        Finish observing a statement started with L{begin}, calling the C{post} functions
+        of the sampled hooks and logging the statement if it was slow.
+        """
+        if query is None:
+            return
+        query.elapsed = elapsed
+        query.rowcount = rowcount
+        query.error = error
+        threshold = klass.SLOW_QUERY_THRESHOLD
+        if threshold is not None and elapsed >= threshold:
+            log.msg("TWISTAR slow query (%.4fs) from %s: %s" % (elapsed, query.callsite, query.sql))
+        for hook in query.hooks:
+            if hook.post is not None:
+                hook.post(query)
+
+
+def queryShape(sql):
+    """
+    Normalize a statement so that statements differing only by their literal
+    values or parameter counts have the same shape.
+
+    For instance, C{"SELECT * FROM users WHERE id IN (1,2,3)"} becomes
+    C{"SELECT * FROM users WHERE id IN (...)"}.
+    """
+    for pattern, replacement in SHAPE_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class QueryRecorder(object):
+    """
+    Records every statement run between L{start} and L{stop}.
+
+    @ivar queries: The C{list} of recorded L{Query}s.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self._lock = threading.Lock()
+        self._hook = None
+
+
+    def start(self):
+        """
+        Start recording statements.
+        """
+        self.queries = []
+        self._hook = Instrumentation.addHook(post=self._record)
+
+
+    def stop(self):
+        """
+        Stop recording statements.
+
+        @return: The C{list} of recorded L{Query}s.
+        """
+        if self._hook is not None:
+            Instrumentation.removeHook(self._hook)
+            self._hook = None
+        return self.queries
+
+
+    def watch(self, func, *args, **kwargs):
+        """
+        Record the statements run by the given function, which may return a C{Deferred}.
+
+        @return: A C{Deferred} that fires with the result of C{func}.
+        """
+        def _stop(result):
+            self.stop()
+            return result
+        self.start()
+        return defer.maybeDeferred(func, *args, **kwargs).addBoth(_stop)
+
+
+    def _record(self, query):
+        with self._lock:
+            self.queries.append(query)
+
+
+class Repetition(object):
+    """
+    A query shape that was repeated more than allowed by an L{NPlusOneDetector}.
+
+    @ivar shape: The L{normalized<queryShape>} statement.
+    @ivar callsite: The L{CallSite} of the first occurrence.
+    @ivar count: How many times the statement was run.
+    """
+
+    def __init__(self, shape, callsite, count):
+        self.shape = shape
+        self.callsite = callsite
+        self.count = count
+
+
+    def suggestion(self):
+        """
+        Get a hint on how to avoid the repetition.  If the statements came from a
+        relationship, this names the relationship to preload.
+        """
+        method = self.callsite.method or ""
+        parts = method.split(".")
+        if len(parts) == 3:
+            return "consider preloading the '%s' relationship of %s instead of calling %s per %s" % \
+                (parts[1], parts[0], parts[2], parts[0])
+        return "consider loading these rows with a single query"
+
+
+    def __str__(self):
+        return "N+1 query: %s ran %i times from %s; %s" % \
+            (self.shape, self.count, self.callsite, self.suggestion())
+
+
+class NPlusOneDetector(object):
+    """
+    Watches the statements run between L{start} and L{stop}, grouping them by
+    L{shape<queryShape>} and L{CallSite} method.  When any group grows beyond
+    C{threshold} statements, an L{NPlusOneWarning<twistar.exceptions.NPlusOneWarning>}
+    is issued and, if C{raiseErrors} is set, L{stop} raises an
+    L{NPlusOneError<twistar.exceptions.NPlusOneError>}.
+
+    In a trial test, this could look like::
+
+        def setUp(self):
+            self.detector = NPlusOneDetector(threshold=3, raiseErrors=True)
+            self.detector.start()
+
+        def tearDown(self):
+            self.detector.stop()
+
+    @ivar repetitions: The C{list} of L{Repetition}s found so far.
+    """
+
+    def __init__(self, threshold=5, raiseErrors=False):
+        """
+        Constructor.
+
+        @param threshold: The number of times a statement may run before it counts
+        as an N+1 query.
+
+        @param raiseErrors: If True, L{stop} raises an error if any repetitions were found.
+        """
+        self.threshold = threshold
+        self.raiseErrors = raiseErrors
+        self.repetitions = []
+        self._groups = {}
+        self._lock = threading.Lock()
+        self._hook = None
+
+
+    def start(self):
+        """
+        Start watching statements.
+        """
+        self.repetitions = []
+        self._groups = {}
+        self._hook = Instrumentation.addHook(post=self._observe)
+
+
+    def stop(self):
+        """
+        Stop watching statements.
+
+        @return: The C{list} of L{Repetition}s found.
+        """
+        if self._hook is not None:
+            Instrumentation.removeHook(self._hook)
+            self._hook = None
+        if self.raiseErrors and len(self.repetitions) > 0:
+            raise NPlusOneError("\n".join([str(r) for r in self.repetitions]))
+        return self.repetitions
+
+
+    def watch(self, func, *args, **kwargs):
+        """
+        Watch the statements run by the given function, which may return a C{Deferred}.
+
+        @return: A C{Deferred} that fires with the result of C{func} (or fails with an
+        L{NPlusOneError<twistar.exceptions.NPlusOneError>} if C{raiseErrors} is set and
+        repetitions were found).
+        """
+        def _stop(result):
+            self.stop()
+            return result
+
+        def _stopOnFailure(failure):
+            if self._hook is not None:
+                Instrumentation.removeHook(self._hook)
+                self._hook = None
+            return failure
+
+        self.start()
+        return defer.maybeDeferred(func, *args, **kwargs).addCallbacks(_stop, _stopOnFailure)
+
+
+    def _observe(self, query):
+        key = (queryShape(query.sql), query.callsite.method)
+        with self._lock:
+            if key not in self._groups:
+                self._groups[key] = Repetition(key[0], query.callsite, 0)
+            repetition = self._groups[key]
+            repetition.count += 1
+            found = repetition.count == self.threshold + 1
+            if found:
+                self.repetitions.append(repetition)
+        if found:
+            warnings.warn(str(repetition), NPlusOneWarning, stacklevel=2)
@@ -0,0 +1,354 @@
+"""
+Module providing a connection pool that keeps track of its own health.
+"""
+
+from __future__ import absolute_import
+import threading
+from timeit import default_timer as now
+
+from twisted.enterprise import adbapi
+from twisted.internet import threads, task
+from twisted.python import log
+
+from twistar.utils import queryTarget
+import six
+
+
+class Histogram(object):
+    """
+    A fixed bucket histogram of observed values (usually durations in seconds).
+
+    @cvar BUCKETS: The upper bounds of each bucket.  Values greater than the
+    last bound are counted in an overflow bucket.
+    """
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, buckets=None):
+        """
+        Constructor.
+
+        @param buckets: An optional sorted C{tuple} of bucket upper bounds.
+        """
+        self.buckets = buckets or self.BUCKETS
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+    def add(self, value):
+        """
+        Record a single observation.
+        """
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+    def toDict(self):
+        """
+        Get a C{dict} version of this histogram.  The C{buckets} key holds a
+        C{list} of C{(upper bound, count)} pairs, with C{None} as the bound of
+        the overflow bucket.
+        """
+        bounds = list(self.buckets) + [None]
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else 0.0,
+            'buckets': list(zip(bounds, self.counts))
+        }
+
+
+class StatsConnectionPool(adbapi.ConnectionPool):
+    """
+    A C{twisted.enterprise.adbapi.ConnectionPool} that keeps statistics about its
+    connections and queries, recycles old connections and can adapt its size to load.
+
+    On top of the usual C{cp_*} keyword arguments, this pool understands:
+      - C{cp_max_lifetime}: Seconds after which a connection is closed and reopened before use.
+      - C{cp_max_idle}: Seconds a connection may sit unused before it is reopened.
+      - C{cp_pre_ping}: If True, run C{good_sql} on a connection before handing it out.
+      - C{cp_adaptive}: If True, periodically grow C{max} (up to C{cp_max_ceiling}) while
+        interactions are queueing, and shrink it back when connections sit idle.
+      - C{cp_max_ceiling}: The largest C{max} the adaptive sizing may use.
+      - C{cp_adapt_interval}: Seconds between adaptive sizing decisions.
+
+    Use L{stats} to get a snapshot of the pool and L{addObserver} to feed
+    metric exporters.
+    """
+    CP_ARGS = adbapi.ConnectionPool.CP_ARGS + \
+        ["max_lifetime", "max_idle", "pre_ping", "adaptive", "max_ceiling", "adapt_interval"]
+
+    max_lifetime = None
+    max_idle = None
+    pre_ping = False
+    adaptive = False
+    max_ceiling = None
+    adapt_interval = 10
+
+    # adaptive sizing grows the pool when the mean checkout wait over an interval exceeds this
+    WAIT_THRESHOLD = 0.05
+
+    def __init__(self, *args, **kwargs):
+        adbapi.ConnectionPool.__init__(self, *args, **kwargs)
+        self._lock = threading.Lock()
+        self._observers = []
+        self._connInfo = {}
+        self._adaptLoop = None
+        self._baseMax = self.max
+        self.resetStats()
+
+
+    def resetStats(self):
+        """
+        Clear all collected statistics.
+        """
+        with self._lock:
+            self._inUse = 0
+            self._peakInUse = 0
+            self._waiting = 0
+            self._counters = {'checkouts': 0, 'reconnects': 0, 'recycled': 0, 'errors': 0}
+            self._checkoutWait = Histogram()
+            self._intervalWait = Histogram()
+            self._queries = {}
+
+
+    def addObserver(self, observer):
+        """
+        Add a function to be called for each collected sample.  It will be called
+        (in the reactor thread) with three arguments: the name of the metric
+        (C{'checkout_wait'}, C{'query'}, C{'reconnect'}, C{'recycle'} or C{'error'}),
+        a numeric value and a C{dict} of tags (for queries, C{table} and C{operation}).
+        """
+        self._observers.append(observer)
+
+
+    def removeObserver(self, observer):
+        """
+        Remove a function previously added with L{addObserver}.
+        """
+        self._observers.remove(observer)
+
+
+    def _notify(self, name, value, tags=None):
+        if not self._observers:
+            return
+        self._reactor.callFromThread(self._dispatch, name, value, tags or {})
+
+
+    def _dispatch(self, name, value, tags):
+        for observer in list(self._observers):
+            try:
+                observer(name, value, tags)
+            except Exception:
+                log.err(None, "Pool stats observer failed")
+
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+
+    def stats(self):
+        """
+        Get a snapshot of the state of this pool.
+
+        @return: A C{dict} with the current C{size}, C{in_use}, C{idle}, C{waiting}, C{min}
+        and C{max} values, counters for C{checkouts}, C{reconnects}, C{recycled} connections
+        and C{errors}, a C{checkout_wait} histogram and a C{queries} C{dict} of the form
+        C{{tablename: {operation: histogram}}}.  Histograms are given as C{dict}s; see
+        L{Histogram.toDict}.
+        """
+        with self._lock:
+            size = len(self.connections)
+            result = {
+                'size': size,
+                'in_use': self._inUse,
+                'idle': max(size - self._inUse, 0),
+                'waiting': self._waiting,
+                'min': self.min,
+                'max': self.max,
+                'checkout_wait': self._checkoutWait.toDict(),
+                'queries': {}
+            }
+            result.update(self._counters)
+            for (tablename, operation), histogram in six.iteritems(self._queries):
+                result['queries'].setdefault(tablename, {})[operation] = histogram.toDict()
+        return result
+
+
+    def observeQuery(self, query, elapsed):
+        """
+        Record the time taken by a single statement.  This is called by
+        L{twistar.dbconfig.base.InteractionBase} for every statement it executes.
+
+        @param query: The SQL statement.
+
+        @param elapsed: Seconds the statement took.
+        """
+        operation, tablename = queryTarget(query)
+        tablename = tablename or '-'
+        with self._lock:
+            key = (tablename, operation)
+            if key not in self._queries:
+                self._queries[key] = Histogram()
+            self._queries[key].add(elapsed)
+        self._notify('query', elapsed, {'table': tablename, 'operation': operation})
+
+
+    def recordReconnect(self):
+        """
+        Record that a connection had to be reopened after being lost.
+        """
+        self._count('reconnects')
+        self._notify('reconnect', 1)
+
+
+    def connect(self):
+        # threads stopped by resize exit asynchronously, so their connections are
+        # closed here once there are more of them than the pool may use
+        if len(self.connections) > self.max:
+            self._pruneConnections()
+        tid = self.threadID()
+        isNew = tid not in self.connections
+        conn = adbapi.ConnectionPool.connect(self)
+        if isNew:
+            with self._lock:
+                self._connInfo[tid] = [now(), now()]
+        return conn
+
+
+    def disconnect(self, conn):
+        adbapi.ConnectionPool.disconnect(self, conn)
+        with self._lock:
+            self._connInfo.pop(self.threadID(), None)
+
+
+    def _recycle(self):
+        """
+        Close the current thread's connection if it is too old, has been idle too long,
+        or (when C{pre_ping} is set) no longer works.
+        """
+        tid = self.threadID()
+        conn = self.connections.get(tid)
+        if conn is None:
+            return
+        with self._lock:
+            created, lastUsed = self._connInfo.get(tid, (now(), now()))
+        current = now()
+        expired = self.max_lifetime is not None and current - created > self.max_lifetime
+        stale = self.max_idle is not None and current - lastUsed > self.max_idle
+        if expired or stale:
+            self.disconnect(conn)
+            self._count('recycled')
+            self._notify('recycle', 1)
+        elif self.pre_ping:
+            try:
+                curs = conn.cursor()
+                curs.execute(self.good_sql)
+                curs.close()
+            except Exception:
+                self.disconnect(conn)
+                self.recordReconnect()
+
+
+    def runInteraction(self, interaction, *args, **kw):
+        with self._lock:
+            self._waiting += 1
+        return threads.deferToThreadPool(self._reactor, self.threadpool,
+                                         self._runTimedInteraction, now(), interaction, *args, **kw)
+
+
+    def _runTimedInteraction(self, queued, interaction, *args, **kw):
+        wait = now() - queued
+        with self._lock:
+            self._waiting -= 1
+            self._inUse += 1
+            self._peakInUse = max(self._peakInUse, self._inUse)
+            self._counters['checkouts'] += 1
+            self._checkoutWait.add(wait)
+            self._intervalWait.add(wait)
+        self._notify('checkout_wait', wait)
+
+        try:
+            self._recycle()
+            return self._runInteraction(interaction, *args, **kw)
+        except Exception:
+            self._count('errors')
+            self._notify('error', 1)
+            raise
+        finally:
+            with self._lock:
+                self._inUse -= 1
+                info = self._connInfo.get(self.threadID())
+                if info is not None:
+                    info[1] = now()
+
+
+    def start(self):
+        adbapi.ConnectionPool.start(self)
+        if self.adaptive and self._adaptLoop is None:
+            self._adaptLoop = task.LoopingCall(self.adapt)
+            self._adaptLoop.clock = self._reactor
+            self._adaptLoop.start(self.adapt_interval, now=False)
+
+
+    def finalClose(self):
+        if self._adaptLoop is not None and self._adaptLoop.running:
+            self._adaptLoop.stop()
+        self._adaptLoop = None
+        adbapi.ConnectionPool.finalClose(self)
+
+
+    def resize(self, minimum=None, maximum=None):
+        """
+        Change the number of connections (threads) this pool may use.  Connections of
+        threads stopped by shrinking the pool are closed once those threads have exited:
+        right away if they already have, or else by the next L{connect}.
+        """
+        minimum = self.min if minimum is None else minimum
+        maximum = self.max if maximum is None else maximum
+        self.min = min(minimum, maximum)
+        self.max = max(minimum, maximum)
+        self.threadpool.adjustPoolsize(self.min, self.max)
+        self._pruneConnections()
+
+
+    def _pruneConnections(self):
+        """
+        Close connections that belong to threads that are no longer alive.
+        """
+        alive = set(thread.ident for thread in threading.enumerate())
+        for tid in list(self.connections.keys()):
+            if tid not in alive:
+                conn = self.connections.pop(tid, None)
+                if conn is not None:
+                    self._close(conn)
+                with self._lock:
+                    self._connInfo.pop(tid, None)
+
+
+    def adapt(self):
+        """
+        Make one adaptive sizing decision based on the load seen since the last call:
+        grow C{max} by one if interactions had to wait (up to C{max_ceiling}), or
+        shrink it by one (down to the originally configured C{max}) if fewer than half
+        of the connections were ever in use.
+        """
+        with self._lock:
+            waited = self._waiting > 0 or self._intervalWait.toDict()['mean'] > self.WAIT_THRESHOLD
+            peak = self._peakInUse
+            self._intervalWait = Histogram()
+            self._peakInUse = self._inUse
+
+        ceiling = self.max_ceiling or self._baseMax
+        if waited and self.max < ceiling:
+            self.resize(maximum=self.max + 1)
+        elif not waited and peak * 2 < self.max and self.max > self._baseMax:
+            self.resize(maximum=self.max - 1)
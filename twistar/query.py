@@ -0,0 +1,394 @@
+"""
+Lazy, chainable queries.
+"""
+
+from __future__ import absolute_import
+from twisted.internet import defer
+
+from twistar.registry import Registry
+from twistar.utils import createInstances, joinMultipleWheres
+
+
+class Query(object):
+    """
+    A query for instances of a L{DBObject<twistar.dbobject.DBObject>} class.  Each method
+    that refines the query returns a new C{Query}, and nothing is run until the query is
+    awaited or one of L{find}, L{first}, L{count}, L{exists}, L{batches} or L{each} is
+    called.  For instance::
+
+        adults = User.where(age__gte=18)
+        users = yield adults.order('last_name', '-age').limit(50).find()
+        page = yield adults.order('id')[100:150]
+        bob = yield adults.where(first_name="Bob").first()
+
+    Keyword conditions are of the form C{column__operator=value} (see L{OPERATORS}); a plain
+    C{column=value} means C{column = value} (or C{column IS NULL} if the value is C{None}).
+    For classes with a L{SOFT_DELETE<twistar.dbobject.DBObject.SOFT_DELETE>} column, rows
+    marked as deleted are left out unless L{withDeleted} is used.
+
+    @cvar OPERATORS: The operators that can be used in keyword conditions, and the
+    conditional each is turned into.
+
+    @cvar MAX_LIMIT: The limit used for a query with an offset but no limit.
+    """
+    OPERATORS = {
+        'exact': "%s = ?",
+        'ne': "%s <> ?",
+        'gt': "%s > ?",
+        'gte': "%s >= ?",
+        'lt': "%s < ?",
+        'lte': "%s <= ?",
+        'like': "%s LIKE ?",
+        'in': None,
+        'isnull': None
+    }
+    MAX_LIMIT = 2 ** 63 - 1
+
+    def __init__(self, klass, wheres=(), orderby=None, group=None, limit=None, offset=None, joins=(),
+                 deleted=False):
+        """
+        Constructor.  Rather than calling this, use
+        L{DBObject.where<twistar.dbobject.DBObject.where>}.
+
+        @param klass: The L{DBObject<twistar.dbobject.DBObject>} class to find instances of.
+
+        @param wheres: A C{tuple} of conditionals of the same form as the C{where} parameter
+        in L{DBObject.find<twistar.dbobject.DBObject.find>}, which must all hold.
+
+        @param joins: A C{tuple} of the names of relationships to join (see L{joins}).
+
+        @param deleted: Whether to include rows marked as deleted (see L{withDeleted}).
+        """
+        self.klass = klass
+        self.wheres = tuple(wheres)
+        self.orderby = orderby
+        self.grouping = group
+        self.limitTo = limit
+        self.offsetBy = offset
+        self.joinNames = tuple(joins)
+        self.deleted = deleted
+        self._compiled = None
+
+
+    def _clone(self, **changes):
+        args = {
+            'wheres': self.wheres,
+            'orderby': self.orderby,
+            'group': self.grouping,
+            'limit': self.limitTo,
+            'offset': self.offsetBy,
+            'joins': self.joinNames,
+            'deleted': self.deleted
+        }
+        args.update(changes)
+        return self.__class__(self.klass, **args)
+
+
+    def where(self, *wheres, **conditions):
+        """
+        Narrow the query.
+
+        @param wheres: Conditionals of the same form as the C{where} parameter in
+        L{DBObject.find<twistar.dbobject.DBObject.find>}.
+
+        @param conditions: Keyword conditions, like C{age__gt=21}.
+
+        @return: A new L{Query}.
+        """
+        wheres = [where for where in wheres if where]
+        for key in sorted(conditions.keys()):
+            wheres.append(self.conditional(key, conditions[key]))
+        return self._clone(wheres=self.wheres + tuple(wheres))
+
+
+    def conditional(self, key, value):
+        """
+        Turn a keyword condition into a conditional of the same form as the C{where}
+        parameter in L{DBObject.find<twistar.dbobject.DBObject.find>}.
+
+        @raise ValueError: If the operator isn't one of L{OPERATORS}.
+        """
+        column, _, operator = key.partition('__')
+        operator = operator or 'exact'
+        if operator not in self.OPERATORS:
+            raise ValueError("Unknown operator %s in %s" % (operator, key))
+        if operator == 'isnull':
+            return ["%s IS %s" % (column, "NULL" if value else "NOT NULL")]
+        if operator == 'exact' and value is None:
+            return ["%s IS NULL" % column]
+        if operator == 'in':
+            wheres = Registry.getConfig().whereIn(column, value)
+            return joinMultipleWheres(wheres, "OR") or ["1 = 0"]
+        return [self.OPERATORS[operator] % column, value]
+
+
+    def joins(self, *names):
+        """
+        Join the objects of the given relationships, so that the query can be narrowed by
+        them, like the C{joins} parameter in L{DBObject.find<twistar.dbobject.DBObject.find>}.
+        For instance, C{User.where(['pictures.name = ?', 'me']).joins('pictures')}.
+
+        @return: A new L{Query}.
+        """
+        return self._clone(joins=self.joinNames + names)
+
+
+    def withDeleted(self):
+        """
+        Include rows marked as deleted, for classes with a
+        L{SOFT_DELETE<twistar.dbobject.DBObject.SOFT_DELETE>} column.
+
+        @return: A new L{Query}.
+        """
+        return self._clone(deleted=True)
+
+
+    def order(self, *columns):
+        """
+        Order the results, replacing any previous ordering.  Columns starting with C{-}
+        are in descending order, so C{order('last_name', '-age')} orders by
+        C{last_name ASC, age DESC}.
+
+        @return: A new L{Query}.
+        """
+        parts = []
+        for column in columns:
+            if column.startswith('-'):
+                parts.append("%s DESC" % column[1:])
+            elif ' ' in column:
+                parts.append(column)
+            else:
+                parts.append("%s ASC" % column)
+        return self._clone(orderby=", ".join(parts) or None)
+
+
+    def group(self, group):
+        """
+        Group the results, like the C{group} parameter in L{DBObject.find<twistar.dbobject.DBObject.find>}.
+
+        @return: A new L{Query}.
+        """
+        return self._clone(group=group)
+
+
+    def limit(self, limit):
+        """
+        Limit the number of results.
+
+        @return: A new L{Query}.
+        """
+        return self._clone(limit=limit)
+
+
+    def offset(self, offset):
+        """
+        Skip the given number of results.
+
+        @return: A new L{Query}.
+        """
+        return self._clone(offset=offset)
+
+
+    def __getitem__(self, index):
+        """
+        Slice the query.  Slicing returns a new L{Query} with a limit and offset, for instance
+        C{query[100:150]}, and indexing returns a C{Deferred} that fires with the instance at
+        that position (or C{None}).  Negative indexes and steps aren't supported.
+        """
+        if isinstance(index, slice):
+            start, stop = index.start or 0, index.stop
+            if index.step is not None or start < 0 or (stop is not None and stop < 0):
+                raise ValueError("Queries can only be sliced with non-negative bounds and no step")
+            limit = self.limitTo
+            if stop is not None:
+                limit = max(stop - start, 0) if limit is None else max(min(stop, limit) - start, 0)
+            elif limit is not None:
+                limit = max(limit - start, 0)
+            return self._clone(limit=limit, offset=(self.offsetBy or 0) + start or None)
+        if index < 0:
+            raise ValueError("Queries can't be indexed from the end")
+        return self[index:index + 1].find().addCallback(lambda objs: objs[0] if objs else None)
+
+
+    def __iter__(self):
+        raise TypeError("Queries are run asynchronously; use find, batches or each")
+
+
+    def toWhere(self):
+        """
+        Get the conditions of this query as a single conditional of the same form as the
+        C{where} parameter in L{DBObject.find<twistar.dbobject.DBObject.find>}, or C{None}.
+        This includes the condition leaving out rows marked as deleted (see L{withDeleted}).
+        """
+        where = joinMultipleWheres(self.wheres) or None
+        return where if self.deleted else self.klass.liveWhere(where)
+
+
+    def compile(self):
+        """
+        Get the select statement this query runs.  The result is cached, so running the
+        same query again doesn't build it again.
+
+        @return: A C{tuple} of the query string and a C{list} of its arguments.
+        """
+        config = Registry.getConfig()
+        if self._compiled is None or self._compiled[0] is not config:
+            limit = self.limitTo
+            if self.offsetBy:
+                limit = (self.MAX_LIMIT if limit is None else limit, self.offsetBy)
+            select, joins = None, None
+            if self.joinNames:
+                joins, distinct = self.klass.joinClauses(self.joinNames)
+                select = "%s%s.*" % ("DISTINCT " if distinct else "", self.klass.tablename())
+            q, args = config.selectToString(self.klass.tablename(), self.toWhere(), self.grouping, limit,
+                                            self.orderby, select, joins)
+            self._compiled = (config, (q, args))
+        return self._compiled[1]
+
+
+    def find(self):
+        """
+        Run the query.
+
+        @return: A C{Deferred} that fires with a C{list} of instances.
+        """
+        if self.limitTo == 0:
+            return defer.succeed([])
+        config = Registry.getConfig()
+        q, args = self.compile()
+        d = config.runInteraction(config._doselect, q, args, self.klass.tablename(), timeout=self.klass.TIMEOUT)
+        return d.addCallback(lambda props: createInstances(props, self.klass.slottedClass()))
+
+
+    def __await__(self):
+        return self.find().__await__()
+
+
+    def first(self):
+        """
+        Get the first instance found.  Queries without an ordering are ordered by C{id}.
+
+        @return: A C{Deferred} that fires with an instance or C{None}.
+        """
+        query = self if self.orderby is not None else self.order(self._idColumn())
+        return query[0]
+
+
+    def count(self):
+        """
+        Count the instances the query would find.
+
+        @return: A C{Deferred} that fires with an C{int}.
+        """
+        config = Registry.getConfig()
+        if self._simple():
+            return config.count(self.klass.tablename(), where=self.toWhere(), timeout=self.klass.TIMEOUT)
+
+        q, args = self.compile()
+
+        def _count(txn):
+            config.executeTxn(txn, "SELECT COUNT(*) FROM (%s) AS twistar_count" % q, args)
+            return txn.fetchone()[0]
+        return config.runInteraction(_count, timeout=self.klass.TIMEOUT)
+
+
+    def exists(self):
+        """
+        Find out whether the query would find any instances.
+
+        @return: A C{Deferred} that fires with a boolean.
+        """
+        if self._simple():
+            return Registry.getConfig().exists(self.klass.tablename(), where=self.toWhere(), timeout=self.klass.TIMEOUT)
+        return self.count().addCallback(lambda count: count > 0)
+
+
+    def batches(self, batchsize=1000):
+        """
+        Iterate over the results in batches, so that they don't all have to be loaded at
+        once.  Each item is a C{Deferred} firing with a C{list} of up to C{batchsize}
+        instances, which must fire before the next item is requested.  This fits
+        C{inlineCallbacks}::
+
+            for batch in User.where(age__gt=21).batches(100):
+                users = yield batch
+
+        Queries without an ordering are read in C{id} order, each batch starting after the
+        last C{id} of the previous one; ordered queries are read with increasing offsets.
+        """
+        keyset = self.orderby is None
+        query = self.order(self._idColumn()) if keyset else self
+        remaining = self.limitTo
+        offset = self.offsetBy or 0
+        state = {'fetched': None}
+
+        def _fetched(objs):
+            state['fetched'] = len(objs)
+            return objs
+
+        while remaining is None or remaining > 0:
+            size = batchsize if remaining is None else min(batchsize, remaining)
+            batch = query._clone(limit=size, offset=offset or None)
+            state['fetched'] = None
+            d = batch.find().addCallback(_fetched)
+            if keyset:
+                d.addCallback(self._keysetNext, state)
+            yield d
+
+            fetched = state['fetched']
+            if fetched is None:
+                raise RuntimeError("Each batch must be waited for before the next is requested")
+            if fetched < size:
+                return
+            if remaining is not None:
+                remaining -= fetched
+            if keyset:
+                query = self.order(self._idColumn()).where(["%s > ?" % self._idColumn(), state['last']])
+                offset = 0
+            else:
+                offset += fetched
+
+
+    def _simple(self):
+        """
+        Whether the query can be counted or checked for existence without a subquery.
+        """
+        return self.limitTo is None and not self.offsetBy and self.grouping is None and not self.joinNames
+
+
+    def _idColumn(self):
+        return "%s.id" % self.klass.tablename()
+
+
+    def _keysetNext(self, objs, state):
+        if objs:
+            state['last'] = objs[-1].id
+        return objs
+
+
+    @defer.inlineCallbacks
+    def each(self, func, batchsize=1000):
+        """
+        Call a function with each instance the query finds, loading them in batches (see
+        L{batches}).  If the function returns a C{Deferred}, it is waited for.
+
+        @return: A C{Deferred} that fires with the number of instances.
+        """
+        count = 0
+        for batch in self.batches(batchsize):
+            objs = yield batch
+            for obj in objs:
+                yield func(obj)
+            count += len(objs)
+        defer.returnValue(count)
+
+
+    def __repr__(self):
+        where = self.toWhere()
+        parts = ["where=%r" % where] if where else []
+        for name, value in (('orderby', self.orderby), ('group', self.grouping),
+                            ('limit', self.limitTo), ('offset', self.offsetBy), ('joins', self.joinNames or None),
+                            ('deleted', self.deleted or None)):
+            if value is not None:
+                parts.append("%s=%r" % (name, value))
+        return "<Query %s %s>" % (self.klass.__name__, " ".join(parts))
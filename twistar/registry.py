@@ -4,8 +4,9 @@ Module handling global registration of variables and classes.
 
 from __future__ import absolute_import
 from twisted.python import reflect
+from twisted.internet import defer
 
-from twistar.exceptions import ClassNotRegisteredError
+from twistar.exceptions import ClassNotRegisteredError, InvalidRelationshipError
 
 
 class Registry(object):
@@ -14,11 +15,20 @@ class Registry(object):
 
     @cvar DBPOOL: This should be set to the C{twisted.enterprise.dbapi.ConnectionPool} to
     use for all database interaction.
+
+    @cvar RETRY_POLICY: If set to a L{RetryPolicy<twistar.retry.RetryPolicy>}, interactions
+    that fail with transient errors (like deadlocks) are retried according to it.
+
+    @cvar COUNTERS: The counter caches of the registered classes, indexed by the table they
+    count (see L{CounterCache.counting<twistar.relationships.CounterCache.counting>}).  It is
+    built when first needed and cleared when classes are registered.
     """
     SCHEMAS = {}
     REGISTRATION = {}
     IMPL = None
     DBPOOL = None
+    RETRY_POLICY = None
+    COUNTERS = None
 
 
     @classmethod
@@ -28,10 +38,46 @@ class Registry(object):
         are created on the fly (specifically, as a result of relationship C{get}s) the package
         knows how to find them.
 
+        The metadata of the classes' relationships is resolved here, once, rather than on
+        every access of a relationship.  Use L{validate} to check it against the database.
+
         @param klasses: Any number of parameters, each of which is a class.
         """
         for klass in klasses:
             Registry.REGISTRATION[klass.__name__] = klass
+        for klass in klasses:
+            if hasattr(klass, 'initRelationshipCache'):
+                klass.initRelationshipCache()
+        Registry.COUNTERS = None
+
+
+    @classmethod
+    def validate(_, *klasses):
+        """
+        Check the relationships of registered classes: that the classes they refer to are
+        registered and that the tables and columns they rely on (such as foreign keys and
+        join tables) exist.  This is meant to be called at startup, so that misconfigured
+        relationships are found then rather than when they are first used.
+
+        @param klasses: The classes to check.  Default is all registered classes.
+
+        @return: A C{Deferred} that fires with C{None} once the relationships are checked,
+        or fails with an L{InvalidRelationshipError} describing all the problems found.
+        """
+        klasses = klasses or [Registry.REGISTRATION[name] for name in sorted(Registry.REGISTRATION.keys())]
+        ds = []
+        for klass in klasses:
+            cache = getattr(klass, 'RELATIONSHIP_CACHE', None)
+            for name in sorted((cache or {}).keys()):
+                ds.append(cache[name].check())
+
+        def _report(results):
+            problems = []
+            for _, found in results:
+                problems += found
+            if problems:
+                raise InvalidRelationshipError("\n".join(problems))
+        return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True).addCallback(_report)
 
 
     @classmethod
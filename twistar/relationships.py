@@ -9,49 +9,111 @@ from BermiInflector.Inflector import Inflector
 
 from twistar.registry import Registry
 from twistar.utils import createInstances, joinWheres
-from twistar.exceptions import ReferenceNotSavedError
+from twistar.exceptions import ReferenceNotSavedError, InvalidRelationshipError, ClassNotRegisteredError
+from six.moves import range
 
 
 class Relationship(object):
     """
     Base class that all specific relationship type classes extend.
 
+    @cvar TO_MANY: Whether an object can have more than one object through the
+    relationship, so that joining it can repeat rows.
+
     @see: L{HABTM}, L{HasOne}, L{HasMany}, L{BelongsTo}
     """
+    TO_MANY = False
 
-    def __init__(self, inst, propname, givenargs):
+    def __init__(self, inst, info):
         """
         Constructor.
 
         @param inst: The L{DBObject} instance.
 
-        @param propname: The property name in the L{DBObject} instance that
-        results in this class being created.
-
-        @param givenargs: Any arguments given (through the use of a C{dict}
-        in the class variable in L{DBObject} rather than a string to describe
-        the relationship).  The given args can include, for all relationships,
-        a C{class_name}.  Depending on the relationship, C{association_foreign_key}
-        and C{foreign_key} might also be used.
+        @param info: The L{RelationshipInfo} of the relationship, which is shared by every
+        instance of the class.
         """
-        self.infl = Inflector()
         self.inst = inst
+        self.info = info
+        self.propname = info.name
         self.dbconfig = Registry.getConfig()
+        self.args = info.args
 
-        self.args = {
-            'class_name': propname,
-            'association_foreign_key': self.infl.foreignKey(self.infl.singularize(propname)),
-            'foreign_key': self.infl.foreignKey(self.inst.__class__.__name__),
-            'polymorphic': False
-        }
-        self.args.update(givenargs)
-
-        otherklassname = self.infl.classify(self.args['class_name'])
-        if not self.args['polymorphic']:
-            self.otherklass = Registry.getClass(otherklassname)
-        self.othername = self.args['association_foreign_key']
+        if not info.polymorphic:
+            self.otherklass = info.otherklass
+        self.othername = info.othername
         self.thisclass = self.inst.__class__
-        self.thisname = self.args['foreign_key']
+        self.thisname = info.thisname
+
+
+    @classmethod
+    def joinsFor(klass, dbklass, info):
+        """
+        Get the joins that add the objects of a relationship to a select of instances of
+        C{dbklass} (see the C{joins} parameter of L{DBObject.find}).  The other class's table
+        is aliased as the relationship name.  By default, the other class's table references
+        C{dbklass}'s, as in L{HasMany} and L{HasOne}.
+
+        @param info: The L{RelationshipInfo} of the relationship.
+
+        @return: A C{list} of join clauses in the same form as the C{where} parameter in
+        L{DBObject.find}.
+        """
+        othertable = info.otherklass.tablename()
+        alias, this = joinAlias(othertable, info.name), dbklass.tablename()
+        if 'as' in info.args:
+            poly = info.args['as']
+            on = "%s.%s_id = %s.id AND %s.%s_type = ?" % (alias, poly, this, alias, poly)
+            return [joinClause(othertable, alias, [on, dbklass.__name__])]
+        on = "%s.%s = %s.id" % (alias, info.thisname, this)
+        return [joinClause(othertable, alias, [on])]
+
+
+    @classmethod
+    def columnsFor(klass, info):
+        """
+        Get the columns a relationship relies on, for L{RelationshipInfo.check}.  By default,
+        these are the foreign key columns of the other class's table, as in L{HasMany} and
+        L{HasOne}.
+
+        @return: A C{dict} mapping table names to C{list}s of column names.
+        """
+        if 'as' in info.args:
+            return {info.otherklass.tablename(): ["%s_id" % info.args['as'], "%s_type" % info.args['as']]}
+        return {info.otherklass.tablename(): [info.thisname]}
+
+
+    def _ids(self, others):
+        """
+        Get the ids of the given objects, which must have been saved.
+        """
+        for other in others:
+            if other.id is None:
+                msg = "You must save all other instances before defining a relationship"
+                raise ReferenceNotSavedError(msg)
+        return [other.id for other in others]
+
+
+    def _narrow(self, query):
+        """
+        Add the conditions of this relationship to a L{Query<twistar.query.Query>} for the
+        other class.
+        """
+        if not issubclass(query.klass, self.otherklass):
+            raise ValueError("A query for %s can't be used for %s" % (query.klass.__name__, self.otherklass.__name__))
+        return query.where(self._generateGetArgs({})['where'])
+
+
+    def _cachedCount(self, kwargs):
+        """
+        Get the value of this relationship's counter cache, if it has one that can answer
+        a C{count} with the given arguments.  This is the counter as it was loaded with the
+        instance (or last set through this relationship), so it doesn't see other objects
+        saved or deleted since.
+        """
+        if 'counter_cache' not in self.args or len(kwargs) > 0:
+            return None
+        return getattr(self.inst, self.args['counter_cache'], None)
 
 
 class BelongsTo(Relationship):
@@ -59,6 +121,25 @@ class BelongsTo(Relationship):
     Class representing a belongs-to relationship.
     """
 
+    @classmethod
+    def joinsFor(klass, dbklass, info):
+        if info.polymorphic:
+            msg = "The relationship %s in class %s is polymorphic and can't be joined"
+            raise InvalidRelationshipError(msg % (info.name, dbklass.__name__))
+        othertable = info.otherklass.tablename()
+        alias = joinAlias(othertable, info.name)
+        on = "%s.id = %s.%s" % (alias, dbklass.tablename(), info.othername)
+        return [joinClause(othertable, alias, [on])]
+
+
+    @classmethod
+    def columnsFor(klass, info):
+        if info.polymorphic:
+            name = info.args['class_name']
+            return {info.klass.tablename(): ["%s_id" % name, "%s_type" % name]}
+        return {info.klass.tablename(): [info.othername], info.otherklass.tablename(): ['id']}
+
+
     def get(self):
         """
         Get the object that belong to the caller.
@@ -66,24 +147,79 @@ class BelongsTo(Relationship):
         @return: A C{Deferred} with a callback value of either the matching class or
         None (if not set).
         """
-        def get_polymorphic(row):
-            kid = getattr(row, "%s_id" % self.args['class_name'])
-            kname = getattr(row, "%s_type" % self.args['class_name'])
+        if self.info.polymorphic:
+            kname, kid = self.target(self.inst, self.info)
+            if kid is None:
+                return defer.succeed(None)
             return Registry.getClass(kname).find(kid)
 
-        if self.args['polymorphic']:
-            return self.inst.find(where=["id = ?", self.inst.id], limit=1).addCallback(get_polymorphic)
-
         return self.otherklass.find(where=["id = ?", getattr(self.inst, self.othername)], limit=1)
 
 
+    @classmethod
+    def target(klass, obj, info):
+        """
+        Get the name of the class and the id of the object that the given object belongs
+        to, from the object's own attributes.
+
+        @param info: The L{RelationshipInfo} of the relationship.
+
+        @return: A C{tuple} of the class name and the id, or C{(None, None)} if either isn't set.
+        """
+        if info.polymorphic:
+            kname = getattr(obj, "%s_type" % info.args['class_name'], None)
+            kid = getattr(obj, "%s_id" % info.args['class_name'], None)
+        else:
+            kname = info.otherklassname
+            kid = getattr(obj, info.othername, None)
+        if kname is None or kid is None:
+            return (None, None)
+        return (kname, kid)
+
+
+    @classmethod
+    def getMany(klass, objs, info):
+        """
+        Get the objects that each of the given objects belongs to, with one query per class
+        of the objects they belong to (or one per chunk of ids, for many of them; see
+        L{InteractionBase.selectIn<twistar.dbconfig.base.InteractionBase.selectIn>}).  For
+        polymorphic relationships, the objects are grouped by their C{_type}.
+
+        @param info: The L{RelationshipInfo} of the relationship.
+
+        @return: A C{Deferred} that fires with a C{list} of the objects that each of C{objs}
+        belongs to (or C{None}), in the same order.
+        """
+        targets = [klass.target(obj, info) for obj in objs]
+        byclass = {}
+        for kname, kid in targets:
+            if kid is not None:
+                byclass.setdefault(kname, set()).add(kid)
+
+        config = Registry.getConfig()
+        knames = sorted(byclass.keys())
+        ds = []
+        for kname in knames:
+            otherklass = Registry.getClass(kname)
+            d = config.selectIn(otherklass.tablename(), 'id', sorted(byclass[kname]), where=otherklass.liveWhere())
+            ds.append(d.addCallback(createInstances, otherklass.slottedClass()))
+
+        def _match(results):
+            found = {}
+            for kname, (_, others) in zip(knames, results):
+                for other in others:
+                    found[(kname, other.id)] = other
+            return [found.get(target) for target in targets]
+        return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True).addCallback(_match)
+
+
     def set(self, other):
         """
         Set the object that belongs to the caller.
 
         @return: A C{Deferred} with a callback value of the caller.
         """
-        if self.args['polymorphic']:
+        if self.info.polymorphic:
             setattr(self.inst, "%s_type" % self.args['class_name'], other.__class__.__name__)
         setattr(self.inst, self.othername, other.id)
         return self.inst.save()
@@ -104,24 +240,38 @@ class HasMany(Relationship):
     """
     A class representing the has many relationship.
     """
+    TO_MANY = True
 
-    def get(self, **kwargs):
+    def get(self, query=None, **kwargs):
         """
         Get the objects that caller has.
 
+        @param query: An optional L{Query<twistar.query.Query>} for the other class, such as
+        C{Picture.where(size__gt=10).order('name')}, to narrow the objects with.
+
         @param kwargs: These could include C{limit}, C{orderby}, or any others included in
         C{DBObject.find}.  If a C{where} parameter is included, the conditions will
         be added to the ones already imposed by default in this method.
 
         @return: A C{Deferred} with a callback value of a list of objects.
         """
+        if query is not None:
+            return self._narrow(query).find()
         kwargs = self._generateGetArgs(kwargs)
         return self.otherklass.find(**kwargs)
 
 
-    def count(self, **kwargs):
+    def count(self, query=None, **kwargs):
         """
-        Get the number of objects that caller has.
+        Get the number of objects that caller has.  If the relationship has a
+        C{counter_cache} (see L{CounterCache}) and no arguments are given, the
+        counter is used rather than querying the database.  The counter is read from the
+        caller as it was loaded (and as updated by this relationship's own changes), so
+        objects saved or deleted directly since then aren't reflected until the caller is
+        refreshed (see L{DBObject.refresh}).
+
+        @param query: An optional L{Query<twistar.query.Query>} for the other class to
+        narrow the objects with.
 
         @param kwargs: These could include C{limit}, C{orderby}, or any others included in
         C{DBObject.find}.  If a C{where} parameter is included, the conditions will
@@ -129,10 +279,29 @@ class HasMany(Relationship):
 
         @return: A C{Deferred} with the number of objects.
         """
+        if query is not None:
+            return self._narrow(query).count()
+        cached = self._cachedCount(kwargs)
+        if cached is not None:
+            return defer.succeed(cached)
         kwargs = self._generateGetArgs(kwargs)
         return self.otherklass.count(**kwargs)
 
 
+    def aggregate(self, **kwargs):
+        """
+        Compute aggregates over the objects that caller has in the database.
+
+        @param kwargs: The same as for L{DBObject.aggregate}.  If a C{where} parameter is
+        included, the conditions will be added to the ones already imposed by default in
+        this method.
+
+        @return: A C{Deferred} with the results.
+        """
+        kwargs = self._generateGetArgs(kwargs)
+        return self.otherklass.aggregate(**kwargs)
+
+
     def _generateGetArgs(self, kwargs):
         if 'as' in self.args:
             w = "%s_id = ? AND %s_type = ?" % (self.args['as'], self.args['as'])
@@ -160,35 +329,91 @@ class HasMany(Relationship):
         return defer.DeferredList(ds)
 
 
-    def _update(self, _, others):
-        tablename = self.otherklass.tablename()
-        args = {self.thisname: self.inst.id}
-        ids = []
+    def _remove_polymorphic(self, others):
+        ds = []
         for other in others:
-            if other.id is None:
-                msg = "You must save all other instances before defining a relationship"
-                raise ReferenceNotSavedError(msg)
-            ids.append(str(other.id))
-        where = ["id IN (%s)" % ",".join(ids)]
-        return self.dbconfig.update(tablename, args, where)
+            setattr(other, "%s_id" % self.args['as'], None)
+            setattr(other, "%s_type" % self.args['as'], None)
+            ds.append(other.save())
+        return defer.DeferredList(ds)
+
+
+    def _change(self, addids, removeids=None):
+        """
+        In a single transaction, read the ids of the objects the caller has and then only
+        write the foreign keys of those to remove and of the new ones.
+
+        @param removeids: The ids of the objects to remove.  If C{None}, all objects whose
+        ids aren't in C{addids} are removed.
+        """
+        tablename = self.otherklass.tablename()
+        counted = any(counter.foreignkey == self.thisname for counter in CounterCache.counting(tablename))
+
+        def _change(txn):
+            where = self.otherklass.liveWhere(["%s = ?" % self.thisname, self.inst.id])
+            rows = self.dbconfig.select(tablename, where=where, select="id", txn=txn)
+            current = set([row['id'] for row in rows])
+            if removeids is None:
+                removed = sorted(current.difference(addids))
+            else:
+                removed = sorted(current.intersection(removeids))
+            added = sorted(set(addids).difference(current))
+
+            # the objects may be taken from others that count them
+            previous = []
+            if counted and len(added) > 0:
+                rows = self.dbconfig.selectIn(tablename, 'id', added, select=self.thisname, txn=txn)
+                previous = [row[self.thisname] for row in rows]
+            for where in self.dbconfig.whereIn('id', removed):
+                self.dbconfig.update(tablename, {self.thisname: None}, where=where, txn=txn)
+            for where in self.dbconfig.whereIn('id', added):
+                self.dbconfig.update(tablename, {self.thisname: self.inst.id}, where=where, txn=txn)
+            if counted:
+                CounterCache.update(tablename, {self.thisname: [self.inst.id]}, {self.thisname: previous}, txn)
+            return len(current) - len(removed) + len(added)
+
+        def _setCounter(total):
+            setattr(self.inst, self.args['counter_cache'], total)
+
+        d = self.dbconfig.runInteraction(_change)
+        if counted and 'counter_cache' in self.args:
+            d.addCallback(_setCounter)
+        return d
 
 
     def set(self, others):
         """
-        Set the objects that caller has.
+        Set the objects that caller has.  Only the objects that are no longer had and those
+        that are newly had are written, in a single transaction.
 
         @return: A C{Deferred}.
         """
         if 'as' in self.args:
             return self._set_polymorphic(others)
+        return self._change(self._ids(others))
 
-        tablename = self.otherklass.tablename()
-        args = {self.thisname: None}
-        where = ["%s = ?" % self.thisname, self.inst.id]
-        d = self.dbconfig.update(tablename, args, where)
-        if len(others) > 0:
-            d.addCallback(self._update, others)
-        return d
+
+    def add(self, others):
+        """
+        Add to the objects that caller has.
+
+        @return: A C{Deferred}.
+        """
+        if 'as' in self.args:
+            return self._set_polymorphic(others)
+        return self._change(self._ids(others), [])
+
+
+    def remove(self, others):
+        """
+        Remove from the objects that caller has.  Objects that the caller doesn't have
+        are left alone.
+
+        @return: A C{Deferred}.
+        """
+        if 'as' in self.args:
+            return self._remove_polymorphic(others)
+        return self._change([], self._ids(others))
 
 
     def clear(self):
@@ -229,6 +454,22 @@ class HABTM(Relationship):
     A class representing the "has and belongs to many" relationship.  One additional argument
     this class uses in the L{Relationship.__init__} argument list is C{join_table}.
     """
+    TO_MANY = True
+
+    @classmethod
+    def joinsFor(klass, dbklass, info):
+        jointable, othertable = info.jointable, info.otherklass.tablename()
+        alias = joinAlias(othertable, info.name)
+        return [
+            joinClause(jointable, jointable, ["%s.%s = %s.id" % (jointable, info.thisname, dbklass.tablename())]),
+            joinClause(othertable, alias, ["%s.id = %s.%s" % (alias, jointable, info.othername)])
+        ]
+
+
+    @classmethod
+    def columnsFor(klass, info):
+        return {info.jointable: [info.thisname, info.othername], info.otherklass.tablename(): ['id']}
+
 
     def tablename(self):
         """
@@ -238,23 +479,16 @@ class HABTM(Relationship):
         For instance, given the classes C{Teacher} and C{Student}, the resulting table name would
         be C{student_teacher}.
         """
-        # if specified by user
-        if 'join_table' in self.args:
-            return self.args['join_table']
+        return self.info.jointable
 
-        # otherwise, create and cache
-        if not hasattr(self, '_tablename'):
-            thistable = self.infl.tableize(self.thisclass.__name__)
-            othertable = self.infl.tableize(self.otherklass.__name__)
-            tables = [thistable, othertable]
-            tables.sort()
-            self._tablename = "_".join(tables)
-        return self._tablename
 
-
-    def get(self, **kwargs):
+    def get(self, query=None, **kwargs):
         """
-        Get the objects that caller has.
+        Get the objects that caller has.  The join table is consulted in a subquery, so
+        this is a single query.
+
+        @param query: An optional L{Query<twistar.query.Query>} for the other class, such as
+        C{FavoriteColor.where(name__like='r%')}, to narrow the objects with.
 
         @param kwargs: These could include C{limit}, C{orderby}, or any others included in
         C{InteractionBase.select}.  If a C{where} parameter is included, the conditions will
@@ -263,72 +497,138 @@ class HABTM(Relationship):
 
         @return: A C{Deferred} with a callback value of a list of objects.
         """
-        def _get(rows):
-            if len(rows) == 0:
-                return defer.succeed([])
-            ids = [str(row[self.othername]) for row in rows]
-            where = ["id IN (%s)" % ",".join(ids)]
-            if 'where' in kwargs:
-                kwargs['where'] = joinWheres(where, kwargs['where'])
-            else:
-                kwargs['where'] = where
-            d = self.dbconfig.select(self.otherklass.tablename(), **kwargs)
-            return d.addCallback(createInstances, self.otherklass)
-
-        tablename = self.tablename()
-        where = ["%s = ?" % self.thisname, self.inst.id]
-        if 'join_where' in kwargs:
-            where = joinWheres(where, kwargs.pop('join_where'))
-        return self.dbconfig.select(tablename, where=where).addCallback(_get)
+        if query is not None:
+            return self._narrow(query).find()
+        kwargs = self._generateGetArgs(kwargs)
+        kwargs['where'] = self.otherklass.liveWhere(kwargs['where'])
+        d = self.dbconfig.select(self.otherklass.tablename(), **kwargs)
+        return d.addCallback(lambda props: createInstances(props, self.otherklass.slottedClass()))
 
 
-    def count(self, **kwargs):
+    def count(self, query=None, **kwargs):
         """
-        Get the number of objects that caller has.
+        Get the number of objects that caller has.  If the relationship has a
+        C{counter_cache} (see L{CounterCache}) and no arguments are given, the
+        counter is used rather than querying the database.  The counter is read from the
+        caller as it was loaded (and as updated by this relationship's own changes), so
+        objects saved or deleted directly since then aren't reflected until the caller is
+        refreshed (see L{DBObject.refresh}).
 
-        @param kwargs: These could include C{limit}, C{orderby}, or any others included in
-        C{InteractionBase.select}.  If a C{where} parameter is included, the conditions will
-        be added to the ones already imposed by default in this method.
+        @param query: An optional L{Query<twistar.query.Query>} for the other class to
+        narrow the objects with.
+
+        @param kwargs: A C{where} parameter, whose conditions will be added to the ones
+        already imposed by default in this method, and C{join_where}, which will be
+        applied to the join table.
 
         @return: A C{Deferred} with the number of objects.
         """
-        def _get(rows):
-            if len(rows) == 0:
-                return defer.succeed(0)
-            if 'where' not in kwargs:
-                return defer.succeed(len(rows))
-            ids = [str(row[self.othername]) for row in rows]
-            where = ["id IN (%s)" % ",".join(ids)]
-            if 'where' in kwargs:
-                where = joinWheres(where, kwargs['where'])
-            return self.dbconfig.count(self.otherklass.tablename(), where=where)
+        if query is not None:
+            return self._narrow(query).count()
+        cached = self._cachedCount(kwargs)
+        if cached is not None:
+            return defer.succeed(cached)
+        kwargs = self._generateGetArgs(kwargs)
+        return self.dbconfig.count(self.otherklass.tablename(), where=self.otherklass.liveWhere(kwargs['where']))
+
+
+    def aggregate(self, **kwargs):
+        """
+        Compute aggregates over the objects that caller has in the database.  The
+        join table is consulted in a subquery, so this is a single query.
+
+        @param kwargs: The same as for L{DBObject.aggregate}.  If a C{where} parameter is
+        included, the conditions will be added to the ones already imposed by default in
+        this method.  The argument C{join_where} will be applied to the join table, if provided.
+
+        @return: A C{Deferred} with the results.
+        """
+        kwargs = self._generateGetArgs(kwargs)
+        return self.otherklass.aggregate(**kwargs)
+
+
+    def _generateGetArgs(self, kwargs):
+        joinwhere = ["%s = ?" % self.thisname, self.inst.id]
+        if 'join_where' in kwargs:
+            joinwhere = joinWheres(joinwhere, kwargs.pop('join_where'))
+        subquery = "SELECT %s FROM %s WHERE %s" % (self.othername, self.tablename(), joinwhere[0])
+        where = ["id IN (%s)" % subquery] + joinwhere[1:]
+        if 'where' in kwargs:
+            where = joinWheres(where, kwargs['where'])
+        kwargs['where'] = where
+        return kwargs
 
+
+    def _change(self, addids, removeids=None):
+        """
+        In a single transaction, read the ids of the objects the caller has and then
+        only delete the join rows of those to remove and insert those of the new ones.
+
+        @param removeids: The ids of the objects to remove.  If C{None}, all objects whose
+        ids aren't in C{addids} are removed.
+        """
         tablename = self.tablename()
         where = ["%s = ?" % self.thisname, self.inst.id]
-        return self.dbconfig.select(tablename, where=where).addCallback(_get)
+        counted = len(CounterCache.counting(tablename)) > 0
 
-
-    def _set(self, _, others):
-        args = []
-        for other in others:
-            if other.id is None:
-                msg = "You must save all other instances before defining a relationship"
-                raise ReferenceNotSavedError(msg)
-            args.append({self.thisname: self.inst.id, self.othername: other.id})
-        return self.dbconfig.insertMany(self.tablename(), args)
+        def _change(txn):
+            rows = self.dbconfig.select(tablename, where=where, select=self.othername, txn=txn)
+            current = set([row[self.othername] for row in rows])
+            if removeids is None:
+                removed = sorted(current.difference(addids))
+            else:
+                removed = sorted(current.intersection(removeids))
+            added = []
+            for id in addids:
+                if id not in current and id not in added:
+                    added.append(id)
+
+            for removewhere in self.dbconfig.whereIn(self.othername, removed):
+                self.dbconfig.delete(tablename, where=joinWheres(where, removewhere), txn=txn)
+            vals = [{self.thisname: self.inst.id, self.othername: id} for id in added]
+            chunksize = self.dbconfig.MAX_IN_PARAMS // 2
+            for index in range(0, len(vals), chunksize):
+                self.dbconfig.insertMany(tablename, vals[index:index + chunksize], txn=txn)
+            if counted and len(removed + added) > 0:
+                CounterCache.update(tablename, {self.thisname: [self.inst.id], self.othername: removed + added}, txn=txn)
+            return len(current) - len(removed) + len(added)
+
+        def _setCounter(total):
+            setattr(self.inst, self.args['counter_cache'], total)
+
+        d = self.dbconfig.runInteraction(_change)
+        if counted and 'counter_cache' in self.args:
+            d.addCallback(_setCounter)
+        return d
 
 
     def set(self, others):
         """
-        Set the objects that caller has.
+        Set the objects that caller has.  Only the join rows of objects that are no longer
+        had are deleted and only those of newly had objects are inserted, in a single
+        transaction.
 
         @return: A C{Deferred}.
         """
-        where = ["%s = ?" % self.thisname, self.inst.id]
-        d = self.dbconfig.delete(self.tablename(), where=where)
-        if len(others) > 0:
-            d.addCallback(self._set, others)
-        return d
+        return self._change(self._ids(others))
+
+
+    def add(self, others):
+        """
+        Add to the objects that caller has.  Objects the caller already has aren't added again.
+
+        @return: A C{Deferred}.
+        """
+        return self._change(self._ids(others), [])
+
+
+    def remove(self, others):
+        """
+        Remove from the objects that caller has.
+
+        @return: A C{Deferred}.
+        """
+        return self._change([], self._ids(others))
 
 
     def clear(self):
@@ -338,4 +638,297 @@ class HABTM(Relationship):
         return self.set([])
 
 
+def relationshipArgs(infl, dbklass, propname, givenargs):
+    """
+    Get the arguments of a relationship of the given class, with defaults filled in for
+    the ones that weren't given.
+    """
+    args = {
+        'class_name': propname,
+        'association_foreign_key': infl.foreignKey(infl.singularize(propname)),
+        'foreign_key': infl.foreignKey(dbklass.__name__),
+        'polymorphic': False
+    }
+    args.update(givenargs)
+    return args
+
+
+def joinAlias(tablename, name):
+    """
+    Get the alias of a table joined for the relationship with the given name: the
+    relationship name, escaped for the database, or C{tablename} if they're the same.
+    """
+    if name == tablename:
+        return tablename
+    return Registry.getConfig().escapeColNames([name])[0]
+
+
+def joinClause(tablename, alias, on):
+    """
+    Get an C{INNER JOIN} of a table (aliased, unless the alias is the table name) on the
+    given conditional, in the same form as the C{where} parameter in L{DBObject.find}.
+    """
+    if alias != tablename:
+        tablename = "%s AS %s" % (tablename, alias)
+    return ["INNER JOIN %s ON %s" % (tablename, on[0])] + on[1:]
+
+
+class RelationshipInfo(object):
+    """
+    The metadata of a relationship of a L{DBObject} class: its arguments with defaults filled
+    in, foreign keys, the name of the other class and (for L{HABTM}) the join table.  It's
+    resolved once per class, when the class is registered (or first used), and is shared by
+    every access of the relationship, eager loaders and joins.  It can't be changed.
+
+    @ivar klass: The class the relationship is defined in.
+    @ivar name: The name of the relationship.
+    @ivar relationshipKlass: The L{Relationship} subclass of the relationship.
+    @ivar args: The relationship arguments (see L{relationshipArgs}).
+    @ivar polymorphic: Whether the relationship is a polymorphic L{BelongsTo}.
+    @ivar otherklassname: The name of the other class (C{None} if C{polymorphic}).
+    @ivar othername: The C{association_foreign_key}.
+    @ivar thisname: The C{foreign_key}.
+    @ivar jointable: The join table of a L{HABTM} relationship (C{None} for others).
+    @ivar dependent: What happens to the objects of a L{HasMany} or L{HasOne} relationship
+    when the object that has them is deleted with cascading (see L{DBObject.deleteWhere}):
+    C{'delete'} deletes them, C{'nullify'} sets their foreign keys to C{NULL}, and C{None}
+    (the default) leaves them alone.
+    @ivar counter: The L{CounterCache} of a L{HasMany} or L{HABTM} relationship with a
+    C{counter_cache} option, or C{None}.
+
+    @cvar DEPENDENT: The possible values of C{dependent}.
+    """
+    __slots__ = ('klass', 'name', 'relationshipKlass', 'args', 'polymorphic', 'otherklassname',
+                 'othername', 'thisname', 'jointable', 'dependent', 'counter')
+    DEPENDENT = (None, 'delete', 'nullify')
+
+    def __init__(self, klass, name, relationshipKlass, givenargs):
+        infl = Inflector()
+        args = relationshipArgs(infl, klass, name, givenargs)
+        polymorphic = bool(args['polymorphic'])
+        otherklassname = None if polymorphic else infl.classify(args['class_name'])
+        jointable = None
+        if relationshipKlass is HABTM:
+            jointable = args.get('join_table') or joinTablename(infl, klass.__name__, otherklassname)
+        dependent = args.get('dependent')
+        if dependent not in self.DEPENDENT or (dependent is not None and relationshipKlass not in (HasMany, HasOne)):
+            msg = "The relationship %s in class %s can't have dependent=%r"
+            raise InvalidRelationshipError(msg % (name, klass.__name__, dependent))
+        values = {
+            'klass': klass,
+            'name': name,
+            'relationshipKlass': relationshipKlass,
+            'args': args,
+            'polymorphic': polymorphic,
+            'otherklassname': otherklassname,
+            'othername': args['association_foreign_key'],
+            'thisname': args['foreign_key'],
+            'jointable': jointable,
+            'dependent': dependent,
+            'counter': None
+        }
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+        if 'counter_cache' in args and relationshipKlass in (HasMany, HABTM):
+            object.__setattr__(self, 'counter', CounterCache(self))
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Relationship metadata can't be changed")
+
+
+    @property
+    def otherklass(self):
+        """
+        The other class of the relationship (looked up in the L{Registry}).
+
+        @raise ClassNotRegisteredError: If the class isn't registered.
+        """
+        return Registry.getClass(self.otherklassname)
+
+
+    def check(self):
+        """
+        Check that the other class of the relationship is registered and that the tables
+        and columns it relies on exist.
+
+        @return: A C{Deferred} that fires with a C{list} of problems (C{str}s), which is
+        empty if there are none.
+        """
+        where = "The relationship %s in class %s" % (self.name, self.klass.__name__)
+        try:
+            columns = self.relationshipKlass.columnsFor(self)
+        except Exception as e:
+            return defer.succeed(["%s: %s" % (where, e)])
+
+        config = Registry.getConfig()
+        tablenames = sorted(columns.keys())
+
+        def _check(results):
+            problems = []
+            for tablename, (success, schema) in zip(tablenames, results):
+                if not success:
+                    problems.append("%s needs the table %s, which doesn't exist" % (where, tablename))
+                    continue
+                for column in columns[tablename]:
+                    if column not in schema:
+                        problems.append("%s needs the column %s of the table %s" % (where, column, tablename))
+            return problems
+        ds = [config.runInteraction(lambda txn, tablename: config.getSchema(tablename, txn), tablename)
+              for tablename in tablenames]
+        return defer.DeferredList(ds, consumeErrors=True).addCallback(_check)
+
+
+    def __repr__(self):
+        return "<RelationshipInfo %s.%s (%s)>" % (self.klass.__name__, self.name, self.relationshipKlass.__name__)
+
+
+def joinTablename(infl, thisname, othername):
+    """
+    Get the default name of the join table of a L{HABTM} relationship between the
+    classes with the given names: the sorted table name versions of the two class
+    names joined with a '_'.
+    """
+    tables = [infl.tableize(thisname), infl.tableize(othername)]
+    tables.sort()
+    return "_".join(tables)
+
+
+class CounterCache(object):
+    """
+    A column counting the objects that a L{HasMany} or L{HABTM} relationship has, given
+    by the C{counter_cache} relationship option.  For instance, if C{User} has
+    C{HASMANY = [{'name': 'pictures', 'counter_cache': 'pictures_count'}]} then the
+    C{pictures_count} column of the C{users} table is kept up to date when pictures are
+    created, deleted or moved to another user (through C{save}, C{delete} or the C{set} and
+    C{clear} methods of relationships), and C{user.pictures.count()} just reads it.
+    Counters are recounted from the counted table rather than incremented, so one that has
+    drifted (for instance, after L{DBObject.deleteAll}) is fixed on the next change or by
+    L{DBObject.recountCounters}.  Polymorphic relationships can't have a counter cache.
+    Objects of a L{HasMany} relationship that are marked as deleted (see
+    L{DBObject.SOFT_DELETE}) aren't counted.
+
+    Counters are built once per class, from the L{RelationshipInfo} of their relationship,
+    and are looked up by the table they count (see L{counting}).
+
+    @ivar info: The L{RelationshipInfo} of the relationship.
+    @ivar klass: The class with the counter column.
+    @ivar name: The name of the relationship.
+    @ivar column: The name of the counter column.
+    @ivar foreignkey: The column of C{tablename} referencing C{klass}.
+    """
+
+    def __init__(self, info):
+        if 'as' in info.args or info.polymorphic:
+            msg = "The relationship %s in class %s is polymorphic and can't have a counter cache"
+            raise InvalidRelationshipError(msg % (info.name, info.klass.__name__))
+        self.info = info
+        self.klass = info.klass
+        self.name = info.name
+        self.column = info.args['counter_cache']
+        self.foreignkey = info.thisname
+
+
+    @property
+    def tablename(self):
+        """
+        The table whose rows are counted: the other class's table for L{HasMany} and the
+        join table for L{HABTM}.
+
+        @raise ClassNotRegisteredError: If the other class of a L{HasMany} relationship
+        isn't registered.
+        """
+        if self.info.jointable is not None:
+            return self.info.jointable
+        return self.info.otherklass.tablename()
+
+
+    @property
+    def condition(self):
+        """
+        An optional conditional the counted rows must match.
+        """
+        if self.info.jointable is not None:
+            return None
+        return self.info.otherklass.liveWhere()
+
+
+    @classmethod
+    def definedBy(klass, dbklass):
+        """
+        Get the counter caches of the relationships of the given class.
+
+        @return: A C{list} of L{CounterCache}s.
+        """
+        cache = dbklass.relationshipCache()
+        return [cache[name].counter for name in sorted(cache.keys()) if cache[name].counter is not None]
+
+
+    @classmethod
+    def counting(klass, tablename):
+        """
+        Get the counter caches of all registered classes that count rows of the given table.
+        They are indexed by table once, and again after classes are registered (see
+        L{Registry.COUNTERS<twistar.registry.Registry.COUNTERS>}).  A counter whose other
+        class isn't registered yet is left out until it is.
+
+        @return: A C{list} of L{CounterCache}s.
+        """
+        index = Registry.COUNTERS
+        if index is None or index[0] is not Registry.REGISTRATION:
+            counters = {}
+            for dbklass in list(Registry.REGISTRATION.values()):
+                if not hasattr(dbklass, 'relationshipCache'):
+                    continue
+                for counter in klass.definedBy(dbklass):
+                    try:
+                        counters.setdefault(counter.tablename, []).append(counter)
+                    except ClassNotRegisteredError:
+                        pass
+            index = Registry.COUNTERS = (Registry.REGISTRATION, counters)
+        return index[1].get(tablename, [])
+
+
+    @classmethod
+    def update(klass, tablename, ids, previous=None, txn=None):
+        """
+        Bring the counter caches counting rows of the given table up to date for the
+        objects referenced by rows that changed.
+
+        @param ids: A C{dict} mapping columns of C{tablename} to C{list}s of the ids
+        the changed rows now hold.
+
+        @param previous: An optional C{dict} of the same form with the ids they held before.
+
+        @param txn: If given, the counters are recounted in this transaction.
+
+        @return: A C{Deferred}, or C{None} if C{txn} is given.
+        """
+        previous = previous or {}
+        ds = []
+        for counter in klass.counting(tablename):
+            changed = ids.get(counter.foreignkey, []) + previous.get(counter.foreignkey, [])
+            ds.append(counter.recount(changed, txn))
+        if txn is None:
+            return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+
+
+    def recount(self, ids=None, txn=None):
+        """
+        Recount the counter for the objects with the given ids (or for all of them).
+
+        @param txn: If given, the counter is recounted in this transaction.
+
+        @return: A C{Deferred}, or C{None} if C{txn} is given.
+        """
+        config = Registry.getConfig()
+        wheres = [None]
+        if ids is not None:
+            wheres = config.whereIn('id', sorted(set([id for id in ids if id is not None])))
+        ds = [config.recount(self.klass.tablename(), self.column, self.tablename, self.foreignkey, where,
+                             txn=txn, condition=self.condition) for where in wheres]
+        if txn is None:
+            return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+
+
 Relationship.TYPES = {'HASMANY': HasMany, 'HASONE': HasOne, 'BELONGSTO': BelongsTo, 'HABTM': HABTM}
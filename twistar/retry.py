@@ -0,0 +1,168 @@
+"""
+Module for retrying interactions that fail with transient errors, like deadlocks.
+"""
+
+from __future__ import absolute_import
+import random
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from twistar.exceptions import TransactionError
+
+
+def originalError(error):
+    """
+    Get the error a L{TransactionError} was raised for (or the given error, if it
+    isn't one).
+    """
+    while isinstance(error, TransactionError) and error.original is not None:
+        error = error.original
+    return error
+
+
+class RetryPolicy(object):
+    """
+    How to retry interactions that fail with a transient error, such as a deadlock or a
+    serialization failure.  The database rolls the transaction back in that case, and
+    running it again usually succeeds.  Which errors are transient depends on the
+    database; see L{InteractionBase.isTransientError<twistar.dbconfig.base.InteractionBase.isTransientError>}.
+
+    Each retry waits a random time between 0 and C{min(maximum, initial * 2 ** n)}
+    seconds, where C{n} is the number of retries so far.  The randomness keeps the
+    transactions that collided from colliding again.  Retries are also limited by a
+    budget: each call adds C{budget} to a reserve of at most C{reserve} retries, and each
+    retry takes one from it.  So over time there are at most C{budget} retries per call,
+    and a database that keeps failing doesn't get several times the load.
+
+    A policy is used for every interaction when it is set as
+    L{Registry.RETRY_POLICY<twistar.registry.Registry.RETRY_POLICY>}, and for a
+    L{transaction<twistar.utils.transaction>} when it is given as that decorator's C{retry}
+    argument.  The interactions must be safe to run again, which twistar's own are.  A
+    function decorated with C{transaction} is run again as a whole, so it shouldn't have
+    effects outside of the database.
+
+    @ivar attempts: The most times a call is made, including the first one.
+    @ivar initial: The delay limit in seconds before the first retry.
+    @ivar maximum: The largest delay limit in seconds.
+    @ivar budget: The number of retries each call adds to the reserve.
+    @ivar reserve: The most retries that can be saved up in the reserve.
+    """
+
+    def __init__(self, attempts=5, initial=0.01, maximum=1.0, budget=0.1, reserve=10, clock=None):
+        """
+        Constructor.
+
+        @param clock: The C{IReactorTime} used to wait between attempts.  Default is the
+        global reactor.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.attempts = attempts
+        self.initial = initial
+        self.maximum = maximum
+        self.budget = budget
+        self.reserve = reserve
+        self.clock = clock
+        self._tokens = float(reserve)
+        self._observers = []
+        self.resetStats()
+
+
+    def resetStats(self):
+        """
+        Clear all collected statistics.
+        """
+        self._counters = {'calls': 0, 'retries': 0, 'recovered': 0, 'exhausted': 0, 'over_budget': 0}
+
+
+    def stats(self):
+        """
+        Get the statistics of this policy.
+
+        @return: A C{dict} with the number of C{calls} made through the policy, the number
+        of C{retries}, the number of calls that succeeded after being retried
+        (C{recovered}), and the number of calls that failed with a transient error because
+        they had used all their attempts (C{exhausted}) or because the budget was spent
+        (C{over_budget}).
+        """
+        return dict(self._counters)
+
+
+    def addObserver(self, observer):
+        """
+        Add a function to be called with each retry and each call that fails with a
+        transient error without being retried.  It is called with the same three arguments
+        as the observers of L{StatsConnectionPool<twistar.pool.StatsConnectionPool>}: the name
+        of the event (C{'retry'}, C{'exhausted'} or C{'over_budget'}), a numeric value (the
+        delay before a retry, or 1) and a C{dict} of tags (the C{error} class name and the
+        C{attempt} that failed).
+        """
+        self._observers.append(observer)
+
+
+    def removeObserver(self, observer):
+        """
+        Remove a function previously added with L{addObserver}.
+        """
+        self._observers.remove(observer)
+
+
+    def _record(self, name, value, tags):
+        self._counters['retries' if name == 'retry' else name] += 1
+        for observer in list(self._observers):
+            try:
+                observer(name, value, tags)
+            except Exception:
+                log.err(None, "Retry policy observer failed")
+
+
+    def delay(self, retries):
+        """
+        Get a random delay before a retry.
+
+        @param retries: The number of retries already made for the call.
+        """
+        return random.uniform(0, min(self.maximum, self.initial * 2 ** retries))
+
+
+    def run(self, func, isTransient):
+        """
+        Call C{func} and call it again if it fails with a transient error.
+
+        @param func: A function taking no arguments and returning a C{Deferred}.
+
+        @param isTransient: A function taking an exception and returning True if it's
+        transient.  It is given the original error of a L{TransactionError}.
+
+        @return: A C{Deferred} that fires with the result of the last call of C{func}.
+        """
+        self._counters['calls'] += 1
+        self._tokens = min(self._tokens + self.budget, self.reserve)
+
+        def _attempt(attempt):
+            d = defer.maybeDeferred(func)
+            return d.addCallbacks(_succeeded, _failed, callbackArgs=(attempt,), errbackArgs=(attempt,))
+
+        def _succeeded(result, attempt):
+            if attempt > 1:
+                self._counters['recovered'] += 1
+            return result
+
+        def _failed(failure, attempt):
+            error = originalError(failure.value)
+            if not isTransient(error):
+                return failure
+            tags = {'error': error.__class__.__name__, 'attempt': attempt}
+            if attempt >= self.attempts:
+                self._record('exhausted', 1, tags)
+                return failure
+            if self._tokens < 1:
+                self._record('over_budget', 1, tags)
+                return failure
+            self._tokens -= 1
+            delay = self.delay(attempt - 1)
+            self._record('retry', delay, tags)
+            return task.deferLater(self.clock, delay, _attempt, attempt + 1)
+
+        return _attempt(1)
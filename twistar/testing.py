@@ -0,0 +1,86 @@
+"""
+Helpers for testing code that uses twistar with C{twisted.trial}.
+"""
+
+from __future__ import absolute_import
+
+from twistar.instrumentation import QueryRecorder
+
+
+def describeQueries(queries):
+    """
+    Get a readable, numbered list of the given L{Query<twistar.instrumentation.Query>}s
+    along with their timing and call sites.
+    """
+    lines = []
+    for index, query in enumerate(queries):
+        lines.append("%i. %s -- %r (%.4fs from %s)" % (index + 1, query.sql, query.args, query.elapsed, query.callsite))
+    return "\n".join(lines)
+
+
+class QueryAssertions(object):
+    """
+    A mixin for C{twisted.trial.unittest.TestCase} classes with assertions about the
+    statements run by a block of code.  Each assertion accepts a function (which may
+    return a C{Deferred}) and any arguments to call it with, and returns a C{Deferred}
+    that fires with the function's result or fails the test.  For instance::
+
+        class UserTest(QueryAssertions, unittest.TestCase):
+            def test_avatar(self):
+                return self.assertNumQueries(1, user.avatar.get)
+    """
+
+    def _recordQueries(self, func, args, kwargs, check):
+        recorder = QueryRecorder()
+
+        def _check(result):
+            check(recorder.queries)
+            return result
+        return recorder.watch(func, *args, **kwargs).addCallback(_check)
+
+
+    def assertNumQueries(self, num, func, *args, **kwargs):
+        """
+        Assert that calling C{func(*args, **kwargs)} runs exactly C{num} statements.
+
+        @return: A C{Deferred} that fires with the result of C{func}.
+        """
+        def _check(queries):
+            if len(queries) != num:
+                msg = "%i queries run, %i expected:\n%s" % (len(queries), num, describeQueries(queries))
+                self.fail(msg)
+        return self._recordQueries(func, args, kwargs, _check)
+
+
+    def assertMaxQueries(self, num, func, *args, **kwargs):
+        """
+        Assert that calling C{func(*args, **kwargs)} runs at most C{num} statements.
+
+        @return: A C{Deferred} that fires with the result of C{func}.
+        """
+        def _check(queries):
+            if len(queries) > num:
+                msg = "%i queries run, at most %i expected:\n%s" % (len(queries), num, describeQueries(queries))
+                self.fail(msg)
+        return self._recordQueries(func, args, kwargs, _check)
+
+
+    def assertMaxQueryTime(self, seconds, func, *args, **kwargs):
+        """
+        Assert that no statement run by C{func(*args, **kwargs)} takes longer than C{seconds}.
+        If a C{total} keyword argument is given (and isn't C{None}), the sum of the time taken
+        by all statements must also be no more than C{total} seconds; it isn't passed to C{func}.
+
+        @return: A C{Deferred} that fires with the result of C{func}.
+        """
+        total = kwargs.pop('total', None)
+
+        def _check(queries):
+            slow = [query for query in queries if query.elapsed > seconds]
+            if len(slow) > 0:
+                self.fail("%i queries took longer than %.4fs:\n%s" % (len(slow), seconds, describeQueries(slow)))
+            spent = sum([query.elapsed for query in queries])
+            if total is not None and spent > total:
+                self.fail("queries took %.4fs in total, at most %.4fs expected:\n%s" %
+                          (spent, total, describeQueries(queries)))
+        return self._recordQueries(func, args, kwargs, _check)
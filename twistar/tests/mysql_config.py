@@ -9,13 +9,16 @@ CONNECTION = Registry.DBPOOL = adbapi.ConnectionPool('MySQLdb', user="root", pas
 def initDB(testKlass):
     def runInitTxn(txn):
         txn.execute("""CREATE TABLE users (id INT AUTO_INCREMENT,
-                       first_name VARCHAR(255), last_name VARCHAR(255), age INT, dob DATE, PRIMARY KEY (id))""")
+                       first_name VARCHAR(255), last_name VARCHAR(255), age INT, dob DATE,
+                       pictures_count INT, favorite_colors_count INT, comments_count INT, PRIMARY KEY (id))""")
         txn.execute("""CREATE TABLE avatars (id INT AUTO_INCREMENT, name VARCHAR(255),
                        color VARCHAR(255), user_id INT, PRIMARY KEY (id))""")
         txn.execute("""CREATE TABLE pictures (id INT AUTO_INCREMENT, name VARCHAR(255),
-                       size INT, user_id INT, PRIMARY KEY (id))""")
+                       size INT, user_id INT, lock_version INT, PRIMARY KEY (id))""")
         txn.execute("""CREATE TABLE comments (id INT AUTO_INCREMENT, subject VARCHAR(255),
-                       body TEXT, user_id INT, PRIMARY KEY (id))""")
+                       body TEXT, user_id INT, parent_id INT, deleted_at DATETIME(6), PRIMARY KEY (id))""")
+        txn.execute("""CREATE TABLE comments_archive (id INT, subject VARCHAR(255),
+                       body TEXT, user_id INT, parent_id INT, deleted_at DATETIME(6), PRIMARY KEY (id))""")
         txn.execute("""CREATE TABLE favorite_colors (id INT AUTO_INCREMENT, name VARCHAR(255), PRIMARY KEY (id))""")
         txn.execute("""CREATE TABLE favorite_colors_users (favorite_color_id INT, user_id INT, palette_id INT)""")
         txn.execute("""CREATE TABLE coltests (id INT AUTO_INCREMENT, `select` VARCHAR(255), `where` VARCHAR(255), PRIMARY KEY (id))""")
@@ -29,7 +32,7 @@ def initDB(testKlass):
         txn.execute("""CREATE TABLE categories (id INT AUTO_INCREMENT,
                        name VARCHAR(255), PRIMARY KEY (id))""")
         txn.execute("""CREATE TABLE posts_categories (category_id INT, blogpost_id INT)""")
-        txn.execute("""CREATE TABLE transactions (id INT AUTO_INCREMENT, name VARCHAR(255), PRIMARY KEY (id), UNIQUE(name))""")
+        txn.execute("""CREATE TABLE transactions (id INT AUTO_INCREMENT, name VARCHAR(255), user_id INT, PRIMARY KEY (id), UNIQUE(name))""")
 
     return CONNECTION.runInteraction(runInitTxn)
 
@@ -40,6 +43,7 @@ def tearDownDB(self):
         txn.execute("DROP TABLE avatars")
         txn.execute("DROP TABLE pictures")
         txn.execute("DROP TABLE comments")
+        txn.execute("DROP TABLE comments_archive")
         txn.execute("DROP TABLE favorite_colors")
         txn.execute("DROP TABLE favorite_colors_users")
         txn.execute("DROP TABLE coltests")
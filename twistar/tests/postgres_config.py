@@ -9,13 +9,16 @@ CONNECTION = Registry.DBPOOL = adbapi.ConnectionPool('psycopg2', "dbname=twistar
 def initDB(testKlass):
     def runInitTxn(txn):
         txn.execute("""CREATE TABLE users (id SERIAL PRIMARY KEY,
-                       first_name VARCHAR(255), last_name VARCHAR(255), age INT, dob DATE)""")
+                       first_name VARCHAR(255), last_name VARCHAR(255), age INT, dob DATE,
+                       pictures_count INT, favorite_colors_count INT, comments_count INT)""")
         txn.execute("""CREATE TABLE avatars (id SERIAL PRIMARY KEY, name VARCHAR(255),
                        color VARCHAR(255), user_id INT)""")
         txn.execute("""CREATE TABLE pictures (id SERIAL PRIMARY KEY, name VARCHAR(255),
-                       size INT, user_id INT)""")
+                       size INT, user_id INT, lock_version INT)""")
         txn.execute("""CREATE TABLE comments (id SERIAL PRIMARY KEY, subject VARCHAR(255),
-                       body TEXT, user_id INT)""")
+                       body TEXT, user_id INT, parent_id INT, deleted_at TIMESTAMP)""")
+        txn.execute("""CREATE TABLE comments_archive (id INT PRIMARY KEY, subject VARCHAR(255),
+                       body TEXT, user_id INT, parent_id INT, deleted_at TIMESTAMP)""")
         txn.execute("""CREATE TABLE favorite_colors (id SERIAL PRIMARY KEY, name VARCHAR(255))""")
         txn.execute("""CREATE TABLE favorite_colors_users (favorite_color_id INT, user_id INT, palette_id INT)""")
         txn.execute("""CREATE TABLE coltests (id SERIAL PRIMARY KEY, "select" VARCHAR(255), "where" VARCHAR(255))""")
@@ -29,7 +32,7 @@ def initDB(testKlass):
         txn.execute("""CREATE TABLE categories (id SERIAL PRIMARY KEY,
                        name VARCHAR(255))""")
         txn.execute("""CREATE TABLE posts_categories (category_id INT, blogpost_id INT)""")
-        txn.execute("""CREATE TABLE transactions (id SERIAL PRIMARY KEY, name VARCHAR(255) UNIQUE)""")
+        txn.execute("""CREATE TABLE transactions (id SERIAL PRIMARY KEY, name VARCHAR(255) UNIQUE, user_id INT)""")
 
     return CONNECTION.runInteraction(runInitTxn)
 
@@ -47,6 +50,7 @@ def tearDownDB(self):
 
         txn.execute("DROP SEQUENCE comments_id_seq CASCADE")
         txn.execute("DROP TABLE comments")
+        txn.execute("DROP TABLE comments_archive")
 
         txn.execute("DROP SEQUENCE favorite_colors_id_seq CASCADE")
         txn.execute("DROP TABLE favorite_colors")
@@ -11,13 +11,16 @@ def initDB(testKlass):
 
     def runInitTxn(txn):
         txn.execute("""CREATE TABLE users (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                       first_name TEXT, last_name TEXT, age INTEGER, dob DATE)""")
+                       first_name TEXT, last_name TEXT, age INTEGER, dob DATE,
+                       pictures_count INTEGER, favorite_colors_count INTEGER, comments_count INTEGER)""")
         txn.execute("""CREATE TABLE avatars (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT,
                        color TEXT, user_id INTEGER)""")
         txn.execute("""CREATE TABLE pictures (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT,
-                       size INTEGER, user_id INTEGER)""")
+                       size INTEGER, user_id INTEGER, lock_version INTEGER)""")
         txn.execute("""CREATE TABLE comments (id INTEGER PRIMARY KEY AUTOINCREMENT, subject TEXT,
-                       body TEXT, user_id INTEGER)""")
+                       body TEXT, user_id INTEGER, parent_id INTEGER, deleted_at TIMESTAMP)""")
+        txn.execute("""CREATE TABLE comments_archive (id INTEGER PRIMARY KEY, subject TEXT,
+                       body TEXT, user_id INTEGER, parent_id INTEGER, deleted_at TIMESTAMP)""")
         txn.execute("""CREATE TABLE favorite_colors (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT)""")
         txn.execute("""CREATE TABLE favorite_colors_users (favorite_color_id INTEGER, user_id INTEGER, palette_id INTEGER)""")
         txn.execute("""CREATE TABLE coltests (id INTEGER PRIMARY KEY AUTOINCREMENT, `select` TEXT, `where` TEXT)""")
@@ -31,7 +34,7 @@ def initDB(testKlass):
         txn.execute("""CREATE TABLE categories (id INTEGER PRIMARY KEY AUTOINCREMENT,
                        name TEXT)""")
         txn.execute("""CREATE TABLE posts_categories (category_id INTEGER, blogpost_id INTEGER)""")
-        txn.execute("""CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, UNIQUE (name))""")
+        txn.execute("""CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT, user_id INTEGER, UNIQUE (name))""")
     return Registry.DBPOOL.runInteraction(runInitTxn)
 
 
@@ -4,6 +4,7 @@ from twisted.internet.defer import inlineCallbacks
 
 from twistar.registry import Registry
 from twistar.dbconfig.base import InteractionBase
+from twistar.dbconfig.postgres import PostgreSQLDBConfig
 
 from .utils import User, Picture, Avatar, initDB, tearDownDB, Coltest
 from six.moves import range
@@ -121,6 +122,68 @@ class DBConfigTest(unittest.TestCase):
                 self.assertEqual(value, getattr(users[counter], key))
 
 
+    def test_whereIn(self):
+        self.patch(self.dbconfig, 'MAX_IN_PARAMS', 2)
+        self.assertEqual(self.dbconfig.whereIn('id', []), [])
+        wheres = self.dbconfig.whereIn('id', [1, 2, 3])
+        if isinstance(self.dbconfig, PostgreSQLDBConfig):
+            self.assertEqual(wheres, [["id = ANY(?)", [1, 2, 3]]])
+        else:
+            self.assertEqual(wheres, [["id IN (?,?)", 1, 2], ["id IN (?)", 3]])
+
+
+    @inlineCallbacks
+    def test_selectIn(self):
+        tablename = User.tablename()
+        yield self.dbconfig.insertMany(tablename, [{'first_name': "selectIn", 'age': age} for age in range(10)])
+        users = yield User.find(where=['first_name = ?', "selectIn"], orderby="age")
+        ids = [user.id for user in users]
+
+        self.patch(self.dbconfig, 'MAX_IN_PARAMS', 3)
+        rows = yield self.dbconfig.selectIn(tablename, 'id', ids + [self.user.id], where=['age > ?', 4])
+        self.assertEqual(sorted([row['id'] for row in rows]), sorted(ids[5:] + [self.user.id]))
+
+        # beyond the threshold, the ids are put in a temporary table
+        self.patch(self.dbconfig, 'TEMP_TABLE_THRESHOLD', 5)
+        rows = yield self.dbconfig.selectIn(tablename, 'id', ids, where=['age > ?', 4], select="id")
+        self.assertEqual(sorted([row['id'] for row in rows]), ids[5:])
+        rows = yield self.dbconfig.selectIn(tablename, 'id', ids)
+        self.assertEqual(len(rows), 10)
+
+
+    @inlineCallbacks
+    def test_lock(self):
+        base = InteractionBase()
+        q, args = base.selectToString('jobs', ['id > ?', 1], limit=2, select="id", lock='update', skip_locked=True)
+        self.assertEqual(q, "SELECT id FROM jobs WHERE id > %s LIMIT 2 FOR UPDATE SKIP LOCKED")
+        self.assertEqual(base.lockToString('share'), "FOR SHARE")
+        self.assertRaises(ValueError, base.lockToString, 'exclusive')
+
+        user = yield User.find(self.user.id, lock='update', skip_locked=True)
+        self.assertEqual(user, self.user)
+        self.assertRaises(ValueError, User.find, self.user.id, lock='exclusive')
+
+
+    @inlineCallbacks
+    def test_claim(self):
+        yield self.dbconfig.insertMany(Picture.tablename(), [{'name': "job %i" % i, 'size': i} for i in range(5)])
+        claimed = yield Picture.claim(where=['user_id IS NULL'], limit=2, set={'user_id': 42}, orderby="size")
+        self.assertEqual(sorted([picture.size for picture in claimed]), [0, 1])
+        self.assertEqual(set([picture.user_id for picture in claimed]), set([42]))
+
+        claimed = yield Picture.claim(where=['user_id IS NULL'], limit=10, set={'user_id': 43})
+        self.assertEqual(sorted([picture.size for picture in claimed]), [2, 3, 4])
+        claimed = yield Picture.claim(where=['user_id IS NULL'], set={'user_id': 44})
+        self.assertEqual(claimed, [])
+        self.assertRaises(ValueError, Picture.claim, where=['user_id IS NULL'])
+
+        # the generic path, used without RETURNING
+        rows = yield InteractionBase.claim(self.dbconfig, Picture.tablename(), {'user_id': None},
+                                           ['user_id = ?', 43], limit=1)
+        self.assertEqual(len(rows), 1)
+        self.assertIsNone(rows[0]['user_id'])
+
+
     @inlineCallbacks
     def test_insert_obj(self):
         args = {'first_name': "test_insert_obj", "last_name": "foo", "age": 91}
@@ -1,15 +1,23 @@
 from __future__ import absolute_import
+import pickle
+
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed, fail
 
-from twistar.exceptions import ImaginaryTableError
+from twistar.exceptions import ImaginaryTableError, StaleObjectError
 from twistar.registry import Registry
+from twistar.testing import QueryAssertions
 
-from .utils import User, Avatar, Picture, tearDownDB, initDB, FakeObject, DBObject
+from .utils import User, Avatar, Picture, Transaction, tearDownDB, initDB, FakeObject, DBObject
 from six.moves import range
 
 
-class DBObjectTest(unittest.TestCase):
+class VersionedPicture(DBObject):
+    TABLENAME = 'pictures'
+    LOCK_VERSION = 'lock_version'
+
+
+class DBObjectTest(QueryAssertions, unittest.TestCase):
     @inlineCallbacks
     def setUp(self):
         yield initDB(self)
@@ -193,6 +201,199 @@ class DBObjectTest(unittest.TestCase):
         User.clearValidations()
 
 
+    @inlineCallbacks
+    def test_validation_uniqueness_single_query(self):
+        User.validatesUniquenessOf('first_name', 'last_name')
+        self.addCleanup(User.clearValidations)
+
+        u = User(first_name="First", last_name="Unique")
+        yield self.assertNumQueries(1, u.validate)
+        self.assertEqual(len(u.errors), 1)
+        self.assertEqual(len(u.errors.errorsFor('first_name')), 1)
+
+        # an object does not clash with itself
+        yield self.assertNumQueries(1, self.user.validate)
+        self.assertEqual(len(self.user.errors), 0)
+
+
+    @inlineCallbacks
+    def test_saveMany(self):
+        User.validatesUniquenessOf('first_name', 'last_name')
+        self.addCleanup(User.clearValidations)
+
+        users = [User(first_name="First", last_name="a"),
+                 User(first_name="b", last_name="same"),
+                 User(first_name="c", last_name="same"),
+                 User(first_name="d", last_name="e")]
+        # one query per validated column, then one insert for the valid user
+        yield self.assertNumQueries(3, User.saveMany, users)
+        self.assertEqual([len(u.errors) for u in users], [1, 1, 1, 0])
+        self.assertEqual([u.id for u in users[:3]], [None, None, None])
+
+        saved = yield User.find(users[3].id)
+        self.assertEqual(saved.first_name, "d")
+
+        # existing objects are updated and do not clash with themselves
+        self.user.age = 11
+        yield User.saveMany([self.user])
+        self.assertEqual(len(self.user.errors), 0)
+        user = yield User.find(self.user.id)
+        self.assertEqual(user.age, 11)
+
+
+    @inlineCallbacks
+    def test_saveMany_coerced(self):
+        User.validatesUniquenessOf('age')
+        self.addCleanup(User.clearValidations)
+
+        # the database finds the existing age 10 for "10", which isn't equal to it in Python
+        users = [User(first_name="a", age="10"), User(first_name="b", age=11)]
+        yield User.saveMany(users)
+        self.assertEqual([len(u.errors) for u in users], [1, 0])
+        self.assertEqual(users[0].id, None)
+
+        user = User(first_name="c", age="10")
+        yield user.save()
+        self.assertEqual(len(user.errors), 1)
+
+
+    @inlineCallbacks
+    def test_saveMany_failure(self):
+        def beforeCreate(user):
+            if user.first_name == "bad":
+                raise ValueError("not saving this one")
+        self.patch(User, 'beforeCreate', beforeCreate)
+
+        users = [User(first_name="good"), User(first_name="bad"), User(first_name="later")]
+        yield self.assertFailure(User.saveMany(users), ValueError)
+        # writes happen one after another, so the batch stops at the failure
+        self.assertIsNotNone(users[0].id)
+        self.assertEqual([users[1].id, users[2].id], [None, None])
+
+
+    @inlineCallbacks
+    def test_exists(self):
+        exists = yield User.exists(where=['first_name = ?', "First"])
+        self.assertTrue(exists)
+        exists = yield User.exists(where=['first_name = ?', "DNE"])
+        self.assertFalse(exists)
+
+
+    @inlineCallbacks
+    def test_constraint_errors(self):
+        self.patch(Transaction, 'CONSTRAINT_ERRORS', True)
+        yield Transaction(name="a name").save()
+
+        # the insert is the only query, and its failure ends up in errors
+        t = Transaction(name="a name")
+        yield self.assertNumQueries(1, t.save)
+        self.assertEqual(t.id, None)
+        self.assertEqual(t.errors.errorsFor('name'), ["Name is not unique."])
+
+        t = yield Transaction(name="another name").save()
+        t.name = "a name"
+        yield t.save()
+        self.assertEqual(t.errors.errorsFor('name'), ["Name is not unique."])
+        count = yield Transaction.count(where=['name = ?', "a name"])
+        self.assertEqual(count, 1)
+
+        # errors are raised as usual when the option is off
+        self.patch(Transaction, 'CONSTRAINT_ERRORS', False)
+        yield self.assertFailure(Transaction(name="a name").save(), Registry.DBPOOL.dbapi.IntegrityError)
+
+
+    @inlineCallbacks
+    def test_aggregate(self):
+        other = yield User(first_name="Other").save()
+        yield Picture(name="another pic", size=20, user_id=self.user.id).save()
+        yield Picture(name="other pic", size=5, user_id=other.id).save()
+
+        result = yield Picture.aggregate(sum='size', max=['size', 'id'], count='*')
+        self.assertEqual(result['sum_size'], 35)
+        self.assertEqual(result['max_size'], 20)
+        self.assertEqual(result['count'], 3)
+
+        results = yield Picture.aggregate(sum='size', min='size', group='user_id', orderby='user_id')
+        self.assertEqual([(r['user_id'], r['sum_size'], r['min_size']) for r in results],
+                         [(self.user.id, 30, 10), (other.id, 5, 5)])
+
+        result = yield Picture.aggregate(avg='size', where=['user_id = ?', self.user.id])
+        self.assertEqual(result['avg_size'], 15)
+        self.assertRaises(ValueError, Picture.aggregate, median='size')
+
+
+    @inlineCallbacks
+    def test_findColumns(self):
+        yield User(first_name="Second", age=20).save()
+        yield User(first_name="Third").save()
+
+        columns = yield User.findColumns(['first_name', 'age'], orderby="id")
+        self.assertEqual(sorted(columns.keys()), ['age', 'first_name'])
+        self.assertEqual(columns['first_name'], ["First", "Second", "Third"])
+        self.assertEqual(columns['age'], [10, 20, None])
+
+        columns = yield User.findColumns(['age'], where=['age IS NOT NULL'], orderby="id")
+        self.assertEqual(columns['age'].tolist(), [10, 20])
+
+        columns = yield User.findColumns(where=['first_name = ?', "DNE"])
+        self.assertEqual(columns['first_name'], [])
+        self.assertTrue('last_name' in columns)
+
+
+    @inlineCallbacks
+    def test_errors_lazy(self):
+        user = yield User.find(self.user.id)
+        self.assertEqual(user.__dict__.get('_errors'), None)
+        self.assertTrue(user.errors.isEmpty())
+        self.assertTrue(user.__dict__.get('_errors') is user.errors)
+
+        user.errors.add('first_name', "is wrong.")
+        self.assertEqual(user.errors.errorsFor('first_name'), ["First Name is wrong."])
+        self.assertTrue(user.errors.infl is Avatar().errors.infl)
+
+
+    @inlineCallbacks
+    def test_slots(self):
+        self.patch(User, 'SLOTS', True)
+        users = yield User.all()
+        self.addCleanup(delattr, User, 'SLOTTED_CLASS')
+        user = users[0]
+
+        self.assertTrue(isinstance(user, User))
+        self.assertTrue(type(user) is User.slottedClass())
+        self.assertEqual(type(user).__name__, "User")
+        self.assertEqual(user.__dict__, {})
+        self.assertEqual(user, self.user)
+        self.assertEqual((user.first_name, user.age), ("First", 10))
+
+        user.age = 11
+        yield user.save()
+        self.assertEqual(user.__dict__, {})
+        self.assertEqual(len(user.errors), 0)
+        avatar = yield user.avatar.get()
+        self.assertEqual(avatar, self.avatar)
+        fresh = yield User.find(user.id)
+        self.assertEqual(fresh.age, 11)
+        self.assertTrue(type(fresh) is type(user))
+
+
+    @inlineCallbacks
+    def test_slots_pickle(self):
+        self.patch(User, 'SLOTS', True)
+        user = yield User.find(self.user.id)
+        self.addCleanup(delattr, User, 'SLOTTED_CLASS')
+
+        copy = pickle.loads(pickle.dumps(user, pickle.HIGHEST_PROTOCOL))
+        self.assertTrue(type(copy) is User.slottedClass())
+        self.assertEqual(copy.__dict__, {})
+        self.assertEqual((copy.id, copy.first_name, copy.age), (user.id, "First", 10))
+
+        copy.age = 12
+        yield copy.save()
+        fresh = yield User.find(user.id)
+        self.assertEqual(fresh.age, 12)
+
+
     @inlineCallbacks
     def test_validation_function(self):
         def adult(user):
@@ -215,6 +416,64 @@ class DBObjectTest(unittest.TestCase):
         User.clearValidations()
 
 
+    def test_validation_synchronous(self):
+        User.validatesPresenceOf('first_name')
+        User.validatesLengthOf('last_name', range=range(1, 101))
+        self.addCleanup(User.clearValidations)
+
+        def adult(user):
+            if user.age < 18:
+                user.errors.add('age', "must be over 18.")
+        User.addValidator(adult, synchronous=True)
+
+        class Checker(object):
+            def check(self, user):
+                if user.age < 12:
+                    user.errors.add('age', "must be over 12.")
+        # bound methods can't have attributes set, but can be synchronous validators too
+        User.addValidator(Checker().check, synchronous=True)
+
+        u = User(age=10)
+        d = u.validate()
+        # no Deferred-returning validators, so the result is already there
+        self.assertTrue(d.called)
+        self.assertEqual(len(u.errors), 4)
+        self.assertEqual(len(u.errors.errorsFor('age')), 2)
+        return d
+
+
+    @inlineCallbacks
+    def test_validation_mixed(self):
+        User.validatesPresenceOf('first_name')
+        User.addValidator(lambda user: succeed(user.errors.add('age', "is checked later.")))
+        self.addCleanup(User.clearValidations)
+
+        u = yield User().save()
+        self.assertEqual(u.id, None)
+        self.assertEqual(len(u.errors), 2)
+
+        users = [User(), User(first_name="a")]
+        yield User.saveMany(users)
+        self.assertEqual([len(user.errors) for user in users], [2, 1])
+
+
+    @inlineCallbacks
+    def test_validation_failing(self):
+        def broken(user):
+            return fail(ValueError("validator broke"))
+        broken.batch = lambda users: fail(ValueError("batch validator broke"))
+        User.addValidator(broken)
+        self.addCleanup(User.clearValidations)
+
+        user = User(first_name="Broken")
+        yield self.assertFailure(user.save(), ValueError)
+        self.assertIsNone(user.id)
+        users = [User(first_name="a"), User(first_name="b")]
+        error = yield self.assertFailure(User.saveMany(users), ValueError)
+        self.assertEqual(str(error), "batch validator broke")
+        self.assertEqual([u.id for u in users], [None, None])
+
+
     @inlineCallbacks
     def test_afterInit(self):
         def afterInit(user):
@@ -259,3 +518,32 @@ class DBObjectTest(unittest.TestCase):
         suball = yield user.loadRelations('pictures')
         self.assertTrue('avatar' not in suball)
         self.assertEqual(pictures, suball['pictures'])
+
+
+    @inlineCallbacks
+    def test_lock_version(self):
+        picture = yield VersionedPicture(name="versioned", size=1).save()
+        self.assertEqual(picture.lock_version, 0)
+        other = yield VersionedPicture.find(picture.id)
+
+        picture.size = 2
+        yield picture.save()
+        self.assertEqual(picture.lock_version, 1)
+
+        other.size = 3
+        yield self.assertFailure(other.save(), StaleObjectError)
+        self.assertEqual(other.lock_version, 0)
+        found = yield VersionedPicture.find(picture.id)
+        self.assertEqual((found.size, found.lock_version), (2, 1))
+
+        yield other.refresh()
+        other.size = 3
+        yield other.save()
+        found = yield VersionedPicture.find(picture.id)
+        self.assertEqual((found.size, found.lock_version), (3, 2))
+
+        # rows written without a version are still updated once
+        yield Registry.getConfig().update('pictures', {'lock_version': None}, ['id = ?', picture.id])
+        found = yield VersionedPicture.find(picture.id)
+        yield found.save()
+        self.assertEqual(found.lock_version, 1)
@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+from twisted.python import log
+
+from twistar.instrumentation import Instrumentation, NPlusOneDetector, queryShape
+from twistar.exceptions import NPlusOneError, NPlusOneWarning
+from twistar.dbconfig.base import InteractionBase
+
+from .utils import User, Avatar, initDB, tearDownDB
+
+
+class InstrumentationTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield initDB(self)
+        self.user = yield User(first_name="First", last_name="Last", age=10).save()
+        self.avatar = yield Avatar(name="an avatar name", user_id=self.user.id).save()
+        self.pre = []
+        self.post = []
+        self.hook = Instrumentation.addHook(pre=self.pre.append, post=self.post.append)
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        Instrumentation.removeHook(self.hook)
+        Instrumentation.SLOW_QUERY_THRESHOLD = None
+        yield tearDownDB(self)
+
+
+    @inlineCallbacks
+    def test_hooks(self):
+        yield User.find(where=['first_name = ?', "First"])
+        self.assertEqual(len(self.pre), 1)
+        self.assertEqual(self.pre, self.post)
+
+        query = self.post[0]
+        self.assertEqual(query.operation, 'select')
+        self.assertEqual(query.tablename, 'users')
+        self.assertEqual(query.args, ["First"])
+        self.assertTrue(query.elapsed >= 0)
+        self.assertEqual(query.error, None)
+
+
+    @inlineCallbacks
+    def test_rowcount(self):
+        yield User.deleteAll(where=['first_name = ?', "First"])
+        self.assertEqual(self.post[-1].operation, 'delete')
+        self.assertEqual(self.post[-1].rowcount, 1)
+
+
+    @inlineCallbacks
+    def test_callsite(self):
+        yield User.find(self.user.id)
+        self.assertEqual(self.post[-1].callsite.method, 'User.find')
+        self.assertTrue(self.post[-1].callsite.caller.startswith(__file__.rsplit('.', 1)[0]))
+
+        yield self.user.avatar.get()
+        self.assertEqual(self.post[-1].callsite.method, 'User.avatar.get')
+
+
+    @inlineCallbacks
+    def test_sampling(self):
+        Instrumentation.removeHook(self.hook)
+        self.hook = Instrumentation.addHook(post=self.post.append, sample=0)
+        yield User.find(self.user.id)
+        self.assertEqual(self.post, [])
+
+
+    @inlineCallbacks
+    def test_slow_query_log(self):
+        messages = []
+
+        def observer(event):
+            messages.append(" ".join(event['message']))
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+
+        Instrumentation.SLOW_QUERY_THRESHOLD = 0
+        yield User.find(self.user.id)
+        slow = [m for m in messages if m.startswith("TWISTAR slow query")]
+        self.assertEqual(len(slow), 1)
+        self.assertTrue("User.find" in slow[0])
+
+
+    def test_log_non_string_args(self):
+        messages = []
+
+        def observer(event):
+            messages.append(" ".join(event['message']))
+        log.addObserver(observer)
+        self.addCleanup(log.removeObserver, observer)
+
+        InteractionBase.LOG = True
+        self.addCleanup(setattr, InteractionBase, 'LOG', False)
+        InteractionBase().log("SELECT * FROM users WHERE id = ?", [[1, None]], {})
+        InteractionBase().log("SELECT * FROM users WHERE id = ?", [1], {})
+        self.assertEqual(messages, ["TWISTAR query: SELECT * FROM users WHERE id = ?", "TWISTAR args: 1,None",
+                                    "TWISTAR query: SELECT * FROM users WHERE id = ?", "TWISTAR args: 1"])
+
+
+class NPlusOneDetectorTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield initDB(self)
+        self.users = []
+        for index in range(4):
+            user = yield User(first_name="First %i" % index).save()
+            yield Avatar(name="avatar %i" % index, user_id=user.id).save()
+            self.users.append(user)
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield tearDownDB(self)
+
+
+    def test_queryShape(self):
+        shape = queryShape("SELECT * FROM users  WHERE id IN (1, 2,3) AND name = 'bob''s'")
+        self.assertEqual(shape, "SELECT * FROM users WHERE id IN (...) AND name = ?")
+        self.assertEqual(queryShape("SELECT * FROM users WHERE id = %s"), queryShape("SELECT * FROM users WHERE id = 10"))
+
+
+    @inlineCallbacks
+    def test_detect(self):
+        detector = NPlusOneDetector(threshold=2)
+        detector.start()
+        for user in self.users:
+            yield user.avatar.get()
+        repetitions = detector.stop()
+
+        self.assertEqual(len(repetitions), 1)
+        self.assertEqual(repetitions[0].count, 4)
+        self.assertEqual(repetitions[0].callsite.method, 'User.avatar.get')
+        self.assertTrue("'avatar'" in repetitions[0].suggestion())
+        warned = self.flushWarnings()
+        self.assertEqual(len(warned), 1)
+        self.assertEqual(warned[0]['category'], NPlusOneWarning)
+
+        # queries after stopping are not counted
+        yield self.users[0].avatar.get()
+        self.assertEqual(repetitions[0].count, 4)
+
+
+    @inlineCallbacks
+    def test_below_threshold(self):
+        detector = NPlusOneDetector(threshold=4, raiseErrors=True)
+        detector.start()
+        for user in self.users:
+            yield user.avatar.get()
+        self.assertEqual(detector.stop(), [])
+
+
+    def test_watch(self):
+        @inlineCallbacks
+        def loadAvatars():
+            for user in self.users:
+                yield user.avatar.get()
+
+        detector = NPlusOneDetector(threshold=2, raiseErrors=True)
+        d = self.assertFailure(detector.watch(loadAvatars), NPlusOneError)
+        return d.addCallback(lambda _: self.flushWarnings())
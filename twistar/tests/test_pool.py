@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+import threading
+import time
+
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, DeferredList
+
+from twistar.pool import Histogram, StatsConnectionPool
+from twistar.registry import Registry
+
+from .utils import User, initDB, tearDownDB
+
+
+class HistogramTest(unittest.TestCase):
+    def test_add(self):
+        histogram = Histogram(buckets=(1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.add(value)
+        result = histogram.toDict()
+        self.assertEqual(result['count'], 4)
+        self.assertEqual(result['max'], 50)
+        self.assertEqual(result['buckets'], [(1, 2), (10, 1), (None, 1)])
+
+
+class StatsConnectionPoolTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield initDB(self)
+        self.oldpool = Registry.DBPOOL
+        if Registry.DBPOOL.dbapiName != 'sqlite3':
+            raise unittest.SkipTest("StatsConnectionPool tests only run against SQLite")
+        location = Registry.DBPOOL.connargs[0]
+        Registry.DBPOOL = StatsConnectionPool('sqlite3', location, check_same_thread=False,
+                                              cp_min=1, cp_max=1)
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        Registry.DBPOOL.close()
+        Registry.DBPOOL = self.oldpool
+        yield tearDownDB(self)
+
+
+    @inlineCallbacks
+    def test_stats(self):
+        # load the table's schema first, so that its query isn't counted
+        yield User(first_name="Zeroth").save()
+        Registry.DBPOOL.resetStats()
+        yield User(first_name="First").save()
+        yield User.find(where=['first_name = ?', "First"])
+        stats = Registry.DBPOOL.stats()
+
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['size'], stats['idle'])
+        self.assertTrue(stats['checkouts'] >= 2)
+        self.assertEqual(stats['checkout_wait']['count'], stats['checkouts'])
+        self.assertEqual(stats['queries']['users']['insert']['count'], 1)
+        self.assertEqual(stats['queries']['users']['select']['count'], 1)
+
+
+    @inlineCallbacks
+    def test_observers(self):
+        samples = []
+        Registry.DBPOOL.addObserver(lambda name, value, tags: samples.append((name, tags)))
+        yield User.count()
+        # observers are called in the reactor thread, so give them a chance to run
+        yield Registry.DBPOOL.runInteraction(lambda txn: None)
+        self.assertTrue(('query', {'table': 'users', 'operation': 'select'}) in samples)
+        self.assertTrue(('checkout_wait', {}) in samples)
+
+
+    @inlineCallbacks
+    def test_recycle(self):
+        Registry.DBPOOL.max_lifetime = 0
+        yield User.count()
+        yield User.count()
+        self.assertTrue(Registry.DBPOOL.stats()['recycled'] >= 1)
+
+
+    def test_adapt(self):
+        pool = Registry.DBPOOL
+        pool.max_ceiling = 2
+        pool._waiting = 1
+        pool.adapt()
+        self.assertEqual(pool.max, 2)
+
+        pool._waiting = 0
+        pool.adapt()
+        self.assertEqual(pool.max, 1)
+
+
+    @inlineCallbacks
+    def test_resize_prunes(self):
+        pool = Registry.DBPOOL
+        pool.resize(maximum=3)
+        yield DeferredList([pool.runInteraction(lambda txn: time.sleep(0.05)) for _ in range(3)])
+        self.assertEqual(len(pool.connections), 3)
+
+        pool.resize(maximum=1)
+        for _ in range(100):
+            alive = set(thread.ident for thread in threading.enumerate())
+            if len([tid for tid in pool.connections if tid not in alive]) >= 2:
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        yield User.count()
+        self.assertEqual(len(pool.connections), 1)
+        self.assertEqual(len(pool._connInfo), 1)
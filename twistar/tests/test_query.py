@@ -0,0 +1,141 @@
+from __future__ import absolute_import
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+
+from twistar.query import Query
+from twistar.registry import Registry
+from twistar.testing import QueryAssertions
+
+from .utils import User, Picture, FavoriteColor, initDB, tearDownDB
+from six.moves import range
+
+
+class QueryTest(QueryAssertions, unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield initDB(self)
+        self.config = Registry.getConfig()
+        rows = [{'first_name': "user %i" % i, 'last_name': "Last", 'age': i} for i in range(10)]
+        yield self.config.insertMany(User.tablename(), rows)
+        self.users = yield User.find(orderby="age")
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield tearDownDB(self)
+
+
+    @inlineCallbacks
+    def test_lazy(self):
+        query = User.where(age__gte=5)
+        self.assertIsInstance(query, Query)
+        query = yield self.assertNumQueries(0, lambda: query.where(['first_name <> ?', "user 6"]).order('-age'))
+        users = yield self.assertNumQueries(1, query.find)
+        self.assertEqual([user.age for user in users], [9, 8, 7, 5])
+
+        # refining a query leaves it alone
+        self.assertEqual(len(query.wheres), 2)
+        self.assertEqual(query.compile(), query.compile())
+        self.assertIs(query.compile(), query.compile())
+
+
+    @inlineCallbacks
+    def test_operators(self):
+        users = yield User.where(age__lt=2).find()
+        self.assertEqual(sorted([user.age for user in users]), [0, 1])
+        users = yield User.where(age__in=[3, 4, 42]).find()
+        self.assertEqual(sorted([user.age for user in users]), [3, 4])
+        users = yield User.where(age__in=[]).find()
+        self.assertEqual(users, [])
+        users = yield User.where(first_name__like="user 1%", age__ne=2).find()
+        self.assertEqual([user.age for user in users], [1])
+        count = yield User.where(dob__isnull=True).count()
+        self.assertEqual(count, 10)
+        count = yield User.where(dob=None, age=3).count()
+        self.assertEqual(count, 1)
+        self.assertRaises(ValueError, User.where, age__between=3)
+
+
+    @inlineCallbacks
+    def test_slicing(self):
+        query = User.where().order('age')
+        users = yield query[2:5].find()
+        self.assertEqual([user.age for user in users], [2, 3, 4])
+        users = yield query[2:5][1:].find()
+        self.assertEqual([user.age for user in users], [3, 4])
+        users = yield query[8:].find()
+        self.assertEqual([user.age for user in users], [8, 9])
+        user = yield query[3]
+        self.assertEqual(user.age, 3)
+        user = yield query[20]
+        self.assertIsNone(user)
+        self.assertRaises(ValueError, query.__getitem__, -1)
+        self.assertRaises(ValueError, query.__getitem__, slice(0, 5, 2))
+        self.assertRaises(TypeError, list, query)
+
+
+    @inlineCallbacks
+    def test_first_count_exists(self):
+        user = yield User.where(age__gt=4).first()
+        self.assertEqual(user, self.users[5])
+        user = yield User.where(age__gt=4).order('-age').first()
+        self.assertEqual(user, self.users[9])
+        user = yield User.where(age__gt=40).first()
+        self.assertIsNone(user)
+
+        count = yield User.where(age__gt=4).count()
+        self.assertEqual(count, 5)
+        count = yield User.where(age__gt=4).order('age')[1:3].count()
+        self.assertEqual(count, 2)
+        exists = yield User.where(age=4).exists()
+        self.assertTrue(exists)
+        exists = yield User.where(age=4)[1:].exists()
+        self.assertFalse(exists)
+
+
+    @inlineCallbacks
+    def test_batches(self):
+        ages = []
+        for batch in User.where(age__gte=1).batches(4):
+            users = yield batch
+            self.assertTrue(len(users) <= 4)
+            ages.extend([user.age for user in users])
+        self.assertEqual(ages, list(range(1, 10)))
+
+        ages = []
+        for batch in User.where().order('-age').limit(7).batches(3):
+            users = yield batch
+            ages.extend([user.age for user in users])
+        self.assertEqual(ages, [9, 8, 7, 6, 5, 4, 3])
+
+        batches = User.where().batches(3)
+        next(batches)
+        self.assertRaises(RuntimeError, next, batches)
+
+        seen = []
+        count = yield User.where(age__lt=5).each(lambda user: seen.append(user.age), batchsize=2)
+        self.assertEqual(count, 5)
+        self.assertEqual(seen, list(range(5)))
+
+
+    @inlineCallbacks
+    def test_relationships(self):
+        user = self.users[0]
+        for size in range(4):
+            yield Picture(name="pic %i" % size, size=size, user_id=user.id).save()
+        yield Picture(name="other", size=10, user_id=self.users[1].id).save()
+
+        pictures = yield user.pictures.get(Picture.where(size__gt=1).order('-size'))
+        self.assertEqual([picture.size for picture in pictures], [3, 2])
+        count = yield user.pictures.count(Picture.where(size__gt=1))
+        self.assertEqual(count, 2)
+
+        red = yield FavoriteColor(name="red").save()
+        blue = yield FavoriteColor(name="blue").save()
+        yield user.favorite_colors.set([red, blue])
+        colors = yield self.assertNumQueries(1, user.favorite_colors.get, FavoriteColor.where(name="blue"))
+        self.assertEqual(colors, [blue])
+        count = yield user.favorite_colors.count(FavoriteColor.where().order('name')[:1])
+        self.assertEqual(count, 1)
+
+        self.assertRaises(ValueError, user.pictures.get, User.where())
@@ -2,14 +2,46 @@ from __future__ import absolute_import
 from twisted.trial import unittest
 from twisted.internet.defer import inlineCallbacks
 
-from twistar.exceptions import ReferenceNotSavedError
+from twistar.exceptions import ReferenceNotSavedError, InvalidRelationshipError
+from twistar.relationships import CounterCache, RelationshipInfo, HasMany, HABTM
+from twistar.instrumentation import QueryRecorder
+from twistar.testing import QueryAssertions
 
-from .utils import Boy, Girl, tearDownDB, initDB, Registry, Comment, Category
-from .utils import User, Avatar, Picture, FavoriteColor, Nickname, Blogpost
+from .utils import Boy, Girl, tearDownDB, initDB, Registry, Comment, Category, DBObject
+from .utils import User, Avatar, Picture, FavoriteColor, Nickname, Blogpost, Transaction
 from six.moves import range
 
 
-class RelationshipTest(unittest.TestCase):
+class CountedUser(DBObject):
+    TABLENAME = 'users'
+    HASMANY = [{'name': 'pictures', 'foreign_key': 'user_id', 'counter_cache': 'pictures_count'}]
+    HABTM = [{'name': 'favorite_colors', 'foreign_key': 'user_id', 'join_table': 'favorite_colors_users',
+              'counter_cache': 'favorite_colors_count'}]
+
+
+class TransactingUser(DBObject):
+    TABLENAME = 'users'
+    HASMANY = [{'name': 'transactions', 'foreign_key': 'user_id', 'counter_cache': 'comments_count'}]
+
+
+class DependentUser(DBObject):
+    TABLENAME = 'users'
+    HASMANY = [{'name': 'pictures', 'foreign_key': 'user_id', 'dependent': 'delete'},
+               {'name': 'comments', 'foreign_key': 'user_id', 'dependent': 'nullify'}]
+    HASONE = [{'name': 'avatar', 'foreign_key': 'user_id', 'dependent': 'delete'}]
+    HABTM = [{'name': 'favorite_colors', 'foreign_key': 'user_id', 'join_table': 'favorite_colors_users'}]
+
+    def beforeDelete(self):
+        return self.first_name != "Keep"
+
+
+class ThreadedComment(DBObject):
+    TABLENAME = 'comments'
+    HASMANY = [{'name': 'replies', 'class_name': 'ThreadedComment', 'foreign_key': 'parent_id', 'dependent': 'delete'},
+               {'name': 'pictures', 'foreign_key': 'user_id', 'dependent': 'nullify'}]
+
+
+class RelationshipTest(QueryAssertions, unittest.TestCase):
     @inlineCallbacks
     def setUp(self):
         yield initDB(self)
@@ -48,6 +80,34 @@ class RelationshipTest(unittest.TestCase):
         girl = yield sue.nicknameable.get()
         self.assertEqual(girl, self.girl)
 
+        # the owner is found from the nickname's own attributes
+        girl = yield self.assertNumQueries(1, sue.nicknameable.get)
+        self.assertEqual(girl, self.girl)
+        nobody = yield Nickname(value="Nobody").save()
+        nobody = yield self.assertNumQueries(0, nobody.nicknameable.get)
+        self.assertIsNone(nobody)
+
+
+    @inlineCallbacks
+    def test_loadBelongsTo(self):
+        otherboy = yield Boy(name="Bill").save()
+        nicknames = [
+            Nickname(value="Bob", nicknameable_id=self.boy.id, nicknameable_type="Boy"),
+            Nickname(value="Sue", nicknameable_id=self.girl.id, nicknameable_type="Girl"),
+            Nickname(value="Nobody"),
+            Nickname(value="Billy", nicknameable_id=otherboy.id, nicknameable_type="Boy"),
+            Nickname(value="Robbie", nicknameable_id=self.boy.id, nicknameable_type="Boy")
+        ]
+        owners = yield self.assertNumQueries(2, Nickname.loadBelongsTo, nicknames, 'nicknameable')
+        self.assertEqual(owners, [self.boy, self.girl, None, otherboy, self.boy])
+        self.assertIsInstance(owners[1], Girl)
+
+        other = yield User(first_name="Other").save()
+        pictures = [self.picture, Picture(user_id=other.id), Picture(user_id=self.user.id + other.id)]
+        users = yield self.assertNumQueries(1, Picture.loadBelongsTo, pictures, 'user')
+        self.assertEqual(users, [self.user, other, None])
+        self.assertRaises(InvalidRelationshipError, User.loadBelongsTo, [self.user], 'pictures')
+
 
     @inlineCallbacks
     def test_polymorphic_set(self):
@@ -157,6 +217,130 @@ class RelationshipTest(unittest.TestCase):
         self.assertEqual(pics[0].name, 'a pic')
 
 
+    @inlineCallbacks
+    def test_has_many_aggregate(self):
+        yield Picture(name="another pic", size=20, user_id=self.user.id).save()
+        yield Picture(name="not mine", size=40).save()
+
+        result = yield self.user.pictures.aggregate(sum='size', min='size', count='*')
+        self.assertEqual(result, {'sum_size': 30, 'min_size': 10, 'count': 2})
+
+        result = yield self.user.pictures.aggregate(max='size', where=['size < ?', 15])
+        self.assertEqual(result['max_size'], 10)
+
+
+    @inlineCallbacks
+    def test_has_many_counter_cache(self):
+        self.patch(Registry, 'REGISTRATION', dict(Registry.REGISTRATION, CountedUser=CountedUser))
+        user = yield CountedUser.find(self.user.id)
+        self.assertEqual(user.pictures_count, None)
+        count = yield user.pictures.count()
+        self.assertEqual(count, 1)
+
+        # repair the counter of the picture created before counting started
+        yield CountedUser.recountCounters()
+        user = yield CountedUser.find(self.user.id)
+        self.assertEqual(user.pictures_count, 1)
+
+        picture = yield Picture(name="another pic", user_id=user.id).save()
+        user = yield CountedUser.find(self.user.id)
+        count = yield self.assertNumQueries(0, user.pictures.count)
+        self.assertEqual(count, 2)
+
+        # moving a picture updates both users
+        other = yield CountedUser(first_name="Other").save()
+        picture.user_id = other.id
+        yield picture.save()
+        user = yield CountedUser.find(self.user.id)
+        other = yield CountedUser.find(other.id)
+        self.assertEqual((user.pictures_count, other.pictures_count), (1, 1))
+
+        yield picture.delete()
+        other = yield CountedUser.find(other.id)
+        self.assertEqual(other.pictures_count, 0)
+
+        pictures = [self.picture, (yield Picture(name="third pic").save())]
+        yield other.pictures.set(pictures)
+        self.assertEqual(other.pictures_count, 2)
+        user = yield CountedUser.find(self.user.id)
+        self.assertEqual(user.pictures_count, 0)
+
+        # saving a user doesn't overwrite the counter
+        user.pictures_count = 100
+        yield user.save()
+        user = yield CountedUser.find(self.user.id)
+        self.assertEqual(user.pictures_count, 0)
+
+
+    def test_counter_cache_polymorphic(self):
+        args = {'name': 'nicknames', 'as': 'nicknameable', 'counter_cache': 'nicknames_count'}
+        self.assertRaises(InvalidRelationshipError, RelationshipInfo, Boy, 'nicknames', HasMany, args)
+
+
+    @inlineCallbacks
+    def test_counter_cache_index(self):
+        self.patch(Registry, 'REGISTRATION', dict(Registry.REGISTRATION, CountedUser=CountedUser))
+        counters = CounterCache.counting('pictures')
+        self.assertEqual([(c.klass, c.name) for c in counters], [(CountedUser, 'pictures')])
+        self.assertIs(CounterCache.counting('pictures'), counters)
+        self.assertIs(counters[0], CountedUser.relationshipCache()['pictures'].counter)
+
+        # a counter of a class that isn't registered yet doesn't break other saves
+        class Unfinished(DBObject):
+            TABLENAME = 'users'
+            HASMANY = [{'name': 'gizmos', 'counter_cache': 'gizmos_count'}]
+        Registry.register(Unfinished)
+        yield Picture(name="still saved", user_id=self.user.id).save()
+        self.assertEqual(CounterCache.counting('gizmos'), [])
+
+
+    @inlineCallbacks
+    def test_counter_cache_constraint_errors(self):
+        registration = dict(Registry.REGISTRATION, TransactingUser=TransactingUser, Transaction=Transaction)
+        self.patch(Registry, 'REGISTRATION', registration)
+        self.patch(Transaction, 'CONSTRAINT_ERRORS', True)
+        yield Transaction(name="a name", user_id=self.user.id).save()
+
+        # the violation is rolled back to a savepoint and the counters aren't recounted
+        t = Transaction(name="a name", user_id=self.user.id)
+        recorder = QueryRecorder()
+        yield recorder.watch(t.save)
+        self.assertEqual([q.sql for q in recorder.queries if "users" in q.sql], [])
+        self.assertEqual(t.id, None)
+        self.assertEqual(t.errors.errorsFor('name'), ["Name is not unique."])
+
+        t = yield Transaction(name="another name").save()
+        t.name = "a name"
+        t.user_id = self.user.id
+        yield t.save()
+        self.assertEqual(t.errors.errorsFor('name'), ["Name is not unique."])
+
+        user = yield TransactingUser.find(self.user.id)
+        self.assertEqual(user.comments_count, 1)
+
+
+    @inlineCallbacks
+    def test_add_remove_has_many(self):
+        other = yield User(first_name="Other").save()
+        pic = yield Picture(name="another pic", user_id=other.id).save()
+        yield self.user.pictures.add([pic])
+        pictures = yield self.user.pictures.get()
+        self.assertEqual(sorted([p.id for p in pictures]), [self.picture.id, pic.id])
+
+        # removing pictures the user doesn't have does nothing
+        otherpic = yield Picture(name="other pic", user_id=other.id).save()
+        yield self.user.pictures.remove([self.picture, otherpic])
+        pictures = yield self.user.pictures.get()
+        self.assertEqual([p.id for p in pictures], [pic.id])
+        otherpic = yield Picture.find(otherpic.id)
+        self.assertEqual(otherpic.user_id, other.id)
+
+        yield self.assertNumQueries(2, self.user.pictures.set, [pic, otherpic])
+        pictures = yield self.user.pictures.get()
+        self.assertEqual(sorted([p.id for p in pictures]), [pic.id, otherpic.id])
+        self.assertRaises(ReferenceNotSavedError, self.user.pictures.add, [Picture()])
+
+
     @inlineCallbacks
     def test_has_many_count_with_args(self):
         # First, make a few pics
@@ -287,6 +471,38 @@ class RelationshipTest(unittest.TestCase):
         self.assertEqual(newcolorsnum, 2)
 
 
+    @inlineCallbacks
+    def test_habtm_aggregate(self):
+        color = yield FavoriteColor(name="red").save()
+        yield FavoriteColor(name="green").save()
+        yield self.user.favorite_colors.set([self.favcolor, color])
+
+        result = yield self.user.favorite_colors.aggregate(count='*', max='id')
+        self.assertEqual(result, {'count': 2, 'max_id': color.id})
+
+        result = yield self.user.favorite_colors.aggregate(count='*', where=['name = ?', 'red'])
+        self.assertEqual(result['count'], 1)
+
+
+    @inlineCallbacks
+    def test_habtm_counter_cache(self):
+        self.patch(Registry, 'REGISTRATION', dict(Registry.REGISTRATION, CountedUser=CountedUser))
+        user = yield CountedUser.find(self.user.id)
+        color = yield FavoriteColor(name="red").save()
+        yield user.favorite_colors.set([self.favcolor, color])
+        self.assertEqual(user.favorite_colors_count, 2)
+        count = yield self.assertNumQueries(0, user.favorite_colors.count)
+        self.assertEqual(count, 2)
+
+        # changes from the other side of the relationship are counted as well
+        yield color.users.clear()
+        user = yield CountedUser.find(self.user.id)
+        self.assertEqual(user.favorite_colors_count, 1)
+        yield color.users.set([self.user])
+        user = yield CountedUser.find(self.user.id)
+        self.assertEqual(user.favorite_colors_count, 2)
+
+
     @inlineCallbacks
     def test_habtm_get_with_args(self):
         color = yield FavoriteColor(name="red").save()
@@ -300,6 +516,12 @@ class RelationshipTest(unittest.TestCase):
         newcolor = yield self.user.favorite_colors.get(where=['name = ?', 'red'], limit=1)
         self.assertEqual(newcolor.id, color.id)
 
+        # the join table is read in a subquery
+        colors = yield self.assertNumQueries(1, self.user.favorite_colors.get, orderby="id")
+        self.assertEqual([c.id for c in colors], [self.favcolor.id, color.id])
+        colors = yield self.user.favorite_colors.get(join_where=['favorite_color_id = ?', color.id])
+        self.assertEqual([c.id for c in colors], [color.id])
+
 
     @inlineCallbacks
     def test_habtm_count_with_args(self):
@@ -328,6 +550,30 @@ class RelationshipTest(unittest.TestCase):
         self.assertEqual(newcolorids, colorids)
 
 
+    @inlineCallbacks
+    def test_set_habtm_diff(self):
+        red = yield FavoriteColor(name="red").save()
+        green = yield FavoriteColor(name="green").save()
+        args = {'user_id': self.user.id, 'favorite_color_id': self.favcolor.id, 'palette_id': 3}
+        yield self.config.insert('favorite_colors_users', args)
+        yield self.config.insert('favorite_colors_users', {'user_id': self.user.id, 'favorite_color_id': green.id})
+
+        # one select, one delete and one insert; the kept join row is untouched
+        yield self.assertNumQueries(3, self.user.favorite_colors.set, [self.favcolor, red, red])
+        rows = yield self.config.select('favorite_colors_users', orderby='favorite_color_id')
+        self.assertEqual([(row['favorite_color_id'], row['palette_id']) for row in rows],
+                         [(self.favcolor.id, 3), (red.id, None)])
+
+        yield self.assertNumQueries(1, self.user.favorite_colors.set, [self.favcolor, red])
+        yield self.user.favorite_colors.add([green, red])
+        colors = yield self.user.favorite_colors.get()
+        self.assertEqual(sorted([c.id for c in colors]), [self.favcolor.id, red.id, green.id])
+
+        yield self.user.favorite_colors.remove([red, green])
+        colors = yield self.user.favorite_colors.get()
+        self.assertEqual([c.id for c in colors], [self.favcolor.id])
+
+
     @inlineCallbacks
     def test_clear_habtm(self):
         user = yield User().save()
@@ -377,3 +623,140 @@ class RelationshipTest(unittest.TestCase):
         yield user.favorite_colors.set([])
         newcolors = yield user.favorite_colors.get()
         self.assertEqual(len(newcolors), 0)
+
+
+    @inlineCallbacks
+    def test_find_joins(self):
+        other = yield User(first_name="Other", age=30).save()
+        yield Picture(name="a pic", user_id=self.user.id).save()
+        yield Picture(name="another pic", user_id=other.id).save()
+
+        # users with several matching pictures are only found once
+        users = yield self.assertNumQueries(1, User.find, joins=['pictures'], where=['pictures.name LIKE ?', '%pic'])
+        self.assertEqual(sorted([user.id for user in users]), [self.user.id, other.id])
+        users = yield User.find(joins=['pictures'], where=['pictures.name = ? AND users.age > ?', 'a pic', 20])
+        self.assertEqual(users, [])
+        user = yield User.find(self.user.id, joins=['pictures'])
+        self.assertEqual(user, self.user)
+        count = yield User.where(['pictures.name = ?', 'a pic']).joins('pictures').count()
+        self.assertEqual(count, 1)
+
+        user = yield User.find(joins=['avatar'], where=['avatar.name = ?', "an avatar name"], limit=1)
+        self.assertEqual(user, self.user)
+        pictures = yield Picture.find(joins=['user'], where=['user.age = ?', 30])
+        self.assertEqual([picture.name for picture in pictures], ["another pic"])
+
+        yield self.user.favorite_colors.set([self.favcolor])
+        users = yield User.find(joins=['favorite_colors', 'pictures'], where=['favorite_colors.name = ?', 'blue'])
+        self.assertEqual(users, [self.user])
+
+        # the girl has the same id as the boy, but the nickname is his
+        yield Nickname(value="Bob", nicknameable_id=self.boy.id, nicknameable_type="Boy").save()
+        self.assertEqual(self.girl.id, self.boy.id)
+        boys = yield Boy.find(joins=['nicknames'], where=['nicknames.value = ?', "Bob"])
+        self.assertEqual(boys, [self.boy])
+        girls = yield Girl.find(joins=['nicknames'], where=['nicknames.value = ?', "Bob"])
+        self.assertEqual(girls, [])
+
+        self.assertRaises(InvalidRelationshipError, Nickname.find, joins=['nicknameable'])
+        self.assertRaises(InvalidRelationshipError, User.find, joins=['enemies'])
+
+
+    @inlineCallbacks
+    def test_relationship_info(self):
+        info = User.RELATIONSHIP_CACHE['pictures']
+        self.assertIsInstance(info, RelationshipInfo)
+        self.assertIs(self.user.pictures.info, info)
+        self.assertEqual((info.thisname, info.otherklass), ('user_id', Picture))
+        self.assertEqual(User.RELATIONSHIP_CACHE['favorite_colors'].jointable, 'favorite_colors_users')
+        self.assertRaises(AttributeError, setattr, info, 'thisname', 'owner_id')
+
+        yield Registry.validate()
+
+        class Broken(DBObject):
+            TABLENAME = 'users'
+            HASMANY = ['widgets', {'name': 'pictures', 'foreign_key': 'owner_id'}]
+            HABTM = [{'name': 'favorite_colors', 'join_table': 'no_such_table'}]
+        self.patch(Registry, 'REGISTRATION', dict(Registry.REGISTRATION, Broken=Broken))
+        Registry.register(Broken)
+        error = yield self.assertFailure(Registry.validate(Broken), InvalidRelationshipError)
+        problems = str(error).split("\n")
+        self.assertEqual(len(problems), 3)
+        self.assertIn("The relationship widgets in class Broken: ", problems[2])
+        self.assertIn("needs the column owner_id of the table pictures", problems[1])
+        self.assertIn("needs the table no_such_table", problems[0])
+
+
+    @inlineCallbacks
+    def test_deleteWhere(self):
+        other = yield User(first_name="Keep", age=20).save()
+        yield Picture(name="other pic", user_id=other.id).save()
+        yield Picture(name="another pic", user_id=self.user.id).save()
+        comment = yield Comment(subject="hi", user_id=self.user.id).save()
+        yield self.user.favorite_colors.set([self.favcolor])
+        yield other.favorite_colors.set([self.favcolor])
+
+        # the join rows, pictures, avatar and comments of the user are handled with set-based statements
+        deleted = yield self.assertNumQueries(5, DependentUser.deleteWhere, ['age < ?', 15])
+        self.assertEqual(deleted, 1)
+        users = yield User.all()
+        self.assertEqual(users, [other])
+        pictures = yield Picture.all()
+        self.assertEqual([picture.user_id for picture in pictures], [other.id])
+        avatars = yield Avatar.count()
+        self.assertEqual(avatars, 0)
+        comment = yield Comment.find(comment.id)
+        self.assertIsNone(comment.user_id)
+        rows = yield self.config.select('favorite_colors_users')
+        self.assertEqual([row['user_id'] for row in rows], [other.id])
+
+        # beforeDelete is called in batches and can keep objects
+        yield User(first_name="Drop", age=30).save()
+        deleted = yield DependentUser.deleteWhere(['age > ?', 15], callbacks=True, batchsize=1)
+        self.assertEqual(deleted, 1)
+        users = yield User.all()
+        self.assertEqual(users, [other])
+
+        deleted = yield User.deleteWhere(cascade=False)
+        self.assertEqual(deleted, 1)
+        pictures = yield Picture.count()
+        self.assertEqual(pictures, 1)
+
+
+    @inlineCallbacks
+    def test_deleteWhere_self_referential(self):
+        self.patch(Registry, 'REGISTRATION', dict(Registry.REGISTRATION, ThreadedComment=ThreadedComment))
+        top = yield ThreadedComment(subject="top").save()
+        reply = yield ThreadedComment(subject="reply", parent_id=top.id).save()
+        yield ThreadedComment(subject="reply to reply", parent_id=reply.id).save()
+        other = yield ThreadedComment(subject="other").save()
+        picture = yield Picture(name="referenced", user_id=reply.id).save()
+
+        # replies of replies are deleted too, by id
+        deleted = yield ThreadedComment.deleteWhere(['subject = ?', "top"])
+        self.assertEqual(deleted, 3)
+        comments = yield ThreadedComment.all()
+        self.assertEqual(comments, [other])
+        picture = yield Picture.find(picture.id)
+        self.assertIsNone(picture.user_id)
+
+
+    @inlineCallbacks
+    def test_deleteWhere_polymorphic_and_counters(self):
+        DependentBoy = type('Boy', (Boy,), {'HASMANY': [{'name': 'nicknames', 'as': 'nicknameable', 'dependent': 'delete'}]})
+        yield Nickname(value="Bob", nicknameable_id=self.boy.id, nicknameable_type="Boy").save()
+        yield Nickname(value="Sue", nicknameable_id=self.girl.id, nicknameable_type="Girl").save()
+        yield DependentBoy.deleteWhere()
+        nicknames = yield Nickname.all()
+        self.assertEqual([nickname.value for nickname in nicknames], ["Sue"])
+
+        self.patch(Registry, 'REGISTRATION', dict(Registry.REGISTRATION, CountedUser=CountedUser))
+        yield Picture(name="big", size=100, user_id=self.user.id).save()
+        yield self.user.favorite_colors.set([self.favcolor])
+        yield Picture.deleteWhere(['size > ?', 50])
+        yield FavoriteColor.deleteWhere()
+        user = yield CountedUser.find(self.user.id)
+        self.assertEqual((user.pictures_count, user.favorite_colors_count), (1, 0))
+
+        self.assertRaises(InvalidRelationshipError, RelationshipInfo, User, 'colors', HABTM, {'dependent': 'delete'})
+        self.assertRaises(InvalidRelationshipError, RelationshipInfo, User, 'pictures', HasMany, {'dependent': 'destroy'})
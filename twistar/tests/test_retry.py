@@ -0,0 +1,143 @@
+from __future__ import absolute_import
+import sqlite3
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, fail, succeed
+
+from twistar.exceptions import TransactionError
+from twistar.registry import Registry
+from twistar.retry import RetryPolicy, originalError
+from twistar.utils import transaction
+
+from .utils import initDB, tearDownDB, Transaction
+
+
+def locked():
+    return sqlite3.OperationalError("database is locked")
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.calls = []
+        self.events = []
+
+
+    def flaky(self, failures, error=locked):
+        def _call():
+            self.calls.append(None)
+            if len(self.calls) <= failures:
+                return fail(error())
+            return succeed(len(self.calls))
+        return _call
+
+
+    def isTransient(self, error):
+        return isinstance(error, sqlite3.OperationalError)
+
+
+    def test_retries(self):
+        policy = RetryPolicy(attempts=4, initial=0.1, maximum=0.5, clock=self.clock)
+        policy.addObserver(lambda name, value, tags: self.events.append((name, tags['attempt'])))
+        d = policy.run(self.flaky(2), self.isTransient)
+        self.clock.advance(0.1)
+        self.clock.advance(0.2)
+        self.assertEqual(self.successResultOf(d), 3)
+        self.assertEqual(self.events, [('retry', 1), ('retry', 2)])
+        self.assertEqual(policy.stats(), {'calls': 1, 'retries': 2, 'recovered': 1, 'exhausted': 0, 'over_budget': 0})
+
+        for retries in range(10):
+            self.assertTrue(0 <= policy.delay(retries) <= min(0.5, 0.1 * 2 ** retries))
+
+
+    def test_gives_up(self):
+        policy = RetryPolicy(attempts=2, initial=0, clock=self.clock)
+        d = policy.run(self.flaky(5), self.isTransient)
+        self.clock.advance(0)
+        self.failureResultOf(d, sqlite3.OperationalError)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(policy.stats()['exhausted'], 1)
+
+        # other errors aren't retried
+        self.calls = []
+        d = policy.run(self.flaky(1, ValueError), self.isTransient)
+        self.failureResultOf(d, ValueError)
+        self.assertEqual(len(self.calls), 1)
+
+
+    def test_budget(self):
+        policy = RetryPolicy(attempts=10, initial=0, budget=0.5, reserve=1, clock=self.clock)
+        d = policy.run(self.flaky(5), self.isTransient)
+        self.clock.advance(0)
+        self.failureResultOf(d, sqlite3.OperationalError)
+        self.assertEqual(len(self.calls), 2)
+        self.assertEqual(policy.stats()['over_budget'], 1)
+
+        # each call adds to the budget
+        self.calls = []
+        policy.run(self.flaky(0), self.isTransient)
+        d = policy.run(self.flaky(2), self.isTransient)
+        self.clock.advance(0)
+        self.assertEqual(self.successResultOf(d), 3)
+
+
+    def test_originalError(self):
+        error = locked()
+        self.assertIs(originalError(TransactionError("locked", error)), error)
+        self.assertIs(originalError(error), error)
+
+
+class RetryInteractionTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield initDB(self)
+        self.config = Registry.getConfig()
+        self.policy = RetryPolicy(initial=0)
+        self.calls = []
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield tearDownDB(self)
+
+
+    @inlineCallbacks
+    def test_runInteraction(self):
+        def interaction(txn):
+            self.calls.append(None)
+            self.config.insert(Transaction.tablename(), {'name': "retried %i" % len(self.calls)}, txn)
+            if len(self.calls) < 3:
+                raise locked()
+            return len(self.calls)
+
+        yield self.assertFailure(self.config.runInteraction(interaction), sqlite3.OperationalError)
+        self.patch(Registry, 'RETRY_POLICY', self.policy)
+        result = yield self.config.runInteraction(interaction)
+        self.assertEqual(result, 3)
+        names = yield Transaction.findColumns(['name'])
+        self.assertEqual(list(names['name']), ["retried 3"])
+
+
+    @inlineCallbacks
+    def test_transaction(self):
+        @transaction(retry=self.policy)
+        def interaction(txn, name):
+            self.calls.append(None)
+            d = Transaction(name=name).save()
+            if len(self.calls) == 1:
+                d.addCallback(lambda _: fail(locked()))
+            return d
+
+        yield interaction("a name")
+        self.assertEqual(len(self.calls), 2)
+        count = yield Transaction.count()
+        self.assertEqual(count, 1)
+
+        @transaction
+        def failing(txn):
+            raise ValueError("not transient")
+
+        error = yield self.assertFailure(failing(), TransactionError)
+        self.assertIsInstance(error.original, ValueError)
+        self.assertEqual(self.policy.stats()['retries'], 1)
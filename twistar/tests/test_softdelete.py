@@ -0,0 +1,110 @@
+from __future__ import absolute_import
+import datetime
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+
+from twistar.registry import Registry
+
+from .utils import DBObject, initDB, tearDownDB
+
+
+class Note(DBObject):
+    TABLENAME = 'comments'
+    SOFT_DELETE = 'deleted_at'
+    BELONGSTO = [{'name': 'user', 'class_name': 'NotingUser', 'foreign_key': 'user_id'}]
+
+
+class NotingUser(DBObject):
+    TABLENAME = 'users'
+    HASMANY = [{'name': 'notes', 'foreign_key': 'user_id', 'counter_cache': 'comments_count'}]
+
+
+class SoftDeleteTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield initDB(self)
+        self.patch(Registry, 'REGISTRATION', dict(Registry.REGISTRATION, Note=Note, NotingUser=NotingUser))
+        self.config = Registry.getConfig()
+        self.user = yield NotingUser(first_name="First").save()
+        self.notes = []
+        for subject in ("a", "b", "c"):
+            note = yield Note(subject=subject, user_id=self.user.id).save()
+            self.notes.append(note)
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield tearDownDB(self)
+
+
+    @inlineCallbacks
+    def test_delete_and_restore(self):
+        note = self.notes[0]
+        yield note.delete()
+        self.assertEqual(note.id, self.notes[0].id)
+        self.assertIsNotNone(note.deleted_at)
+
+        notes = yield Note.find(orderby="id")
+        self.assertEqual([n.subject for n in notes], ["b", "c"])
+        found = yield Note.find(note.id)
+        self.assertIsNone(found)
+        count = yield Note.count()
+        self.assertEqual(count, 2)
+        exists = yield Note.exists(["subject = ?", "a"])
+        self.assertFalse(exists)
+        count = yield Note.where().withDeleted().count()
+        self.assertEqual(count, 3)
+        count = yield self.config.count(Note.tablename())
+        self.assertEqual(count, 3)
+
+        notes = yield self.user.notes.get()
+        self.assertEqual(len(notes), 2)
+        user = yield NotingUser.find(self.user.id)
+        self.assertEqual(user.comments_count, 2)
+
+        yield note.restore()
+        self.assertIsNone(note.deleted_at)
+        count = yield Note.where(subject="a").count()
+        self.assertEqual(count, 1)
+        user = yield NotingUser.find(self.user.id)
+        self.assertEqual(user.comments_count, 3)
+
+
+    @inlineCallbacks
+    def test_deleteAll_and_deleteWhere(self):
+        yield Note.deleteAll(["subject = ?", "a"])
+        deleted = yield Note.deleteWhere(["subject <> ?", "c"])
+        self.assertEqual(deleted, 1)
+        notes = yield Note.all()
+        self.assertEqual([n.subject for n in notes], ["c"])
+        count = yield self.config.count(Note.tablename())
+        self.assertEqual(count, 3)
+        user = yield NotingUser.find(self.user.id)
+        self.assertEqual(user.comments_count, 1)
+
+        owners = yield Note.loadBelongsTo(notes, 'user')
+        self.assertEqual(owners, [self.user])
+
+
+    @inlineCallbacks
+    def test_archive(self):
+        longago = datetime.datetime.now() - datetime.timedelta(days=30)
+        for note in self.notes[:2]:
+            yield note.delete()
+        yield self.config.update(Note.tablename(), {'deleted_at': longago}, ["subject = ?", "a"])
+
+        moved = yield Note.archive(older_than=datetime.timedelta(days=1))
+        self.assertEqual(moved, 1)
+        archived = yield self.config.select('comments_archive')
+        self.assertEqual([row['subject'] for row in archived], ["a"])
+        self.assertEqual(archived[0]['id'], self.notes[0].id)
+
+        moved = yield Note.archive(older_than=datetime.datetime.now() + datetime.timedelta(days=1), batchsize=1)
+        self.assertEqual(moved, 1)
+        count = yield self.config.count(Note.tablename())
+        self.assertEqual(count, 1)
+        count = yield self.config.count('comments_archive')
+        self.assertEqual(count, 2)
+
+        yield self.assertFailure(NotingUser.archive(datetime.timedelta(days=1)), ValueError)
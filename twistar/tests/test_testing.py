@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+
+from twistar.testing import QueryAssertions
+
+from .utils import User, Avatar, initDB, tearDownDB
+
+
+class QueryAssertionsTest(QueryAssertions, unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        yield initDB(self)
+        self.user = yield User(first_name="First", last_name="Last", age=10).save()
+        self.avatar = yield Avatar(name="an avatar name", user_id=self.user.id).save()
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield tearDownDB(self)
+
+
+    @inlineCallbacks
+    def test_assertNumQueries(self):
+        avatar = yield self.assertNumQueries(1, self.user.avatar.get)
+        self.assertEqual(avatar, self.avatar)
+
+        yield self.assertNumQueries(2, self.user.loadRelations, 'avatar', 'pictures')
+        yield self.assertFailure(self.assertNumQueries(2, self.user.avatar.get), self.failureException)
+
+
+    @inlineCallbacks
+    def test_assertMaxQueries(self):
+        yield self.assertMaxQueries(4, self.user.loadRelations)
+        yield self.assertFailure(self.assertMaxQueries(0, User.find, self.user.id), self.failureException)
+
+
+    @inlineCallbacks
+    def test_assertMaxQueryTime(self):
+        user = yield self.assertMaxQueryTime(60, User.find, self.user.id, total=60)
+        self.assertEqual(user, self.user)
+        yield self.assertFailure(self.assertMaxQueryTime(-1, User.find, self.user.id), self.failureException)
+        yield self.assertFailure(self.assertMaxQueryTime(60, User.find, self.user.id, total=-1), self.failureException)
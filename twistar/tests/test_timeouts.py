@@ -0,0 +1,119 @@
+from __future__ import absolute_import
+from twisted.trial import unittest
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, CancelledError
+
+from twistar.dbconfig.base import RunningInteraction
+from twistar.exceptions import QueryTimeoutError
+from twistar.registry import Registry
+from twistar.utils import transaction
+
+from .utils import User, DBObject, initDB, tearDownDB, DBTYPE
+
+# a query counting to a hundred million, which takes several seconds
+SLOW = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 100000000) SELECT COUNT(*) FROM c"
+
+
+class TimedUser(DBObject):
+    TABLENAME = 'users'
+    TIMEOUT = 0.05
+
+
+class TimeoutTest(unittest.TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        if DBTYPE != 'sqlite':
+            raise unittest.SkipTest("The slow query is written for SQLite")
+        yield initDB(self)
+        self.config = Registry.getConfig()
+        yield User(first_name="First").save()
+
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield tearDownDB(self)
+
+
+    def slow(self, txn):
+        self.config.executeTxn(txn, SLOW)
+        return txn.fetchone()[0]
+
+
+    @inlineCallbacks
+    def test_timeout(self):
+        yield self.assertFailure(self.config.runInteraction(self.slow, timeout=0.05), QueryTimeoutError)
+        count = yield self.config.count(User.tablename(), timeout=1)
+        self.assertEqual(count, 1)
+
+        where = ["? < (%s)" % SLOW, 0]
+        yield self.assertFailure(self.config.select(User.tablename(), where=where, timeout=0.05), QueryTimeoutError)
+        yield self.assertFailure(TimedUser.find(where=where), QueryTimeoutError)
+        yield self.assertFailure(TimedUser.where(where).count(), QueryTimeoutError)
+        yield self.assertFailure(TimedUser.findColumns(['id'], where=where), QueryTimeoutError)
+        yield self.assertFailure(TimedUser.claim(where=where, set={'age': 1}), QueryTimeoutError)
+        users = yield TimedUser.all()
+        self.assertEqual(len(users), 1)
+
+
+    @inlineCallbacks
+    def test_endTimeout_failure(self):
+        def endTimeout(txn):
+            raise RuntimeError("connection lost")
+        self.patch(self.config, 'endTimeout', endTimeout)
+
+        def failing(txn):
+            raise ValueError("the interaction's own error")
+
+        yield self.assertFailure(self.config.runInteraction(failing, timeout=1), ValueError)
+        count = yield self.config.count(User.tablename(), timeout=1)
+        self.assertEqual(count, 1)
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 2)
+
+
+    @inlineCallbacks
+    def test_cancel(self):
+        d = self.config.runInteraction(self.slow)
+        reactor.callLater(0.05, d.cancel)
+        yield self.assertFailure(d, CancelledError)
+
+        # the connection is usable again
+        users = yield User.all()
+        self.assertEqual(len(users), 1)
+
+
+    def test_interrupt_finished(self):
+        interrupted = []
+
+        class Connection(object):
+            def interrupt(self):
+                interrupted.append(True)
+
+        class Transaction(object):
+            connection = Connection()
+
+        # an interaction that isn't running (any more) isn't interrupted
+        running = RunningInteraction()
+        self.config.interrupt(running)
+        self.assertEqual(interrupted, [])
+        running.txn = Transaction()
+        self.config.interrupt(running)
+        self.assertEqual(interrupted, [True])
+
+
+    @inlineCallbacks
+    def test_transaction(self):
+        @transaction(timeout=0.05)
+        def interaction(txn):
+            User(first_name="Second").save()
+            return self.slow(txn)
+
+        yield self.assertFailure(interaction(), QueryTimeoutError)
+        count = yield User.count()
+        self.assertEqual(count, 1)
+
+        @transaction(timeout=1)
+        def quick(txn):
+            return task.deferLater(reactor, 0, lambda: "done")
+
+        result = yield quick()
+        self.assertEqual(result, "done")
@@ -52,6 +52,26 @@ class TransactionTest(unittest.TestCase):
         self.assertEqual(count, 0)
 
 
+    @inlineCallbacks
+    def test_constraintErrors(self):
+        self.patch(Transaction, 'CONSTRAINT_ERRORS', True)
+
+        @transaction
+        def interaction(txn):
+            def finish(trans):
+                self.assertEqual(len(trans.errors), 1)
+                return Transaction(name="unique name two").save()
+            return Transaction(name="unique name").save().addCallback(
+                lambda _: Transaction(name="unique name").save()).addCallback(finish)
+
+        # the violation is rolled back to a savepoint, so the transaction goes on
+        result = yield interaction()
+        self.assertEqual(len(result.errors), 0)
+
+        count = yield Transaction.count()
+        self.assertEqual(count, 2)
+
+
     @inlineCallbacks
     def test_success(self):
 
@@ -1,12 +1,14 @@
 from __future__ import absolute_import
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, fail, succeed
 
 from twistar import utils
+from twistar.exceptions import StaleObjectError
 
 from .utils import User, initDB, tearDownDB
 
 from collections import OrderedDict
+from array import array
 
 
 class UtilsTest(unittest.TestCase):
@@ -51,6 +53,7 @@ class UtilsTest(unittest.TestCase):
         age = ['age <> ?', 20]
 
         where = utils.joinMultipleWheres([first, last, age], joiner='AND')
+        self.assertEqual(where, ["(first_name = ?) AND (last_name = ?) AND (age <> ?)", "First", "Last", 20])
 
         results = yield User.count(where=where)
         self.assertEqual(1, results)
@@ -78,6 +81,62 @@ class UtilsTest(unittest.TestCase):
         self.assertEqual(result, ["(one = ?) AND (three is ?)", "two", None])
 
 
+    def test_queryTarget(self):
+        self.assertEqual(utils.queryTarget("SELECT * FROM users WHERE id = ?"), ('select', 'users'))
+        self.assertEqual(utils.queryTarget('INSERT INTO "users" (name) VALUES (?)'), ('insert', 'users'))
+        self.assertEqual(utils.queryTarget("update users SET name = ?"), ('update', 'users'))
+        self.assertEqual(utils.queryTarget("SELECT lastval()"), ('select', None))
+
+
+    def test_extendColumn(self):
+        column = utils.extendColumn(None, (1, 2))
+        self.assertTrue(isinstance(column, array))
+        column = utils.extendColumn(column, (3,))
+        self.assertEqual(column.tolist(), [1, 2, 3])
+
+        column = utils.extendColumn(column, (4.5,))
+        self.assertEqual((column.typecode, column.tolist()), ('d', [1.0, 2.0, 3.0, 4.5]))
+
+        column = utils.extendColumn(column, (None, "a"))
+        self.assertEqual(column, [1.0, 2.0, 3.0, 4.5, None, "a"])
+        self.assertEqual(utils.extendColumn(None, (True, False)), [True, False])
+
+        # integers beyond 64 bits, or beyond what a double holds exactly, keep their values
+        big = 2 ** 64
+        self.assertEqual(utils.extendColumn(None, (1, big)), [1, big])
+        self.assertEqual(utils.extendColumn(None, (0.5, 2 ** 53 + 1)), [0.5, 2 ** 53 + 1])
+        column = utils.extendColumn(None, (2 ** 60,))
+        self.assertEqual(utils.extendColumn(column, (0.5,)), [2 ** 60, 0.5])
+        column = utils.extendColumn(utils.extendColumn(None, (0.5,)), (2 ** 60,))
+        self.assertEqual(column, [0.5, 2 ** 60])
+        column = utils.extendColumn(column, (big,))
+        self.assertEqual(column, [0.5, 2 ** 60, big])
+
+
+    @inlineCallbacks
+    def test_retryOnStale(self):
+        calls = []
+
+        @utils.retryOnStale(attempts=3)
+        def update(failures):
+            calls.append(failures)
+            if len(calls) <= failures:
+                return fail(StaleObjectError())
+            return succeed(len(calls))
+
+        result = yield update(2)
+        self.assertEqual(result, 3)
+
+        del calls[:]
+        yield self.assertFailure(update(3), StaleObjectError)
+        self.assertEqual(len(calls), 3)
+
+        other = utils.retryOnStale()(lambda: calls.append(None) or fail(ValueError()))
+        del calls[:]
+        yield self.assertFailure(other(), ValueError)
+        self.assertEqual(len(calls), 1)
+
+
     @inlineCallbacks
     def tearDown(self):
         yield tearDownDB(self)
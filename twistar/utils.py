@@ -6,18 +6,36 @@ from __future__ import absolute_import
 from twisted.internet import defer, threads, reactor
 
 from twistar.registry import Registry
-from twistar.exceptions import TransactionError
+from twistar.exceptions import TransactionError, StaleObjectError
 import six
 from six.moves import range
-from functools import reduce
+from array import array
+import re
 
 
-def transaction(interaction):
+QUERY_TARGET_RE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+([`"\w.]+)', re.IGNORECASE)
+
+
+def transaction(interaction=None, retry=None, timeout=None):
     """
     A decorator to wrap any code in a transaction.  If any exceptions are raised, all modifications
-    are rolled back.  The function that is decorated should accept at least one argument, which is
+    are rolled back, and a L{TransactionError} is raised with the exception as its C{original}.
+    The function that is decorated should accept at least one argument, which is
     the transaction (in case you want to operate directly on it).
+
+    The decorator can also be given a L{RetryPolicy<twistar.retry.RetryPolicy>}, as in
+    C{@transaction(retry=RetryPolicy())}, to run the whole function again in a new
+    transaction if it fails with a transient error like a deadlock.  Otherwise,
+    L{Registry.RETRY_POLICY} is used, if set.  It can also be given a C{timeout} in seconds
+    for the whole transaction, as in C{@transaction(timeout=5)}: if the function runs past it,
+    the transaction is rolled back and a
+    L{QueryTimeoutError<twistar.exceptions.QueryTimeoutError>} is raised (see
+    L{InteractionBase.runPooled<twistar.dbconfig.base.InteractionBase.runPooled>}).  The
+    C{Deferred} returned by the decorated function can be cancelled in the same way.
     """
+    if interaction is None:
+        return lambda interaction: transaction(interaction, retry, timeout)
+
     def _transaction(txn, args, kwargs):
         config = Registry.getConfig()
         config.txn = txn
@@ -28,14 +46,44 @@ def transaction(interaction):
             return result
         except Exception as e:
             config.txn = None
-            raise TransactionError(str(e))
+            raise TransactionError(str(e), e)
 
     def wrapper(*args, **kwargs):
-        return Registry.DBPOOL.runInteraction(_transaction, args, kwargs)
+        return Registry.getConfig().runPooled(_transaction, args, kwargs, timeout=timeout, retry=retry)
 
     return wrapper
 
 
+def retryOnStale(attempts=3):
+    """
+    A decorator that calls a function returning a C{Deferred} again when it fails with a
+    L{StaleObjectError}, up to C{attempts} times in all.  The function should load the objects
+    it changes each time it's called, so that each attempt works on their latest versions
+    (see the C{LOCK_VERSION} option of L{DBObject<twistar.dbobject.DBObject>}).  For instance::
+
+        @retryOnStale(attempts=5)
+        @defer.inlineCallbacks
+        def addPoints(userid, points):
+            user = yield User.find(userid)
+            user.points += points
+            yield user.save()
+    """
+    def decorator(func):
+        def wrapper(*args, **kwargs):
+            def _attempt(remaining):
+                d = defer.maybeDeferred(func, *args, **kwargs)
+                if remaining > 1:
+                    d.addErrback(_retry, remaining - 1)
+                return d
+
+            def _retry(failure, remaining):
+                failure.trap(StaleObjectError)
+                return _attempt(remaining)
+            return _attempt(attempts)
+        return wrapper
+    return decorator
+
+
 def createInstances(props, klass):
     """
     Create an instance of C{list} of instances of a given class
@@ -100,7 +148,8 @@ def joinWheres(wone, wtwo, joiner="AND"):
 def joinMultipleWheres(wheres, joiner="AND"):
     """
     Take a list of wheres (of the same format as the C{where} parameter in the
-    function L{DBObject.find}) and join them.
+    function L{DBObject.find}) and join them.  The conditionals are joined side by side,
+    like C{(a) AND (b) AND (c)}, rather than nested.
 
     @param wheres: List of where clauses to join C{list}
 
@@ -109,10 +158,14 @@ def joinMultipleWheres(wheres, joiner="AND"):
     @return: A joined version of the list of the given wheres.
     """
     wheres = [w for w in wheres if w]   # discard empty wheres
-    if not wheres:
-        return []
+    if len(wheres) < 2:
+        return list(wheres[0]) if wheres else []
 
-    return reduce(lambda x, y: joinWheres(x, y, joiner), wheres)
+    statement = (" %s " % joiner).join(["(%s)" % where[0] for where in wheres])
+    args = []
+    for where in wheres:
+        args.extend(where[1:])
+    return [statement] + args
 
 
 def deferredDict(d):
@@ -136,3 +189,93 @@ def deferredDict(d):
 
     dl = defer.DeferredList(list(d.values()))
     return dl.addCallback(handle, list(d.keys()))
+
+
+def queryTarget(query):
+    """
+    Determine the operation and table of a SQL statement.
+
+    For instance, C{queryTarget("SELECT * FROM users WHERE id = ?")} returns
+    C{('select', 'users')}.
+
+    @param query: A SQL statement C{str}.
+
+    @return: A C{tuple} of the lowercased first keyword of the statement and the
+    name of the first table referenced (or C{None} if no table could be found).
+    """
+    parts = query.split(None, 1)
+    operation = parts[0].lower() if parts else None
+    match = QUERY_TARGET_RE.search(query)
+    tablename = match.group(1).strip('`"') if match else None
+    return (operation, tablename)
+
+
+# 64 bit integers are 'q' in arrays, but that doesn't exist before Python 3.3
+try:
+    INT_TYPECODE = array('q').typecode
+except ValueError:
+    INT_TYPECODE = 'l'
+
+
+# the range of integers an int array holds, and of those a double holds exactly
+INT_LIMIT = 2 ** (array(INT_TYPECODE).itemsize * 8 - 1)
+DOUBLE_INT_LIMIT = 2 ** 53
+
+
+def _exactDoubles(ints):
+    """
+    Find out whether all of the given integers can be converted to doubles exactly.
+    """
+    return all(-DOUBLE_INT_LIMIT <= value <= DOUBLE_INT_LIMIT for value in ints)
+
+
+def _columnTypecode(values):
+    """
+    Get the C{array} typecode that can hold all of the given values exactly, or C{None}.
+    Integers must fit in 64 bits and, if there are floats among them, in a double.
+    """
+    typecode = INT_TYPECODE
+    ints = []
+    for value in values:
+        if isinstance(value, float):
+            typecode = 'd'
+        elif isinstance(value, bool) or not isinstance(value, six.integer_types):
+            return None
+        elif not -INT_LIMIT <= value < INT_LIMIT:
+            return None
+        else:
+            ints.append(value)
+    if typecode == 'd' and not _exactDoubles(ints):
+        return None
+    return typecode
+
+
+def extendColumn(column, values):
+    """
+    Add values to a column of a columnar result set (see
+    L{InteractionBase.selectColumnar<twistar.dbconfig.base.InteractionBase.selectColumnar>}).
+    Columns start out as C{array}s of 64 bit integers or doubles when the values allow it,
+    and are converted to an C{array} of doubles or a C{list} when later values require it.
+    Integers too large for 64 bits, or mixed with floats and too large for a double to
+    hold exactly, make the column a C{list}, so no value is changed.
+
+    @param column: The current column (an C{array}, a C{list}, or C{None} for a new column).
+
+    @param values: A C{list} of values to add.
+
+    @return: The column, which may be a new object.
+    """
+    if column is None:
+        typecode = _columnTypecode(values)
+        return array(typecode, values) if typecode is not None else list(values)
+    if isinstance(column, array):
+        typecode = _columnTypecode(values)
+        if typecode is not None and typecode != column.typecode:
+            ints = column if typecode == 'd' else values
+            typecode = 'd' if _exactDoubles(ints) else None
+        if typecode is None:
+            column = column.tolist()
+        elif typecode != column.typecode:
+            column = array('d', column)
+    column.extend(values)
+    return column
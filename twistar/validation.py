@@ -5,7 +5,8 @@ Package providing validation support for L{DBObject}s.
 from __future__ import absolute_import
 from twisted.internet import defer
 from BermiInflector.Inflector import Inflector
-from twistar.utils import joinWheres, deferredDict
+from twistar.registry import Registry
+from twistar.utils import joinWheres
 import six
 
 
@@ -62,7 +63,8 @@ def uniquenessOf(obj, names, kwargs):
     """
     A validator to test whether or not some named properties are unique.
     For those named properties that are not unique, an error will
-    be recorded in C{obj.errors}.
+    be recorded in C{obj.errors}.  All of the named properties are
+    tested with a single query.
 
     @param obj: The object whose properties need to be tested.
     @param names: The names of the properties to test.
@@ -72,19 +74,89 @@ def uniquenessOf(obj, names, kwargs):
     message = kwargs.get('message', "is not unique.")
 
     def handle(results):
-        for propname, value in results.items():
-            if value is not None:
-                obj.errors.add(propname, message)
-    ds = {}
+        for name, exists in zip(names, results):
+            if exists:
+                obj.errors.add(name, message)
+    wheres = []
     for name in names:
         where = ["%s = ?" % name, getattr(obj, name, "")]
         if obj.id is not None:
             where = joinWheres(where, ["id != ?", obj.id])
-        d = obj.__class__.find(where=where, limit=1)
-        ds[name] = d
-    return deferredDict(ds).addCallback(handle)
+        wheres.append(where)
+    config = Registry.getConfig()
+    return config.existsEach(obj.tablename(), wheres).addCallback(handle)
 
 
+def uniquenessOfMany(objs, names, kwargs):
+    """
+    The batch version of L{uniquenessOf}: test whether or not some named properties
+    are unique for each of a C{list} of objects of the same class, using one
+    query per property.  Objects in the batch that share a value are also
+    considered not unique.  If the database matches a value that isn't equal in
+    Python to any of the objects' (because of a case insensitive collation or type
+    coercion, for instance), the objects not yet found to clash are checked one by
+    one as in L{uniquenessOf}, with one more query.
+
+    @param objs: The objects whose properties need to be tested.
+    @param names: The names of the properties to test.
+    @param kwargs: Keyword arguments.  Right now, all but a
+    C{message} value are ignored.
+    """
+    if len(objs) == 0:
+        return defer.succeed(None)
+    message = kwargs.get('message', "is not unique.")
+    config = Registry.getConfig()
+    tablename = objs[0].tablename()
+
+    def flag(obj, name, flagged):
+        if not any(obj is other for other in flagged):
+            obj.errors.add(name, message)
+            flagged.append(obj)
+
+    def handleEach(results, name, others):
+        for obj, exists in zip(others, results):
+            if exists:
+                obj.errors.add(name, message)
+
+    def handle(rows, name, byvalue, flagged):
+        unmatched = False
+        for row in rows:
+            if row[name] not in byvalue:
+                unmatched = True
+            for obj in byvalue.get(row[name], []):
+                if obj.id != row['id']:
+                    flag(obj, name, flagged)
+        if not unmatched:
+            return
+        others = []
+        for group in byvalue.values():
+            others += [obj for obj in group if not any(obj is other for other in flagged)]
+        wheres = []
+        for obj in others:
+            where = ["%s = ?" % name, getattr(obj, name, "")]
+            if obj.id is not None:
+                where = joinWheres(where, ["id != ?", obj.id])
+            wheres.append(where)
+        return config.existsEach(tablename, wheres).addCallback(handleEach, name, others)
+
+    ds = []
+    for name in names:
+        byvalue = {}
+        for obj in objs:
+            value = getattr(obj, name, "")
+            if value is not None:
+                byvalue.setdefault(value, []).append(obj)
+        flagged = []
+        for group in byvalue.values():
+            if len(group) > 1:
+                for obj in group:
+                    flag(obj, name, flagged)
+        if len(byvalue) == 0:
+            continue
+        d = config.selectIn(tablename, name, list(byvalue.keys()), select="id, %s" % name)
+        ds.append(d.addCallback(handle, name, byvalue, flagged))
+    return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True)
+
 
 class Validator(object):
     """
@@ -92,9 +164,13 @@ class Validator(object):
 
     @cvar VALIDATIONS: A C{list} of functions to call when testing whether or
     not a particular instance is valid.
+
+    @cvar SYNCHRONOUS_VALIDATIONS: The functions in L{VALIDATIONS} that were added as
+    synchronous (see L{addValidator}).
     """
     # list of validation methods to call for this class
     VALIDATIONS = []
+    SYNCHRONOUS_VALIDATIONS = []
 
     @classmethod
     def clearValidations(klass):
@@ -102,17 +178,22 @@ class Validator(object):
         Clear the given class's validations.
         """
         klass.VALIDATIONS = []
+        klass.SYNCHRONOUS_VALIDATIONS = []
 
 
     @classmethod
-    def addValidator(klass, func):
+    def addValidator(klass, func, synchronous=False):
         """
         Add a function to the given classes validation list.
 
         @param klass: The Class to add the validator to.
         @param func: A function that accepts a single parameter that is the object
         to test for validity.  If the object is invalid, then this function should
-        add errors to it's C{errors} property.
+        add errors to it's C{errors} property.  If the function has a C{batch}
+        attribute, it should be a function accepting a C{list} of objects that
+        validates all of them at once; it is used by L{_validateMany}.
+        @param synchronous: If True, C{func} promises never to return a C{Deferred},
+        so it is called inline without any C{Deferred} being created for it.
 
         @see: L{Errors}
         """
@@ -120,6 +201,8 @@ class Validator(object):
         # array to be created and assigned (otherwise, all classes will have
         # this validator added).
         klass.VALIDATIONS = klass.VALIDATIONS + [func]
+        if synchronous:
+            klass.SYNCHRONOUS_VALIDATIONS = klass.SYNCHRONOUS_VALIDATIONS + [func]
 
 
     @classmethod
@@ -136,7 +219,7 @@ class Validator(object):
         """
         def vfunc(obj):
             return presenceOf(obj, names, kwargs)
-        klass.addValidator(vfunc)
+        klass.addValidator(vfunc, synchronous=True)
 
 
     @classmethod
@@ -153,6 +236,7 @@ class Validator(object):
         """
         def vfunc(obj):
             return uniquenessOf(obj, names, kwargs)
+        vfunc.batch = lambda objs: uniquenessOfMany(objs, names, kwargs)
         klass.addValidator(vfunc)
 
 
@@ -176,7 +260,25 @@ class Validator(object):
         """
         def vfunc(obj):
             return lengthOf(obj, names, kwargs)
-        klass.addValidator(vfunc)
+        klass.addValidator(vfunc, synchronous=True)
+
+
+    @classmethod
+    def _splitValidations(klass):
+        """
+        Split this class's validators into those that are synchronous and those that
+        may return a C{Deferred}.
+
+        @return: A C{tuple} of two C{list}s of validators.
+        """
+        sync = []
+        async_ = []
+        for func in klass.VALIDATIONS:
+            if any(func is other for other in klass.SYNCHRONOUS_VALIDATIONS):
+                sync.append(func)
+            else:
+                async_.append(func)
+        return sync, async_
 
 
     @classmethod
@@ -184,27 +286,80 @@ class Validator(object):
         """
         Validate a given object using all of the set validators for the objects class.
         If errors are found, they will be recorded in the objects C{errors} property.
+        Synchronous validators are run inline; if there are no others, the returned
+        C{Deferred} has already fired.  If a validator raises an exception (or its
+        C{Deferred} fails), the returned C{Deferred} fails with it.
 
         @return: A C{Deferred} whose callback will receive the given object.
 
         @see: L{Errors}
         """
-        ds = [defer.maybeDeferred(func, obj) for func in klass.VALIDATIONS]
+        sync, async_ = klass._splitValidations()
+        try:
+            for func in sync:
+                func(obj)
+        except Exception:
+            return defer.fail()
+        if len(async_) == 0:
+            return defer.succeed(obj)
+
+        ds = [defer.maybeDeferred(func, obj) for func in async_]
         # Return the object when finished
-        return defer.DeferredList(ds).addCallback(lambda results: obj)
+        return klass._gatherValidations(ds).addCallback(lambda results: obj)
+
+
+    @classmethod
+    def _validateMany(klass, objs):
+        """
+        Validate a C{list} of objects using all of the set validators for the objects class.
+        Validators that support it (like the one added by L{validatesUniquenessOf}) check
+        the whole batch at once, and synchronous validators are run inline.  If errors
+        are found, they will be recorded in each object's C{errors} property.  If a
+        validator fails, the returned C{Deferred} fails with its error.
+
+        @return: A C{Deferred} whose callback will receive the given C{list}.
+        """
+        sync, async_ = klass._splitValidations()
+        try:
+            for func in sync:
+                for obj in objs:
+                    func(obj)
+        except Exception:
+            return defer.fail()
+
+        ds = []
+        for func in async_:
+            if hasattr(func, 'batch'):
+                ds.append(defer.maybeDeferred(func.batch, objs))
+            else:
+                ds += [defer.maybeDeferred(func, obj) for obj in objs]
+        if len(ds) == 0:
+            return defer.succeed(objs)
+        return klass._gatherValidations(ds).addCallback(lambda results: objs)
+
+
+    @classmethod
+    def _gatherValidations(klass, ds):
+        """
+        Wait for the C{Deferred}s of validators.  If one fails, the returned C{Deferred}
+        fails with its error, just as it does when a synchronous validator raises.
+        """
+        def _unwrap(failure):
+            failure.trap(defer.FirstError)
+            return failure.value.subFailure
+        return defer.DeferredList(ds, fireOnOneErrback=True, consumeErrors=True).addErrback(_unwrap)
 
 
 
 class Errors(dict):
     """
     A class to hold errors found during validation of a L{DBObject}.
-    """
 
-    def __init__(self):
-        """
-        Constructor.
-        """
-        self.infl = Inflector()
+    @cvar HUMANIZED: A cache of humanized property names, shared by all instances
+    (as is the C{Inflector} used to create them).
+    """
+    infl = Inflector()
+    HUMANIZED = {}
 
 
     def add(self, prop, error):
@@ -218,7 +373,10 @@ class Errors(dict):
         @param error: A string error to associate with the given property.
         """
         self[prop] = self.get(prop, [])
-        msg = "%s %s" % (self.infl.humanize(prop), str(error))
+        humanized = Errors.HUMANIZED.get(prop)
+        if humanized is None:
+            humanized = Errors.HUMANIZED[prop] = self.infl.humanize(prop)
+        msg = "%s %s" % (humanized, str(error))
         if msg not in self[prop]:
             self[prop].append(msg)
 